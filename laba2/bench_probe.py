@@ -0,0 +1,122 @@
+import socket
+import statistics
+import struct
+import time
+
+from traceroute import (RECEIVE_BUFFER, SO_TIMESTAMPNS, TIMESPEC, TIME_EXCEEDED, ProbeTemplate,
+                        generate_icmp_packet, parse_reply)
+
+# Бенчмарк стоимости одной пробы: сборка echo request (прежняя generate_icmp_packet с полным
+# подсчетом контрольной суммы против шаблона с инкрементальной) и прием ответа (recvfrom с новым
+# объектом bytes и разбором одного типа ICMP против recvmsg_into в заранее выделенный буфер с меткой
+# времени ядра и parse_reply, который еще и достает идентификатор и номер из процитированной пробы).
+# Ответы идут по UDP через loopback: сырой сокет не нужен, а путь в интерпретаторе тот же
+ITERATIONS = 200_000
+BATCH = 128  # Датаграмм в буфере сокета за один заход приема
+IDENTIFIER = 0x4b53
+
+
+def time_exceeded(sequence_number):
+    """Ответ маршрутизатора, как его видит сокет приема: IP, ICMP time exceeded, цитата пробы"""
+    probe = generate_icmp_packet(IDENTIFIER, sequence_number)
+    quoted = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(probe), 0, 0, 1, socket.IPPROTO_ICMP, 0,
+                         socket.inet_aton("10.0.1.1"), socket.inet_aton("10.0.4.2")) + probe
+    icmp = struct.pack("!BBHI", TIME_EXCEEDED, 0, 0, 0) + quoted
+    return struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(icmp), 0, 0, 64, socket.IPPROTO_ICMP, 0,
+                       socket.inet_aton("10.0.1.2"), socket.inet_aton("10.0.1.1")) + icmp
+
+
+def measure_build(build):
+    started = time.perf_counter()
+    for sequence_number in range(ITERATIONS):
+        build(IDENTIFIER, sequence_number & 0xffff)
+    return (time.perf_counter() - started) / ITERATIONS * 1e9
+
+
+def old_receive(receiver, send_time=0.0):
+    # Прежний прием: новый bytes на каждый ответ, time.time() и только тип ICMP из заголовка
+    # (идентификатор и номер пробы не сверялись)
+    data, addr = receiver.recvfrom(1024)
+    receive_time = time.time()
+    elapsed_time = (receive_time - send_time) * 1000
+    icmp_header = data[20:28]
+    icmp_type, _, _, _, _ = struct.unpack("!BBHHH", icmp_header)
+    return addr[0], elapsed_time, icmp_type
+
+
+def buffered_receiver():
+    buffer = bytearray(RECEIVE_BUFFER)
+    view = memoryview(buffer)
+
+    def receive(receiver):
+        size, addr = receiver.recvfrom_into(buffer)
+        return addr[0], time.monotonic(), parse_reply(view[:size])
+    return receive
+
+
+def new_receiver(receiver):
+    buffer = bytearray(RECEIVE_BUFFER)
+    view = memoryview(buffer)
+    ancillary_size = socket.CMSG_SPACE(TIMESPEC.size)
+    delays = []  # Сколько прошло от метки ядра до метки интерпретатора, нс
+
+    def receive(receiver):
+        size, ancillary, _, addr = receiver.recvmsg_into([buffer], ancillary_size)
+        receive_time = time.monotonic()
+        if ancillary:
+            _, kind, data = ancillary[0]  # Запрошено только одно вспомогательное сообщение
+            if kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                delay = time.time_ns() - seconds * 1_000_000_000 - nanoseconds
+                delays.append(delay)
+                receive_time -= delay / 1e9
+        return addr[0], receive_time, parse_reply(view[:size])
+    return receive, delays
+
+
+def measure_receive(receive, sender, receiver, datagrams):
+    elapsed = 0.0
+    for _ in range(0, ITERATIONS // 4, BATCH):
+        for datagram in datagrams:
+            sender.send(datagram)
+        started = time.perf_counter()
+        for _ in datagrams:
+            receive(receiver)
+        elapsed += time.perf_counter() - started
+    return elapsed / (ITERATIONS // 4 // BATCH * BATCH) * 1e9
+
+
+def main():
+    template = ProbeTemplate()
+    old_build = measure_build(generate_icmp_packet)
+    new_build = measure_build(template.build)
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    receiver.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(receiver.getsockname())
+    datagrams = [time_exceeded(sequence_number) for sequence_number in range(BATCH)]
+
+    receive, delays = new_receiver(receiver)
+    old_receive_time = measure_receive(old_receive, sender, receiver, datagrams)
+    buffered_receive_time = measure_receive(buffered_receiver(), sender, receiver, datagrams)
+    new_receive_time = measure_receive(receive, sender, receiver, datagrams)
+    sender.close()
+    receiver.close()
+
+    print(f"{'этап':<32} {'прежний':>10} {'новый':>10}   (нс на пробу)")
+    print(f"{'сборка пробы':<32} {old_build:>10.0f} {new_build:>10.0f}")
+    print(f"{'прием и разбор ответа':<32} {old_receive_time:>10.0f} {new_receive_time:>10.0f}")
+    print(f"{'  в буфер, без метки ядра':<32} {'':>10} {buffered_receive_time:>10.0f}")
+    print(f"{'всего':<32} {old_build + old_receive_time:>10.0f} {new_build + new_receive_time:>10.0f}")
+    if delays:
+        # Эту задержку прежний код добавлял к RTT, метка ядра ее исключает
+        delays.sort()
+        print(f"\nот приема ядром до метки в интерпретаторе: медиана {statistics.median(delays) / 1000:.1f} мкс, "
+              f"p99 {delays[len(delays) * 99 // 100] / 1000:.1f} мкс (в очереди сокета до {BATCH} ответов)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,159 +1,466 @@
-import socket
-import struct
-import time
-import sys
-
-ICMP_ECHO_REQUEST = 8
-TIME_EXCEEDED = 11
-HOST_UNREACHABLE = 3
-
-
-def compute_checksum(data):
-    total = 0
-    count = (len(data) // 2) * 2
-    i = 0
-
-    while i < count:
-        value = data[i + 1] * 256 + data[i]
-        total += value
-        total &= 0xffffffff
-        i += 2
-
-    if i < len(data):
-        total += data[-1]
-        total &= 0xffffffff
-
-    total = (total >> 16) + (total & 0xffff)
-    total += (total >> 16)
-    result = ~total & 0xffff
-    return (result >> 8) | ((result << 8) & 0xff00)
-
-
-def generate_icmp_packet(identifier, sequence_number):
-
-    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, identifier, sequence_number)
-    payload = struct.pack("d", time.time())
-    checksum_value = compute_checksum(header + payload)
-    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum_value, identifier, sequence_number)
-    return header + payload
-
-
-def perform_traceroute(destination, max_hops=30, timeout_duration=2, packets_per_hop=3, max_timeout_count=10):
-    try:
-        destination_ip = socket.gethostbyname(destination)
-    except socket.gaierror:
-        print(f"Ошибка: не удалось разрешить имя хоста {destination}")
-        return
-
-    print(f"traceroute to {destination} ({destination_ip}), {max_hops} hops max, timeout {timeout_duration * 1000} ms\n")
-
-    try:
-        response_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
-        response_socket.settimeout(timeout_duration)
-    except PermissionError:
-        print("Ошибка: запустите программу с правами администратора (root)")
-        return
-    except Exception as error:
-        print(f"Ошибка при создании сокетов: {error}")
-        return
-
-    packet_id = id(destination_ip) & 0xffff
-    sequence_number = 0
-    consecutive_timeout_counter = 0
-
-    try:
-        for ttl in range(1, max_hops + 1):
-            try:
-                send_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
-                send_socket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
-            except Exception as error:
-                print(f"Ошибка при создании сокета для отправки: {error}")
-                break
-
-            response_times = []
-            visited_ips = set()  # Множество для хранения уникальных IP-адресов
-            timeouts_for_hop = 0
-
-            for _ in range(packets_per_hop):
-                sequence_number += 1
-                try:
-                    send_time = time.time()
-                    icmp_packet = generate_icmp_packet(packet_id, sequence_number)
-                    send_socket.sendto(icmp_packet, (destination_ip, 0))
-
-                    data, addr = response_socket.recvfrom(1024)
-                    receive_time = time.time()
-                    elapsed_time = (receive_time - send_time) * 1000
-
-                    icmp_header = data[20:28]
-                    icmp_type, _, _, _, _ = struct.unpack("!BBHHH", icmp_header)
-
-                    if icmp_type == TIME_EXCEEDED:
-                        visited_ips.add(addr[0])
-                        response_times.append(f"{elapsed_time:.2f} ms")
-                    elif icmp_type == HOST_UNREACHABLE:
-                        visited_ips.add(addr[0])
-                        response_times.append(f"{elapsed_time:.2f} ms")
-                        if addr[0] == destination_ip:
-                            print(f"{ttl:<4} {addr[0]:<15} {' '.join(response_times)} (Хост недоступен!)")
-                            send_socket.close()
-                            response_socket.close()
-                            return
-                    else:
-                        response_times.append("*")
-
-                    if icmp_type == 0 and addr[0] == destination_ip:
-                        print(f"{ttl:<4} {addr[0]:<15} {' '.join(response_times)} ")
-                        send_socket.close()
-                        response_socket.close()
-                        return
-
-                except socket.timeout:
-                    response_times.append("*")
-                    timeouts_for_hop += 1
-                except Exception as error:
-                    print(f"Ошибка на хопе {ttl}: {error}")
-                    response_times.append("*")
-
-            if timeouts_for_hop == packets_per_hop:
-                consecutive_timeout_counter += 1
-            else:
-                consecutive_timeout_counter = 0
-
-            if consecutive_timeout_counter >= max_timeout_count:
-                print("Превышено количество подряд идущих тайм-аутов. Завершение трассировки.")
-                break
-
-            ip_output = ' '.join(visited_ips) if visited_ips else "*"
-            print(f"{ttl:<4} {ip_output:<15} {' '.join(response_times)}")
-            send_socket.close()
-
-    except KeyboardInterrupt:
-        print("\nТрассировка прервана пользователем.")
-
-    print("Цель не достигнута за максимальное количество хопов.")
-    response_socket.close()
-
-
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        command = sys.argv[1]
-        if command.lower() == "mytraceroute":
-            if len(sys.argv) > 2:
-                destination = sys.argv[2]
-            else:
-                print("Ошибка: не указан адрес для трассировки.")
-                sys.exit(1)
-        else:
-            print("Ошибка: команда не распознана.")
-            sys.exit(1)
-    else:
-        user_input = input("Введите команду и адрес (например, mytraceroute google.com): ")
-        parts = user_input.split()
-        if len(parts) == 2 and parts[0].lower() == "mytraceroute":
-            destination = parts[1]
-        else:
-            print("Ошибка: введена некорректная команда.")
-            sys.exit(1)
-
-    perform_traceroute(destination)
+import select
+import socket
+import struct
+import time
+import sys
+from collections import deque
+
+ICMP_ECHO_REQUEST = 8
+ECHO_REPLY = 0
+TIME_EXCEEDED = 11
+HOST_UNREACHABLE = 3
+DEFAULT_WINDOW = 90  # Проб в полете одновременно: 30 хопов x 3 пробы - вся трассировка за один тайм-аут
+PENDING = object()  # Проба отправлена (или еще нет), ответа и тайм-аута пока не было
+PROBE_PAYLOAD = b"ksistrac"  # Нагрузка пробы: 8 байт, как прежняя метка времени
+RECEIVE_BUFFER = 1024  # Буфер приема ответа (заголовок IP, ICMP и процитированная проба)
+# Время приема от ядра (struct timespec); в модуле socket константы нет, 35 - значение в Linux
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+TIMESPEC = struct.Struct("@ll")
+
+
+def compute_checksum(data):
+    total = 0
+    count = (len(data) // 2) * 2
+    i = 0
+
+    while i < count:
+        value = data[i + 1] * 256 + data[i]
+        total += value
+        total &= 0xffffffff
+        i += 2
+
+    if i < len(data):
+        total += data[-1]
+        total &= 0xffffffff
+
+    total = (total >> 16) + (total & 0xffff)
+    total += (total >> 16)
+    result = ~total & 0xffff
+    return (result >> 8) | ((result << 8) & 0xff00)
+
+
+def generate_icmp_packet(identifier, sequence_number):
+
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, identifier, sequence_number)
+    payload = struct.pack("d", time.time())
+    checksum_value = compute_checksum(header + payload)
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum_value, identifier, sequence_number)
+    return header + payload
+
+
+class ProbeTemplate:
+    """Echo request, собранный один раз: для каждой пробы меняются только идентификатор и номер,
+    а контрольная сумма пересчитывается инкрементально (RFC 1624) вместо суммирования всего пакета"""
+
+    def __init__(self, payload=PROBE_PAYLOAD):
+        self.packet = bytearray(struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, 0, 0) + payload)
+        # ~HC шаблона с нулевыми идентификатором и номером; HC' = ~(~HC + ~m + m'), а ~0 в
+        # дополнительном коде - тот же ноль, поэтому достаточно прибавить новые слова
+        self.base = ~compute_checksum(self.packet) & 0xffff
+
+    def build(self, identifier, sequence_number):
+        """Пакет пробы; возвращается один и тот же bytearray, он действителен до следующего вызова"""
+        total = self.base + identifier + sequence_number
+        total = (total & 0xffff) + (total >> 16)
+        total = (total & 0xffff) + (total >> 16)
+        struct.pack_into("!HHH", self.packet, 2, ~total & 0xffff, identifier, sequence_number)
+        return self.packet
+
+
+def parse_reply(data):
+    """Тип ICMP, идентификатор и номер пробы из ответа; для ошибок ICMP - из процитированного
+    заголовка нашего echo request. None, если это не ответ на пробу"""
+    header_length = (data[0] & 0x0f) * 4
+    if len(data) < header_length + 8:
+        return None
+    icmp_type = data[header_length]
+    if icmp_type == ECHO_REPLY:
+        identifier, sequence_number = struct.unpack_from("!HH", data, header_length + 4)
+        return icmp_type, identifier, sequence_number
+    if icmp_type in (TIME_EXCEEDED, HOST_UNREACHABLE):
+        # После 8 байт заголовка ICMP - заголовок IP и первые 8 байт отправленной пробы
+        quoted = header_length + 8
+        if len(data) < quoted + 1:
+            return None
+        quoted_icmp = quoted + (data[quoted] & 0x0f) * 4
+        if len(data) < quoted_icmp + 8 or data[quoted_icmp] != ICMP_ECHO_REQUEST:
+            return None
+        identifier, sequence_number = struct.unpack_from("!HH", data, quoted_icmp + 4)
+        return icmp_type, identifier, sequence_number
+    return None  # Например, собственные echo request при трассировке localhost
+
+
+class TraceState:
+    """Состояние трассировки одного адреса: какие пробы отправлены, какие ответы получены.
+    Сокеты и ожидание - забота ProbeEngine, поэтому одним движком можно вести много трассировок"""
+
+    def __init__(self, destination_ip, identifier, max_hops=30, packets_per_hop=3, hop_by_hop=False,
+                 window=DEFAULT_WINDOW):
+        self.destination_ip = destination_ip
+        self.identifier = identifier
+        self.max_hops = max_hops
+        self.packets_per_hop = packets_per_hop
+        self.window = window
+        # hop_by_hop - пробы по порядку хопов (при окне 1 - последовательный режим), иначе по кругу
+        # по всем TTL: пробы к одному маршрутизатору разнесены во времени
+        self.hop_by_hop = hop_by_hop
+        self.replies = [[PENDING] * packets_per_hop for _ in range(max_hops)]
+        self.in_flight = {}  # номер пробы -> (ttl, проба, время отправки)
+        # Первая проба, на которую ответила цель: пробы после нее не нужны и не отправляются
+        self.cutoff = (max_hops + 1, 0)
+        self.next_probe = 0
+        self.next_hop = 1
+
+    def probe_at(self, index):
+        if self.hop_by_hop:
+            return index // self.packets_per_hop + 1, index % self.packets_per_hop
+        return index % self.max_hops + 1, index // self.max_hops
+
+    def can_send(self):
+        return len(self.in_flight) < self.window and self.next_probe < self.max_hops * self.packets_per_hop
+
+    def take_probe(self):
+        """Следующая проба (ttl, проба, номер) или None, если отправлять больше нечего"""
+        while self.can_send():
+            ttl, probe = self.probe_at(self.next_probe)
+            self.next_probe += 1
+            if (ttl, probe) <= self.cutoff:
+                return ttl, probe, (ttl - 1) * self.packets_per_hop + probe + 1
+        return None
+
+    def sent(self, ttl, probe, sequence_number, send_time):
+        self.in_flight[sequence_number] = (ttl, probe, send_time)
+
+    def failed(self, ttl, probe):
+        self.replies[ttl - 1][probe] = None
+
+    def expire(self, sequence_number):
+        """Тайм-аут пробы; False, если на нее уже ответили или она отменена"""
+        probe = self.in_flight.pop(sequence_number, None)
+        if probe is None:
+            return False
+        self.replies[probe[0] - 1][probe[1]] = None
+        return True
+
+    def reply(self, sequence_number, address, receive_time, icmp_type):
+        """Ответ на пробу; False - чужой или запоздавший ответ"""
+        probe = self.in_flight.pop(sequence_number, None)
+        if probe is None:
+            return False
+        ttl, probe, send_time = probe
+        self.replies[ttl - 1][probe] = (address, (receive_time - send_time) * 1000, icmp_type)
+        if address == self.destination_ip and icmp_type in (ECHO_REPLY, HOST_UNREACHABLE) \
+                and (ttl, probe) < self.cutoff:
+            self.cutoff = (ttl, probe)
+            for pending_sequence in [number for number, (pending_ttl, pending_probe, _) in self.in_flight.items()
+                                     if (pending_ttl, pending_probe) > self.cutoff]:
+                del self.in_flight[pending_sequence]
+        return True
+
+    def stop(self):
+        """Прекращение трассировки (например, после серии тайм-аутов): ответы больше не нужны"""
+        self.in_flight.clear()
+        self.next_probe = self.max_hops * self.packets_per_hop
+        self.next_hop = self.max_hops + 1
+
+    @property
+    def done(self):
+        return self.next_hop > self.max_hops or (self.next_hop, 0) > self.cutoff
+
+    def completed_hops(self):
+        """Завершенные хопы по порядку TTL: (ttl, ответы); пробы после точки отсечения не ждем.
+        Ответ пробы - (адрес, мс, тип ICMP) или None, если за тайм-аут ничего не пришло"""
+        while not self.done:
+            ttl = self.next_hop
+            replies = [reply for probe, reply in enumerate(self.replies[ttl - 1]) if (ttl, probe) <= self.cutoff]
+            if PENDING in replies:
+                return
+            self.next_hop += 1
+            self.replies[ttl - 1] = None  # Выданный хоп больше не хранится
+            yield ttl, replies
+
+
+class ProbeEngine:
+    """Пробы всех TTL из одного сокета отправки; ответы из общего сокета приема сопоставляются
+    с пробами по идентификатору и номеру, поэтому в полете может быть сразу много проб"""
+
+    def __init__(self, timeout_duration=2, window=DEFAULT_WINDOW):
+        self.timeout_duration = timeout_duration
+        self.window = window
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        self.response_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        self.response_socket.setblocking(False)
+        try:
+            # Время приема ставит ядро: в RTT не попадает ожидание интерпретатора до recvmsg
+            self.response_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.kernel_timestamps = True
+        except OSError:
+            self.kernel_timestamps = False
+        self.template = ProbeTemplate()
+        self.buffer = bytearray(RECEIVE_BUFFER)  # Ответы принимаются в один буфер, без выделения памяти
+        self.view = memoryview(self.buffer)
+        self.ancillary_size = socket.CMSG_SPACE(TIMESPEC.size)
+        self.current_ttl = None
+        self.traces = {}  # идентификатор -> TraceState
+        self.deadlines = deque()  # (срок, трассировка, номер пробы) в порядке отправки: тайм-аут у всех одинаковый
+
+    def close(self):
+        self.send_socket.close()
+        self.response_socket.close()
+
+    def send_probe(self, destination_ip, ttl, identifier, sequence_number):
+        if ttl != self.current_ttl:
+            # TTL меняется опцией того же сокета, а не новым сокетом на каждый хоп
+            self.send_socket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+            self.current_ttl = ttl
+        packet = self.template.build(identifier, sequence_number)
+        # Время берется после сборки пакета и перед отправкой: ответ может прийти (и получить метку
+        # ядра) еще до возврата из sendto
+        send_time = time.monotonic()
+        self.send_socket.sendto(packet, (destination_ip, 0))
+        return send_time
+
+    def receive(self, timeout, wakeup=None):
+        """Все ответы, пришедшие за время ожидания: (адрес, время приема, тип, идентификатор, номер).
+        wakeup - дополнительный сокет, готовность которого прерывает ожидание"""
+        sockets = [self.response_socket] if wakeup is None else [self.response_socket, wakeup]
+        ready, _, _ = select.select(sockets, [], [], max(timeout, 0))
+        replies = []
+        while self.response_socket in ready:
+            try:
+                if self.kernel_timestamps:
+                    size, ancillary, _, addr = self.response_socket.recvmsg_into([self.buffer], self.ancillary_size)
+                else:
+                    (size, addr), ancillary = self.response_socket.recvfrom_into(self.buffer), ()
+            except BlockingIOError:
+                break
+            receive_time = time.monotonic()
+            if ancillary:
+                _, kind, data = ancillary[0]  # Запрошено только одно вспомогательное сообщение
+                if kind == SO_TIMESTAMPNS and len(data) >= TIMESPEC.size:
+                    # Метка ядра - по часам реального времени; переводим ее в monotonic по текущему
+                    # сдвигу часов, так что скачок реального времени исказит только этот миг, а не RTT
+                    seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                    receive_time -= (time.time_ns() - seconds * 1_000_000_000 - nanoseconds) / 1e9
+            parsed = parse_reply(self.view[:size])
+            if parsed is not None:
+                replies.append((addr[0], receive_time) + parsed)
+        return replies
+
+    def add(self, trace):
+        self.traces[trace.identifier] = trace
+
+    def remove(self, trace):
+        del self.traces[trace.identifier]
+        trace.stop()
+
+    def send_next(self, trace):
+        """Отправляет следующую пробу трассировки; False - отправлять нечего"""
+        probe = trace.take_probe()
+        if probe is None:
+            return False
+        ttl, probe, sequence_number = probe
+        try:
+            send_time = self.send_probe(trace.destination_ip, ttl, trace.identifier, sequence_number)
+        except OSError as error:
+            print(f"Ошибка на хопе {ttl}: {error}", file=sys.stderr)
+            trace.failed(ttl, probe)
+            return True
+        trace.sent(ttl, probe, sequence_number, send_time)
+        self.deadlines.append((send_time + self.timeout_duration, trace, sequence_number))
+        return True
+
+    def expire(self, now):
+        """Тайм-ауты проб; возвращает трассировки, в которых что-то изменилось"""
+        changed = set()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, trace, sequence_number = self.deadlines.popleft()
+            if trace.expire(sequence_number):
+                changed.add(trace)
+        return changed
+
+    def match(self, received):
+        """Распределение ответов по трассировкам; возвращает те, которым что-то пришло"""
+        changed = set()
+        for address, receive_time, icmp_type, identifier, sequence_number in received:
+            trace = self.traces.get(identifier)
+            # Чужой ответ или ответ на пробу, уже признанную потерянной, отбрасывается
+            if trace is not None and trace.reply(sequence_number, address, receive_time, icmp_type):
+                changed.add(trace)
+        return changed
+
+    def next_deadline(self):
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def trace(self, destination_ip, identifier, max_hops=30, packets_per_hop=3, hop_by_hop=False):
+        """Генератор (ttl, ответы хопа) по порядку TTL, как только хоп и все предыдущие завершены"""
+        trace = TraceState(destination_ip, identifier, max_hops, packets_per_hop, hop_by_hop, self.window)
+        self.add(trace)
+        try:
+            while True:
+                self.expire(time.monotonic())
+                while self.send_next(trace):
+                    # Уже пришедшие ответы забираем сразу, иначе их время приема включало бы отправку остальных проб
+                    self.match(self.receive(0))
+                yield from trace.completed_hops()
+                if trace.done:
+                    return
+                deadline = self.next_deadline()
+                self.match(self.receive(deadline - time.monotonic() if deadline is not None else 0))
+        finally:
+            self.remove(trace)
+
+
+def format_hop(ttl, replies, destination_ip):
+    """Строка хопа и признак завершения трассировки (ответила цель)"""
+    response_times = []
+    visited_ips = []  # Уникальные IP-адреса хопа в порядке ответов
+    for reply in replies:
+        if reply is None:
+            response_times.append("*")
+            continue
+        address, elapsed_time, icmp_type = reply
+        if address not in visited_ips:
+            visited_ips.append(address)
+        response_times.append(f"{elapsed_time:.2f} ms")
+        if address == destination_ip:
+            if icmp_type == HOST_UNREACHABLE:
+                return f"{ttl:<4} {address:<15} {' '.join(response_times)} (Хост недоступен!)", True
+            if icmp_type == ECHO_REPLY:
+                return f"{ttl:<4} {address:<15} {' '.join(response_times)} ", True
+
+    ip_output = ' '.join(visited_ips) if visited_ips else "*"
+    return f"{ttl:<4} {ip_output:<15} {' '.join(response_times)}", False
+
+
+def perform_traceroute(destination, max_hops=30, timeout_duration=2, packets_per_hop=3, max_timeout_count=10,
+                       window=DEFAULT_WINDOW, serial=False):
+    try:
+        destination_ip = socket.gethostbyname(destination)
+    except socket.gaierror:
+        print(f"Ошибка: не удалось разрешить имя хоста {destination}")
+        return
+
+    print(f"traceroute to {destination} ({destination_ip}), {max_hops} hops max, timeout {timeout_duration * 1000} ms\n")
+
+    try:
+        # Последовательный режим - то же самое с одной пробой в полете
+        engine = ProbeEngine(timeout_duration, 1 if serial else window)
+    except PermissionError:
+        print("Ошибка: запустите программу с правами администратора (root)")
+        return
+    except Exception as error:
+        print(f"Ошибка при создании сокетов: {error}")
+        return
+
+    packet_id = id(destination_ip) & 0xffff
+    consecutive_timeout_counter = 0
+
+    try:
+        for ttl, replies in engine.trace(destination_ip, packet_id, max_hops, packets_per_hop, hop_by_hop=serial):
+            line, reached = format_hop(ttl, replies, destination_ip)
+            if reached:
+                print(line)
+                engine.close()
+                return
+
+            if all(reply is None for reply in replies):
+                consecutive_timeout_counter += 1
+            else:
+                consecutive_timeout_counter = 0
+
+            if consecutive_timeout_counter >= max_timeout_count:
+                print("Превышено количество подряд идущих тайм-аутов. Завершение трассировки.")
+                break
+
+            print(line)
+
+    except KeyboardInterrupt:
+        print("\nТрассировка прервана пользователем.")
+
+    print("Цель не достигнута за максимальное количество хопов.")
+    engine.close()
+
+
+if __name__ == "__main__":
+    # Флаги после команды: --serial - по одной пробе за раз, как раньше; --window=N - сколько проб
+    # одновременно в полете; --bulk=targets.txt (или --bulk=- для stdin) - много целей сразу,
+    # результат - строки JSON по хопам; для него --rate=N проб/с, --concurrency=N, --output=файл;
+    # --mtr - непрерывное наблюдение: --interval=1 (с между раундами), --report=10 (с между снимками),
+    # --count=N (раундов, по умолчанию до Ctrl+C), --json (снимки строками JSON), --output=файл;
+    # --topology=файл - граф топологии, пополняемый в режиме --bulk (по умолчанию topology.json для
+    # --stopset); --stopset - режим Doubletree для --bulk (известные участки путей не пробуются),
+    # --start-hop=N - TTL, с которого он начинает; --export=graph.dot|graph.json - выгрузка графа
+    # из --topology без трассировки, --prefix=10.0.4.0/24 - только пути к целям префикса
+    arguments = sys.argv[2:]
+    options = dict((arg[2:].split("=", 1) + [""])[:2] for arg in arguments if arg.startswith("--"))
+    positional = [arg for arg in arguments if not arg.startswith("--")]
+    if len(sys.argv) > 1:
+        command = sys.argv[1]
+        if command.lower() == "mytraceroute":
+            if positional:
+                destination = positional[0]
+            elif "bulk" in options or "export" in options:
+                destination = None
+            else:
+                print("Ошибка: не указан адрес для трассировки.")
+                sys.exit(1)
+        else:
+            print("Ошибка: команда не распознана.")
+            sys.exit(1)
+    else:
+        user_input = input("Введите команду и адрес (например, mytraceroute google.com): ")
+        parts = user_input.split()
+        if len(parts) == 2 and parts[0].lower() == "mytraceroute":
+            destination = parts[1]
+        else:
+            print("Ошибка: введена некорректная команда.")
+            sys.exit(1)
+
+    if options.get("export"):
+        from traceroute_topology import TOPOLOGY_FILE, TopologyStore
+
+        topology = TopologyStore(options.get("topology") or TOPOLOGY_FILE)
+        output = sys.stdout if options["export"] == "-" else open(options["export"], "w", encoding="utf-8")
+        try:
+            if options["export"].endswith(".json"):
+                topology.export_json(output, options.get("prefix"))
+            else:
+                topology.export_dot(output, options.get("prefix"))
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    elif options.get("bulk"):
+        from traceroute_bulk import BULK_CONCURRENCY, BULK_RATE, perform_bulk_traceroute
+
+        topology = None
+        if options.get("topology") or "stopset" in options:
+            from traceroute_topology import TOPOLOGY_FILE, TopologyStore
+
+            topology = TopologyStore(options.get("topology") or TOPOLOGY_FILE)
+        output = open(options["output"], "w", encoding="utf-8") if options.get("output") else sys.stdout
+        try:
+            perform_bulk_traceroute(options["bulk"], output, rate=float(options.get("rate", BULK_RATE)),
+                                    concurrency=int(options.get("concurrency", BULK_CONCURRENCY)),
+                                    topology=topology, stop_set="stopset" in options,
+                                    start_hop=int(options["start-hop"]) if options.get("start-hop") else None)
+        finally:
+            if topology is not None:
+                topology.save()
+            if output is not sys.stdout:
+                output.close()
+    elif "mtr" in options:
+        from traceroute_mtr import MTR_INTERVAL, MTR_REPORT_INTERVAL, perform_mtr
+
+        # Снимки дописываются в конец файла: наблюдение можно перезапускать, не теряя прежних
+        output = open(options["output"], "a", encoding="utf-8") if options.get("output") else sys.stdout
+        try:
+            perform_mtr(destination, output, interval=float(options.get("interval", MTR_INTERVAL)),
+                        report_interval=float(options.get("report", MTR_REPORT_INTERVAL)),
+                        count=int(options["count"]) if options.get("count") else None, as_json="json" in options)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    else:
+        perform_traceroute(destination, window=int(options.get("window", DEFAULT_WINDOW)),
+                           serial="serial" in options)
@@ -0,0 +1,262 @@
+import json
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from traceroute import DEFAULT_WINDOW, ECHO_REPLY, HOST_UNREACHABLE, ProbeEngine, TraceState
+
+BULK_RATE = 200  # Проб в секунду на все трассировки вместе
+BULK_CONCURRENCY = 64  # Трассировок одновременно
+RESOLVER_THREADS = 8  # Потоков разрешения имен
+RESOLVE_AHEAD = 2 * BULK_CONCURRENCY  # Сколько целей разрешается заранее, пока идут трассировки
+
+
+class RateLimiter:
+    """Маркерная корзина: не больше rate проб в секунду, всплеск - не больше burst"""
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate / 10)
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self, now):
+        """Через сколько секунд появится следующий маркер"""
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+def resolve(target):
+    """IPv4-адрес цели; адреса не разрешаются, имена - через getaddrinfo (в потоке резолвера)"""
+    try:
+        # Краткие формы (10.1, 1.2.3) приводятся к полной: с ней сравниваются адреса ответов
+        return socket.inet_ntoa(socket.inet_aton(target))
+    except OSError:
+        return socket.getaddrinfo(target, None, socket.AF_INET, socket.SOCK_RAW)[0][4][0]
+
+
+def read_targets(stream):
+    """Цели по одной в строке; пустые строки и комментарии (#) пропускаются. Файл читается лениво"""
+    for line in stream:
+        target = line.split("#", 1)[0].strip()
+        if target:
+            yield target
+
+
+class BulkTraceroute:
+    """Трассировка многих целей через одну пару сокетов ProbeEngine. Цели читаются и разрешаются
+    по мере освобождения мест, каждый завершенный хоп сразу пишется строкой JSON, поэтому память
+    не зависит от длины списка целей"""
+
+    def __init__(self, engine, output=sys.stdout, rate=BULK_RATE, concurrency=BULK_CONCURRENCY, max_hops=30,
+                 packets_per_hop=3, max_timeout_count=10, window=DEFAULT_WINDOW, topology=None):
+        self.engine = engine
+        self.output = output
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.max_hops = max_hops
+        self.packets_per_hop = packets_per_hop
+        self.max_timeout_count = max_timeout_count
+        self.window = window
+        self.topology = topology  # TopologyStore: ответившие хопы попадают в граф топологии
+        self.resolver = ThreadPoolExecutor(RESOLVER_THREADS)
+        self.resolving = 0  # Целей в разрешении
+        # Разрешенные цели в порядке готовности (медленное имя не задерживает остальные): deque
+        # пополняется из потоков резолвера, готовность будит цикл ожидания ответов через пару сокетов
+        self.resolved = deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.active = {}  # TraceState -> [цель, подряд хопов без ответа, {ttl: ответившие адреса}]
+        self.ready_to_send = deque()  # Трассировки, которым можно отправить пробу (по кругу)
+        self.next_identifier = 0
+        self.traced = 0
+        self.failed = 0
+        self.probes = 0
+
+    def write(self, record):
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+    def resolve(self, target):
+        future = self.resolver.submit(resolve, target)
+        future.add_done_callback(lambda done: self.wake(target, done))
+
+    def wake(self, target, future):
+        self.resolved.append((target, future))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Цикл уже разбужен
+
+    def allocate_identifier(self):
+        # Идентификатор ICMP различает трассировки, номер пробы - хоп и пробу внутри нее
+        while True:
+            self.next_identifier = (self.next_identifier + 1) & 0xffff
+            if self.next_identifier not in self.engine.traces:
+                return self.next_identifier
+
+    def start_traces(self):
+        """Запуск трассировок для разрешенных целей, пока есть свободные места"""
+        while self.resolved and len(self.active) < self.concurrency:
+            target, future = self.resolved.popleft()
+            self.resolving -= 1
+            try:
+                destination_ip = future.result()
+            except (OSError, UnicodeError) as error:
+                # UnicodeError - имя, которое не кодируется в IDNA (пустая метка, метка длиннее 63)
+                self.failed += 1
+                self.write({"target": target, "error": f"не удалось разрешить имя: {error}"})
+                continue
+            trace = self.new_trace(destination_ip)
+            self.engine.add(trace)
+            self.active[trace] = [target, 0, {}]
+            self.ready_to_send.append(trace)
+
+    def new_trace(self, destination_ip):
+        return TraceState(destination_ip, self.allocate_identifier(), self.max_hops, self.packets_per_hop,
+                          window=self.window)
+
+    def report(self, trace):
+        """Строки JSON для завершенных хопов; завершенная трассировка освобождает место"""
+        state = self.active[trace]
+        for ttl, replies in trace.completed_hops():
+            reached = any(reply is not None and reply[0] == trace.destination_ip
+                          and reply[2] in (ECHO_REPLY, HOST_UNREACHABLE) for reply in replies)
+            self.write({
+                "target": state[0], "ip": trace.destination_ip, "hop": ttl,
+                "probes": [None if reply is None else {"ip": reply[0], "rtt_ms": round(reply[1], 3), "type": reply[2]}
+                           for reply in replies],
+                "reached": reached,
+            })
+            state[1] = state[1] + 1 if all(reply is None for reply in replies) else 0
+            addresses = [reply[0] for reply in replies if reply is not None]
+            if addresses:
+                state[2][ttl] = addresses
+            if reached or state[1] >= self.max_timeout_count:
+                break
+        else:
+            if not trace.done:
+                return
+            reached = False
+        self.write({"target": state[0], "ip": trace.destination_ip, "done": True, "reached": reached,
+                    "hops": trace.next_hop - 1 if reached else None})
+        if self.topology is not None:
+            self.topology.add_path(trace.destination_ip, state[2])
+        self.finish(trace)
+
+    def finish(self, trace):
+        del self.active[trace]
+        self.engine.remove(trace)
+        self.traced += 1
+
+    def send_probes(self, now):
+        """Пробы по кругу по трассировкам, пока есть маркеры; возвращает, нужно ли ждать маркер"""
+        while self.ready_to_send:
+            if not self.limiter.take(now):
+                return True
+            trace = self.ready_to_send.popleft()
+            if trace not in self.active or not self.engine.send_next(trace):
+                self.limiter.tokens += 1  # Маркер не израсходован
+                continue
+            self.probes += 1
+            if trace.can_send():
+                self.ready_to_send.append(trace)
+            # Ответы забираются между отправками, чтобы время приема не включало отправку других проб.
+            # Сама трассировка тоже проверяется: проба, не ушедшая из-за ошибки sendto, уже завершена
+            # и не попадет ни в тайм-ауты, ни в ответы
+            changed = self.engine.match(self.engine.receive(0))
+            changed.add(trace)
+            self.handle(changed)
+            now = time.monotonic()
+        return False
+
+    def handle(self, changed):
+        for trace in changed:
+            if trace in self.active:
+                if trace.can_send() and trace not in self.ready_to_send:
+                    self.ready_to_send.append(trace)
+                self.report(trace)
+
+    def run(self, targets):
+        targets = iter(targets)
+        exhausted = False
+        try:
+            while True:
+                # Разрешение имен идет заранее, но не больше RESOLVE_AHEAD целей
+                while not exhausted and self.resolving < RESOLVE_AHEAD:
+                    target = next(targets, None)
+                    if target is None:
+                        exhausted = True
+                        break
+                    self.resolving += 1
+                    self.resolve(target)
+                self.start_traces()
+                if exhausted and not self.resolving and not self.active:
+                    break
+
+                now = time.monotonic()
+                self.handle(self.engine.expire(now))
+                waiting_for_token = self.send_probes(now)
+
+                timeout = 1.0
+                deadline = self.engine.next_deadline()
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                if waiting_for_token:
+                    timeout = min(timeout, self.limiter.delay(time.monotonic()))
+                self.handle(self.engine.match(self.engine.receive(timeout, self.wakeup_reader)))
+                try:
+                    while self.wakeup_reader.recv(1024):
+                        pass
+                except BlockingIOError:
+                    pass
+        finally:
+            self.resolver.shutdown(wait=False, cancel_futures=True)
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+
+
+def perform_bulk_traceroute(source, output=sys.stdout, rate=BULK_RATE, concurrency=BULK_CONCURRENCY,
+                            timeout_duration=2, max_hops=30, packets_per_hop=3, max_timeout_count=10,
+                            topology=None, stop_set=False, start_hop=None):
+    """source - путь к файлу целей или "-" для stdin; результат - строки JSON в output.
+    topology - TopologyStore для пополнения графа; stop_set - режим Doubletree с хопа start_hop"""
+    try:
+        engine = ProbeEngine(timeout_duration)
+    except PermissionError:
+        print("Ошибка: запустите программу с правами администратора (root)", file=sys.stderr)
+        return
+    stream = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    options = dict(output=output, rate=rate, concurrency=concurrency, max_hops=max_hops,
+                   packets_per_hop=packets_per_hop, max_timeout_count=max_timeout_count)
+    if stop_set:
+        from traceroute_topology import DOUBLETREE_START_HOP, StopSetBulkTraceroute
+
+        bulk = StopSetBulkTraceroute(engine, topology, start_hop or DOUBLETREE_START_HOP, **options)
+    else:
+        bulk = BulkTraceroute(engine, topology=topology, **options)
+    started = time.monotonic()
+    try:
+        bulk.run(read_targets(stream))
+    except KeyboardInterrupt:
+        print("\nТрассировка прервана пользователем.", file=sys.stderr)
+    finally:
+        engine.close()
+        if stream is not sys.stdin:
+            stream.close()
+    print(f"Трассировано целей: {bulk.traced}, не разрешено имен: {bulk.failed}, проб: {bulk.probes}, "
+          f"за {time.monotonic() - started:.1f} с", file=sys.stderr)
@@ -0,0 +1,288 @@
+import json
+import socket
+import sys
+import time
+from array import array
+
+from traceroute import ECHO_REPLY, HOST_UNREACHABLE, ProbeEngine
+
+MTR_INTERVAL = 1.0  # Секунд между раундами проб (в раунде - по одной пробе на каждый хоп)
+MTR_REPORT_INTERVAL = 10.0  # Секунд между снимками статистики
+PERCENTILES = (0.5, 0.95)  # Оцениваемые перцентили RTT
+JITTER_GAIN = 1 / 16  # Сглаживание джиттера, как в RFC 3550
+EXACT_SAMPLES = 64  # Первых замеров, по которым перцентиль считается точно, пока не расставлены маркеры P²
+
+
+class P2Quantile:
+    """Потоковая оценка перцентиля алгоритмом P² (Jain, Chlamtac): пять маркеров вместо
+    хранения всех замеров, поэтому память не растет, сколько бы замеров ни было. Первые EXACT_SAMPLES
+    замеров хранятся в массиве фиксированного размера: по ним перцентиль точный (с пятью маркерами
+    в начале оценка p95 еще близка к медиане), а затем по ним же расставляются маркеры"""
+    __slots__ = ('p', 'count', 'samples', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.samples = array('d', bytes(8 * EXACT_SAMPLES))
+        self.heights = array('d', bytes(8 * 5))
+        self.positions = array('d', bytes(8 * 5))
+        self.desired = array('d', bytes(8 * 5))
+        self.increments = array('d', [0, p / 2, p, (1 + p) / 2, 1])
+
+    def start_markers(self):
+        """Маркеры P² по накопленным замерам: высоты - точные квантили, позиции - их ранги"""
+        ordered = sorted(self.samples)
+        last = len(ordered)
+        for i, fraction in enumerate(self.increments):
+            position = 1 + round((last - 1) * fraction)
+            position = min(max(position, self.positions[i - 1] + 1 if i else 1), last - 4 + i)
+            self.positions[i] = position
+            self.heights[i] = ordered[int(position) - 1]
+            self.desired[i] = 1 + (last - 1) * fraction
+        self.samples = None  # Дальше хватает маркеров
+
+    def add(self, value):
+        if self.count < EXACT_SAMPLES:
+            self.samples[self.count] = value
+            self.count += 1
+            if self.count == EXACT_SAMPLES:
+                self.start_markers()
+            return
+        heights = self.heights
+        self.count += 1
+        positions = self.positions
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Средние маркеры сдвигаются к желаемым позициям (параболическая, иначе линейная поправка)
+        for i in (1, 2, 3):
+            shift = self.desired[i] - positions[i]
+            if (shift >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (shift <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if shift > 0 else -1
+                height = heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+                    (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i])
+                    / (positions[i + 1] - positions[i])
+                    + (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1])
+                    / (positions[i] - positions[i - 1]))
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.count < EXACT_SAMPLES:
+            return sorted(self.samples[:self.count])[round(self.p * (self.count - 1))]
+        return self.heights[2]
+
+
+class PathStats:
+    """Статистика по хопам в массивах фиксированного размера (по элементу на TTL)"""
+
+    def __init__(self, max_hops):
+        self.received = array('Q', bytes(8 * max_hops))
+        self.lost = array('Q', bytes(8 * max_hops))
+        self.last = array('d', bytes(8 * max_hops))
+        self.minimum = array('d', [float('inf')] * max_hops)
+        self.maximum = array('d', bytes(8 * max_hops))
+        self.total = array('d', bytes(8 * max_hops))
+        self.jitter = array('d', bytes(8 * max_hops))
+        self.quantiles = [tuple(P2Quantile(p) for p in PERCENTILES) for _ in range(max_hops)]
+        self.addresses = [None] * max_hops  # Последний ответивший адрес хопа
+
+    def add_reply(self, ttl, address, rtt):
+        i = ttl - 1
+        if self.received[i]:
+            self.jitter[i] += (abs(rtt - self.last[i]) - self.jitter[i]) * JITTER_GAIN
+        self.received[i] += 1
+        self.last[i] = rtt
+        self.total[i] += rtt
+        if rtt < self.minimum[i]:
+            self.minimum[i] = rtt
+        if rtt > self.maximum[i]:
+            self.maximum[i] = rtt
+        for estimator in self.quantiles[i]:
+            estimator.add(rtt)
+        self.addresses[i] = address
+
+    def add_loss(self, ttl):
+        self.lost[ttl - 1] += 1
+
+    def hop(self, ttl):
+        i = ttl - 1
+        received, lost = self.received[i], self.lost[i]
+        finished = received + lost
+        return {
+            "hop": ttl,
+            "ip": self.addresses[i],
+            "sent": finished,
+            "received": received,
+            "loss": round(lost / finished * 100, 2) if finished else None,
+            "last_ms": round(self.last[i], 3) if received else None,
+            "min_ms": round(self.minimum[i], 3) if received else None,
+            "avg_ms": round(self.total[i] / received, 3) if received else None,
+            "max_ms": round(self.maximum[i], 3) if received else None,
+            "jitter_ms": round(self.jitter[i], 3) if received else None,
+            "percentiles_ms": {f"p{round(estimator.p * 100)}": (round(estimator.value(), 3) if received else None)
+                               for estimator in self.quantiles[i]},
+        }
+
+
+class MtrTrace:
+    """Непрерывная трассировка для ProbeEngine: каждый раунд - по пробе на каждый хоп до цели.
+    Проба в полете хранится только до ответа или тайм-аута, итоги - только в PathStats"""
+
+    def __init__(self, destination_ip, identifier, max_hops=30):
+        self.destination_ip = destination_ip
+        self.identifier = identifier
+        self.max_hops = max_hops
+        self.path_length = max_hops  # Уменьшается до TTL цели, когда она ответит
+        self.stats = PathStats(max_hops)
+        self.in_flight = {}  # номер пробы -> (ttl, время отправки)
+        self.rounds = 0
+        self.next_ttl = max_hops + 1  # Следующий TTL текущего раунда
+
+    def start_round(self):
+        self.rounds += 1
+        self.next_ttl = 1
+
+    def can_send(self):
+        return self.next_ttl <= self.path_length
+
+    def take_probe(self):
+        if not self.can_send():
+            return None
+        ttl = self.next_ttl
+        self.next_ttl += 1
+        sequence_number = (self.rounds * self.max_hops + ttl) & 0xffff
+        if sequence_number in self.in_flight:
+            # Номер пошел на второй круг раньше тайм-аута старой пробы: она считается потерянной
+            self.expire(sequence_number)
+        return ttl, 0, sequence_number
+
+    def sent(self, ttl, probe, sequence_number, send_time):
+        self.in_flight[sequence_number] = (ttl, send_time)
+
+    def failed(self, ttl, probe):
+        self.stats.add_loss(ttl)
+
+    def expire(self, sequence_number):
+        probe = self.in_flight.pop(sequence_number, None)
+        if probe is None:
+            return False
+        if probe[0] <= self.path_length:
+            self.stats.add_loss(probe[0])
+        return True
+
+    def reply(self, sequence_number, address, receive_time, icmp_type):
+        probe = self.in_flight.pop(sequence_number, None)
+        if probe is None:
+            return False
+        ttl, send_time = probe
+        self.stats.add_reply(ttl, address, (receive_time - send_time) * 1000)
+        if address == self.destination_ip and icmp_type in (ECHO_REPLY, HOST_UNREACHABLE) \
+                and ttl < self.path_length:
+            self.path_length = ttl
+        return True
+
+    def stop(self):
+        self.in_flight.clear()
+        self.next_ttl = self.max_hops + 1
+
+    def snapshot(self, destination):
+        return {
+            "destination": destination,
+            "ip": self.destination_ip,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "rounds": self.rounds,
+            "hops": [self.stats.hop(ttl) for ttl in range(1, self.path_length + 1)],
+        }
+
+
+def format_snapshot(snapshot):
+    """Снимок в виде таблицы, как у mtr"""
+    def number(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    names = [f"p{round(p * 100)}" for p in PERCENTILES]
+    lines = [f"mtr to {snapshot['destination']} ({snapshot['ip']}), раундов {snapshot['rounds']}, {snapshot['time']}",
+             f"{'#':<4} {'адрес':<15} {'потери%':>8} {'отпр':>6} {'посл':>8} {'мин':>8} {'сред':>8} {'макс':>8} "
+             f"{'джиттер':>8} " + " ".join(f"{name:>8}" for name in names)]
+    for hop in snapshot["hops"]:
+        lines.append(f"{hop['hop']:<4} {hop['ip'] or '*':<15} {number(hop['loss']):>8} {hop['sent']:>6} "
+                     f"{number(hop['last_ms']):>8} {number(hop['min_ms']):>8} {number(hop['avg_ms']):>8} "
+                     f"{number(hop['max_ms']):>8} {number(hop['jitter_ms']):>8} "
+                     + " ".join(f"{number(hop['percentiles_ms'][name]):>8}" for name in names))
+    return "\n".join(lines) + "\n\n"
+
+
+def perform_mtr(destination, output=sys.stdout, interval=MTR_INTERVAL, report_interval=MTR_REPORT_INTERVAL,
+                count=None, as_json=False, max_hops=30, timeout_duration=2):
+    """Непрерывная трассировка: раунд проб каждые interval секунд, снимок - каждые report_interval
+    (и в конце); count - сколько раундов (None - до Ctrl+C)"""
+    try:
+        destination_ip = socket.gethostbyname(destination)
+    except socket.gaierror:
+        print(f"Ошибка: не удалось разрешить имя хоста {destination}", file=sys.stderr)
+        return
+    try:
+        engine = ProbeEngine(timeout_duration)
+    except PermissionError:
+        print("Ошибка: запустите программу с правами администратора (root)", file=sys.stderr)
+        return
+
+    trace = MtrTrace(destination_ip, id(destination_ip) & 0xffff, max_hops)
+    engine.add(trace)
+
+    def emit():
+        snapshot = trace.snapshot(destination)
+        output.write(json.dumps(snapshot, ensure_ascii=False) + "\n" if as_json else format_snapshot(snapshot))
+        output.flush()
+
+    now = time.monotonic()
+    next_round = now
+    next_report = now + report_interval
+    try:
+        while True:
+            now = time.monotonic()
+            engine.expire(now)
+            more_rounds = count is None or trace.rounds < count
+            if not more_rounds and not trace.in_flight and not trace.can_send():
+                break  # Последний раунд завершен: на все пробы ответ или тайм-аут
+            if more_rounds and now >= next_round:
+                trace.start_round()
+                next_round += interval
+                if next_round < now:
+                    next_round = now + interval  # Пропущенные раунды не наверстываются пачкой
+            while engine.send_next(trace):
+                engine.match(engine.receive(0))
+            if now >= next_report:
+                emit()
+                next_report += report_interval
+            wake_at = [next_report]
+            if more_rounds:
+                wake_at.append(next_round)
+            if engine.next_deadline() is not None:
+                wake_at.append(engine.next_deadline())
+            engine.match(engine.receive(min(wake_at) - time.monotonic()))
+    except KeyboardInterrupt:
+        print("\nТрассировка прервана пользователем.", file=sys.stderr)
+    finally:
+        emit()
+        engine.remove(trace)
+        engine.close()
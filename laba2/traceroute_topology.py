@@ -0,0 +1,321 @@
+import json
+import os
+import socket
+import struct
+import time
+from collections import deque
+
+from traceroute import ECHO_REPLY, HOST_UNREACHABLE, PENDING
+from traceroute_bulk import BulkTraceroute
+
+TOPOLOGY_FILE = "topology.json"  # Файл графа топологии по умолчанию
+PREFIX_LENGTH = 24  # Длина префикса цели в глобальном множестве остановки
+DOUBLETREE_START_HOP = 5  # TTL, с которого трассировка идет вперед и назад
+STOPSET_MAX_AGE = 24 * 3600  # Секунд, после которых наблюдение не останавливает трассировку
+SOURCE_NODE = "source"  # Вершина графа для самого узла, с которого идут пробы
+
+
+def prefix_of(address, length=PREFIX_LENGTH):
+    value = struct.unpack("!I", socket.inet_aton(address))[0] & (0xffffffff << (32 - length)) & 0xffffffff
+    return f"{socket.inet_ntoa(struct.pack('!I', value))}/{length}"
+
+
+# Граф топологии на уровне интерфейсов: адреса, ответившие на пробы, и связи между ответившими
+# хопами одного пути (distance - разница TTL, больше 1, если между ними молчащие хопы), у всего -
+# время первого и последнего наблюдения. Для каждого префикса цели хранятся интерфейсы, через
+# которые к нему шли пути: это глобальное множество остановки Doubletree, а все известные
+# интерфейсы - локальное. Граф хранится в файле JSON и переживает перезапуск (path=None - только
+# в памяти, на время одного запуска)
+class TopologyStore:
+    def __init__(self, path=TOPOLOGY_FILE, max_age=STOPSET_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.interfaces = {}  # адрес -> [первое, последнее наблюдение]
+        self.links = {}  # (адрес, адрес) -> [distance, первое, последнее наблюдение, сколько раз]
+        self.prefixes = {}  # префикс цели -> {адрес интерфейса на пути: последнее наблюдение}
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as file:
+            data = json.load(file)
+        self.interfaces = {address: list(seen) for address, seen in data["interfaces"].items()}
+        self.links = {(link["from"], link["to"]): [link["distance"], link["first_seen"], link["last_seen"],
+                                                   link["count"]] for link in data["links"]}
+        self.prefixes = data["prefixes"]
+
+    def save(self):
+        """Запись через временный файл: при обрыве остается прежний граф, а не половина нового"""
+        if self.path is None:
+            return
+        data = {
+            "updated": int(time.time()),
+            "interfaces": self.interfaces,
+            "links": [{"from": source, "to": target, "distance": distance, "first_seen": first, "last_seen": last,
+                       "count": count} for (source, target), (distance, first, last, count) in self.links.items()],
+            "prefixes": self.prefixes,
+        }
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(temporary, self.path)
+
+    def known(self, address, now):
+        """Локальное множество остановки: интерфейс уже виден с этого узла"""
+        seen = self.interfaces.get(address)
+        return seen is not None and now - seen[1] <= self.max_age
+
+    def leads_to(self, address, prefix, now):
+        """Глобальное множество остановки: через интерфейс уже шел путь к префиксу"""
+        seen = self.prefixes.get(prefix, {}).get(address)
+        return seen is not None and now - seen <= self.max_age
+
+    def add_hop(self, address, prefix, now):
+        seen = self.interfaces.get(address)
+        if seen is None:
+            self.interfaces[address] = [now, now]
+        else:
+            seen[1] = now
+        self.prefixes.setdefault(prefix, {})[address] = now
+
+    def add_link(self, source, target, distance, now):
+        link = self.links.get((source, target))
+        if link is None:
+            self.links[(source, target)] = [distance, now, now, 1]
+        else:
+            link[0] = min(link[0], distance)
+            link[2] = now
+            link[3] += 1
+
+    def add_path(self, destination_ip, hops, first_ttl=1):
+        """Путь к цели: {ttl: ответившие адреса}; first_ttl - наименьший TTL, с которого шли пробы
+        (связь с источником известна, только если пробы начинались с первого хопа)"""
+        now = int(time.time())
+        prefix = prefix_of(destination_ip)
+        previous, previous_ttl = ([SOURCE_NODE], 0) if first_ttl == 1 else (None, None)
+        for ttl in sorted(hops):
+            addresses = set(hops[ttl])
+            for address in addresses:
+                self.add_hop(address, prefix, now)
+                for source in previous or ():
+                    if source != address:
+                        self.add_link(source, address, ttl - previous_ttl, now)
+            previous, previous_ttl = addresses, ttl
+
+    def graph(self, prefix=None):
+        """Объединенный граф путей: все или только к целям префикса (вершины и связи)"""
+        if prefix is None:
+            nodes = set(self.interfaces)
+        else:
+            # Интерфейсы путей к префиксу и все, что к ним ведет: трассировки, остановленные
+            # множеством остановки, начало общего пути не пробовали
+            nodes = set(self.prefixes.get(prefix, ()))
+            predecessors = {}
+            for source, target in self.links:
+                predecessors.setdefault(target, []).append(source)
+            pending = list(nodes)
+            while pending:
+                for source in predecessors.get(pending.pop(), ()):
+                    if source not in nodes:
+                        nodes.add(source)
+                        pending.append(source)
+        nodes.add(SOURCE_NODE)
+        links = [(source, target, link) for (source, target), link in self.links.items()
+                 if source in nodes and target in nodes]
+        return sorted(nodes), links
+
+    def export_json(self, output, prefix=None):
+        nodes, links = self.graph(prefix)
+        json.dump({
+            "nodes": [{"id": node, "first_seen": self.interfaces[node][0], "last_seen": self.interfaces[node][1]}
+                      if node in self.interfaces else {"id": node} for node in nodes],
+            "links": [{"from": source, "to": target, "distance": distance, "first_seen": first, "last_seen": last,
+                       "count": count} for source, target, (distance, first, last, count) in links],
+        }, output, ensure_ascii=False, indent=1)
+        output.write("\n")
+
+    def export_dot(self, output, prefix=None):
+        """Граф для Graphviz; пунктир - между интерфейсами есть молчащие хопы"""
+        nodes, links = self.graph(prefix)
+        output.write("digraph topology {\n    rankdir=LR;\n")
+        for node in nodes:
+            output.write(f'    "{node}"{" [shape=box]" if node == SOURCE_NODE else ""};\n')
+        for source, target, (distance, _, _, count) in links:
+            style = f', style=dashed, label="{count} (+{distance - 1})"' if distance > 1 else f', label="{count}"'
+            output.write(f'    "{source}" -> "{target}" [weight={count}{style}];\n')
+        output.write("}\n")
+
+
+class DoubletreeTrace:
+    """Трассировка Doubletree для ProbeEngine: с хопа start_hop вперед, пока путь не приведет
+    к интерфейсу, через который уже шел путь к префиксу цели (глобальное множество остановки),
+    и одновременно назад, пока не встретится интерфейс, уже известный с этого узла (локальное).
+    Хопы пробуются по одному в каждом направлении: решение о следующем зависит от ответа"""
+
+    def __init__(self, destination_ip, identifier, topology, start_hop=DOUBLETREE_START_HOP, max_hops=30,
+                 packets_per_hop=3, max_timeout_count=10):
+        self.destination_ip = destination_ip
+        self.identifier = identifier
+        self.topology = topology
+        self.prefix = prefix_of(destination_ip)
+        self.max_hops = max_hops
+        self.packets_per_hop = packets_per_hop
+        self.max_timeout_count = max_timeout_count
+        self.start_hop = min(start_hop, max_hops)
+        self.replies = {}  # ttl -> ответы хопа в работе (PENDING, пока ответа и тайм-аута нет)
+        self.in_flight = {}  # номер пробы -> (ttl, проба, время отправки)
+        self.queue = deque()  # (ttl, проба), ожидающие отправки
+        self.completed = deque()  # (ttl, ответы) завершенных хопов, еще не выданных
+        self.path = {}  # ttl -> ответившие адреса
+        self.forward = True
+        self.backward = self.start_hop > 1
+        self.lowest_ttl = self.start_hop
+        self.silent = 0  # Подряд хопов без ответа при движении вперед
+        self.reached = None  # Наименьший TTL, на котором ответила цель
+        self.stopped_at = None  # Интерфейс, на котором остановлено движение вперед
+        self.joined_at = None  # Интерфейс, на котором остановлено движение назад
+        self.loop_at = None  # Интерфейс, повторно ответивший на этой же трассировке (петля или недоступность)
+        self.probes = 0
+        self.queue_hop(self.start_hop)
+        if self.backward:
+            self.queue_hop(self.start_hop - 1)
+
+    def queue_hop(self, ttl):
+        self.replies[ttl] = [PENDING] * self.packets_per_hop
+        self.queue.extend((ttl, probe) for probe in range(self.packets_per_hop))
+
+    def can_send(self):
+        return bool(self.queue)
+
+    def take_probe(self):
+        if not self.queue:
+            return None
+        ttl, probe = self.queue.popleft()
+        self.probes += 1
+        return ttl, probe, (ttl - 1) * self.packets_per_hop + probe + 1
+
+    def sent(self, ttl, probe, sequence_number, send_time):
+        self.in_flight[sequence_number] = (ttl, probe, send_time)
+
+    def set_reply(self, ttl, probe, reply):
+        replies = self.replies.get(ttl)
+        if replies is None:
+            return
+        replies[probe] = reply
+        if PENDING not in replies:
+            del self.replies[ttl]
+            self.complete(ttl, replies)
+
+    def failed(self, ttl, probe):
+        self.set_reply(ttl, probe, None)
+
+    def expire(self, sequence_number):
+        probe = self.in_flight.pop(sequence_number, None)
+        if probe is None:
+            return False
+        self.set_reply(probe[0], probe[1], None)
+        return True
+
+    def reply(self, sequence_number, address, receive_time, icmp_type):
+        probe = self.in_flight.pop(sequence_number, None)
+        if probe is None:
+            return False
+        ttl, probe, send_time = probe
+        self.set_reply(ttl, probe, (address, (receive_time - send_time) * 1000, icmp_type))
+        return True
+
+    def seen_before(self, address):
+        """Адрес уже ответил на другом хопе этой же трассировки: множества остановки пополняются
+        ее собственными хопами, но путь, выученный раньше, - это не они"""
+        return any(address in seen for seen in self.path.values())
+
+    def complete(self, ttl, replies):
+        self.completed.append((ttl, replies))
+        addresses = [reply[0] for reply in replies if reply is not None]
+        reached = any(reply is not None and reply[0] == self.destination_ip
+                      and reply[2] in (ECHO_REPLY, HOST_UNREACHABLE) for reply in replies)
+        if reached and (self.reached is None or ttl < self.reached):
+            self.reached = ttl
+        now = int(time.time())
+
+        if ttl >= self.start_hop:
+            repeated = next((address for address in addresses if self.seen_before(address)), None)
+            known = next((address for address in addresses if not self.seen_before(address)
+                          and self.topology.leads_to(address, self.prefix, now)), None)
+            self.silent = 0 if addresses else self.silent + 1
+            if reached or self.silent >= self.max_timeout_count or ttl >= self.max_hops:
+                self.forward = False
+            elif repeated is not None:
+                # Тот же интерфейс на большем TTL: петля маршрутизации или маршрутизатор, отвечающий
+                # недоступностью, - дальше пробовать бессмысленно, но и выученным путь не считается
+                self.forward = False
+                self.loop_at = repeated
+            elif known is not None:
+                self.forward = False
+                self.stopped_at = known
+            else:
+                self.queue_hop(ttl + 1)
+        else:
+            self.lowest_ttl = ttl
+            # Адреса, которые эта же трассировка видела впереди (например, сама цель), - не стык
+            known = next((address for address in addresses if self.topology.known(address, now)
+                          and not self.seen_before(address)), None)
+            if known is not None:
+                self.backward = False
+                self.joined_at = known
+            elif ttl > 1:
+                self.queue_hop(ttl - 1)
+            else:
+                self.backward = False
+
+        # Множества остановки пополняются сразу: их видят и трассировки, идущие параллельно
+        for address in addresses:
+            self.topology.add_hop(address, self.prefix, now)
+        if addresses:
+            self.path[ttl] = addresses
+
+    def stop(self):
+        self.in_flight.clear()
+        self.queue.clear()
+        self.replies.clear()
+        self.forward = self.backward = False
+
+    @property
+    def done(self):
+        return not self.forward and not self.backward and not self.replies
+
+    def completed_hops(self):
+        """Завершенные хопы в порядке завершения (вперед и назад вперемешку)"""
+        while self.completed:
+            yield self.completed.popleft()
+
+
+class StopSetBulkTraceroute(BulkTraceroute):
+    """Трассировка списка целей в режиме Doubletree: известные участки путей не пробуются заново"""
+
+    def __init__(self, engine, topology=None, start_hop=DOUBLETREE_START_HOP, **options):
+        # Без графа из файла множества остановки копятся только в памяти этого запуска
+        super().__init__(engine, topology=topology if topology is not None else TopologyStore(None), **options)
+        self.start_hop = start_hop
+
+    def new_trace(self, destination_ip):
+        return DoubletreeTrace(destination_ip, self.allocate_identifier(), self.topology, self.start_hop,
+                               self.max_hops, self.packets_per_hop, self.max_timeout_count)
+
+    def report(self, trace):
+        state = self.active[trace]
+        for ttl, replies in trace.completed_hops():
+            self.write({
+                "target": state[0], "ip": trace.destination_ip, "hop": ttl,
+                "probes": [None if reply is None else {"ip": reply[0], "rtt_ms": round(reply[1], 3), "type": reply[2]}
+                           for reply in replies],
+                "reached": any(reply is not None and reply[0] == trace.destination_ip
+                               and reply[2] in (ECHO_REPLY, HOST_UNREACHABLE) for reply in replies),
+            })
+        if not trace.done:
+            return
+        self.write({"target": state[0], "ip": trace.destination_ip, "done": True, "reached": trace.reached is not None,
+                    "hops": trace.reached, "probes": trace.probes, "stopped_at": trace.stopped_at,
+                    "joined_at": trace.joined_at, "loop_at": trace.loop_at})
+        self.topology.add_path(trace.destination_ip, trace.path, trace.lowest_ttl)
+        self.finish(trace)
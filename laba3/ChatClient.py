@@ -1,20 +1,55 @@
+import os
 import socket
 import sys
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import time
 import signal
 
+import ChatProtocol as protocol
+from ChatProtocol import HEARTBEAT, HEARTBEAT_ACK, HEARTBEAT_INTERVAL, MAX_MISSED_HEARTBEATS, pack_frame
+from ChatReliable import LossSimulator, ReliableChannel
+from ChatRooms import DEFAULT_ROOM
+
+# Максимальный размер UDP-датаграммы: сообщения не обрезаются
+MAX_DATAGRAM_SIZE = 65535
+# Как долго ждать датаграмму, если не нужно следить за таймерами надежной доставки, с
+RECV_TIMEOUT = 5.0
+RELIABLE_POLL_INTERVAL = 0.1
+# Сколько последних номеров сообщений комнаты помнится, чтобы не показать сообщение дважды
+SHOWN_WINDOW = 256
+
 
 class ChatClient:
-    def __init__(self):
-        self.username = input("Введите ваше имя: ").strip()
-        self.client_ip = self.get_valid_client_ip()
-        self.server_address = self.get_valid_server_ip()
-        self.server_port = self.get_valid_port("сервера")
-        self.client_port = self.get_valid_port("клиента")
+    def __init__(self, text_protocol=False, reliable=False, simulator=None, username=None, client_ip=None,
+                 server_address=None, server_port=None, client_port=None):
+        # По умолчанию используется двоичный протокол; текстовый - для совместимости со старыми серверами
+        self.text_protocol = text_protocol
+        # Надежная доставка (только в двоичном протоколе): кадры уходят внутри DATA с подтверждениями.
+        # Канал используют поток ввода и поток приема, поэтому обращения к нему идут под блокировкой
+        self.channel = ReliableChannel(self.transmit) if reliable and not text_protocol else None
+        self.channel_lock = Lock()
+        self.simulator = simulator
+        self.session_id = 0  # Номер сессии, выданный сервером (двоичный протокол)
+        self.seq = 0  # Счетчик отправленных сообщений
+        self.names = {}  # номер сессии -> имя отправителя
+        self.room_names = {}  # номер комнаты -> имя
+        # Последний известный номер сообщения в каждой комнате: после повторной регистрации
+        # или входа в комнату клиент запрашивает историю начиная с него
+        self.room_seqs = {}  # имя комнаты -> номер
+        # Номера уже показанных сообщений: живое сообщение, пришедшее между входом в комнату
+        # и порцией истории, приходит и в ней - второй раз оно не печатается
+        self.shown_seqs = {}  # имя комнаты -> множество номеров (последние SHOWN_WINDOW)
+        self.pending = {}  # номер сессии -> сообщения, ждущие ответа на WHOIS
+        # Параметры, переданные явно (режим без интерактивного ввода), не запрашиваются
+        self.username = username if username is not None else input("Введите ваше имя: ").strip()
+        self.client_ip = client_ip if client_ip is not None else self.get_valid_client_ip()
+        self.server_address = server_address if server_address is not None else self.get_valid_server_ip()
+        self.server_port = server_port if server_port is not None else self.get_valid_port("сервера")
+        self.client_port = client_port if client_port is not None else self.get_valid_port("клиента")
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.exit_event = Event()
         self.connected = False
+        self.last_sent = time.monotonic()  # Когда клиент в последний раз что-то отправлял серверу
 
         # Настройка обработчиков сигналов
         signal.signal(signal.SIGINT, self.handle_shutdown)
@@ -22,11 +57,13 @@ class ChatClient:
 
         try:
             self.socket.bind((self.client_ip, self.client_port))
+            self.client_port = self.socket.getsockname()[1]  # Порт 0 - выбирает система
             # Устанавливаем таймаут для сокета
-            self.socket.settimeout(5.0)
+            self.socket.settimeout(RECV_TIMEOUT)
             self.connected = True
             print(f"\n{self.username}, вы подключены через {self.client_ip}:{self.client_port}")
-            print("Введите сообщение (выход - 'exit'):\n")
+            print("Введите сообщение (выход - 'exit'):")
+            print("Комнаты: /join <комната>, /leave <комната>, /rooms, /history [номер]\n")
         except socket.error as e:
             print(f"Ошибка привязки к {self.client_ip}:{self.client_port}: {e}")
             sys.exit(1)
@@ -40,9 +77,12 @@ class ChatClient:
         """Корректное отключение клиента"""
         if self.connected:
             try:
-                self.socket.sendto(b'exit', (self.server_address, self.server_port))
+                self.send_exit()
             except:
                 pass  # Игнорируем ошибки при завершении
+            if self.channel is not None:
+                with self.channel_lock:
+                    print(self.channel.format_stats(self.channel.stats()))
 
         self.exit_event.set()
         time.sleep(0.2)
@@ -103,35 +143,180 @@ class ChatClient:
             except ValueError:
                 print("Введите число")
 
+    def send(self, data):
+        if self.channel is None:
+            self.socket.sendto(data, (self.server_address, self.server_port))
+        else:
+            with self.channel_lock:
+                self.channel.queue((self.server_address, self.server_port), data)
+                self.channel.flush(time.monotonic())
+        self.last_sent = time.monotonic()
+
+    def transmit(self, batch):
+        for address, datagram in batch:
+            self.socket.sendto(datagram, address)
+
+    def send_register(self):
+        if self.text_protocol:
+            # Отправляем регистрационное сообщение с добавлением IP клиента
+            self.send(f"reg:{self.username}:{self.client_ip}".encode())
+        else:
+            self.send(pack_frame(protocol.REGISTER, self.username.encode()))
+
+    def send_message(self, message):
+        if self.text_protocol:
+            self.send(message.encode())
+        elif message.startswith("/"):
+            self.send(pack_frame(protocol.COMMAND, message.encode(), self.session_id))
+        else:
+            self.seq += 1
+            self.send(pack_frame(protocol.MESSAGE, message.encode(), self.session_id, self.seq))
+
+    def send_heartbeat(self, reregister=False):
+        if reregister and not self.text_protocol and self.channel is None:
+            # Ответа на прошлый heartbeat не было - возможно, сессия истекла: повторная регистрация
+            # вернет прежний номер сессии или выдаст новый, после чего клиент догонит историю
+            self.send_register()
+        else:
+            self.send(HEARTBEAT if self.text_protocol else pack_frame(protocol.PING, session=self.session_id))
+
+    def request_history(self, room, since):
+        self.send(pack_frame(protocol.HISTORY_REQUEST, session=self.session_id, seq=since, room=room))
+
+    def remember_seq(self, room, seq):
+        """Запоминает номер сообщения; False - сообщение с этим номером уже показано"""
+        room_name = self.room_names.get(room, DEFAULT_ROOM)
+        highest = max(seq, self.room_seqs.get(room_name, 0))
+        self.room_seqs[room_name] = highest
+        shown = self.shown_seqs.setdefault(room_name, set())
+        if seq in shown:
+            return False
+        shown.add(seq)
+        if len(shown) > 2 * SHOWN_WINDOW:
+            shown.difference_update([number for number in shown if number <= highest - SHOWN_WINDOW])
+        return True
+
+    def send_exit(self):
+        # Выход отправляется без надежной доставки: если он потеряется, сервер удалит сессию по тайм-ауту
+        self.socket.sendto(b'exit' if self.text_protocol else pack_frame(protocol.EXIT, session=self.session_id),
+                           (self.server_address, self.server_port))
+
+    def handle_frame(self, data):
+        """Обработка кадра двоичного протокола; False - сервер закрывается"""
+        try:
+            kind, room, session, seq, payload = protocol.parse_frame(data)
+        except protocol.FrameError:
+            return True
+        if kind == protocol.DELIVER:
+            self.remember_seq(room, seq)
+            text = str(payload, 'utf-8', 'replace')
+            if session in self.names:
+                self.print_message(session, room, text)
+            else:
+                # Имя отправителя еще неизвестно: спрашиваем у сервера, сообщение ждет ответа
+                self.pending.setdefault(session, []).append((room, text))
+                self.send(pack_frame(protocol.WHOIS, session=session))
+        elif kind == protocol.NAME:
+            self.names[session] = str(payload, 'utf-8', 'replace')
+            for room, text in self.pending.pop(session, ()):
+                self.print_message(session, room, text)
+        elif kind == protocol.NOTICE:
+            print(str(payload, 'utf-8', 'replace'))
+        elif kind == protocol.HISTORY:
+            if not self.remember_seq(room, seq):
+                return True
+            name_end = 1 + payload[0]
+            room_name = self.room_names.get(room, DEFAULT_ROOM)
+            line = f"[история #{seq}] {str(payload[1:name_end], 'utf-8', 'replace')}: " \
+                   f"{str(payload[name_end:], 'utf-8', 'replace')}"
+            print(line if room_name == DEFAULT_ROOM else f"[{room_name}] {line}")
+        elif kind == protocol.HISTORY_END:
+            if session:
+                # Порции запрашиваются по одной: следующая - после последнего полученного номера
+                self.request_history(room, seq)
+        elif kind == protocol.ROOM:
+            room_name = self.room_names[room] = str(payload, 'utf-8', 'replace')
+            # Вход в комнату (или повторная регистрация): догоняем пропущенные сообщения
+            self.request_history(room, self.room_seqs.get(room_name, 0))
+        elif kind == protocol.WELCOME:
+            if self.session_id and session != self.session_id:
+                print("Сессия на сервере истекла и создана заново; комнаты, кроме общей, откройте снова (/join)")
+            self.session_id = session
+        elif kind == protocol.SHUTDOWN:
+            print(str(payload, 'utf-8', 'replace'))
+            return False
+        return True
+
+    def print_message(self, session, room, text):
+        room_name = self.room_names.get(room, DEFAULT_ROOM)
+        if room_name == DEFAULT_ROOM:
+            print(f"{self.names[session]}: {text}")
+        else:
+            print(f"[{room_name}] {self.names[session]}: {text}")
+
+    def process_datagram(self, data):
+        """Обработка датаграммы от сервера; False - сервер закрывается"""
+        if data == HEARTBEAT_ACK:
+            return True
+        if not self.text_protocol and protocol.is_frame(data):
+            if self.channel is not None and data[1] in (protocol.DATA, protocol.ACK):
+                try:
+                    kind, _, _, seq, payload = protocol.parse_frame(data)
+                except protocol.FrameError:
+                    return True
+                with self.channel_lock:
+                    frames = self.channel.receive(kind, seq, payload, (self.server_address, self.server_port),
+                                                  time.monotonic())
+                return all(self.handle_frame(frame) for frame in frames)
+            return self.handle_frame(data)
+
+        message = data.decode()
+        print(message)
+        return message != "Сервер закрывается. Соединение будет прервано."
+
+    def service_channel(self):
+        """Повторы и подтверждения надежной доставки; False - сервер перестал подтверждать"""
+        with self.channel_lock:
+            now = time.monotonic()
+            failed = self.channel.expire(now)
+            self.channel.flush(now)
+            timeout = self.channel.next_timeout(now)
+        # Пока есть неподтвержденные датаграммы, просыпаемся к шагу колеса повторов; иначе - не реже
+        # RELIABLE_POLL_INTERVAL, чтобы вовремя заметить таймер, запущенный потоком ввода
+        self.socket.settimeout(RELIABLE_POLL_INTERVAL if timeout is None
+                               else max(0.001, min(timeout, RELIABLE_POLL_INTERVAL)))
+        return not failed
+
     def listen_for_messages(self):
-        consecutive_timeouts = 0
-        max_timeouts = 5  # Максимальное количество таймаутов подряд
+        missed_heartbeats = 0  # Heartbeat, отправленные после последнего ответа сервера
 
         while not self.exit_event.is_set():
+            if self.channel is not None and not self.service_channel():
+                print("\nСервер не подтверждает доставку. Возможно, сервер недоступен.")
+                self.exit_event.set()
+                break
             try:
-                data, _ = self.socket.recvfrom(1024)
-                message = data.decode()
-                print(message)
-
-                # Если сервер сообщает о закрытии, отключаемся
-                if message == "Сервер закрывается. Соединение будет прервано.":
+                data, address = self.socket.recvfrom(MAX_DATAGRAM_SIZE)
+                # Любая датаграмма от сервера подтверждает, что сессия жива
+                missed_heartbeats = 0
+                datagrams = [(data, address)] if self.simulator is None else self.simulator(data, address)
+                if not all(self.process_datagram(datagram) for datagram, _ in datagrams):
+                    # Сервер сообщил о закрытии, отключаемся
                     print("\nСервер закрылся. Отключение...")
                     self.exit_event.set()
                     break
 
-                # Сбрасываем счетчик таймаутов при успешном получении сообщения
-                consecutive_timeouts = 0
-
             except socket.timeout:
-                # Увеличиваем счетчик таймаутов
-                consecutive_timeouts += 1
-
-                # Если слишком много таймаутов подряд, проверяем соединение с сервером
-                if consecutive_timeouts >= max_timeouts:
+                # Если клиент давно ничего не отправлял, сообщаем серверу, что он жив
+                if time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+                    if missed_heartbeats >= MAX_MISSED_HEARTBEATS:
+                        if not self.exit_event.is_set():
+                            print("\nСервер не отвечает. Возможно, сервер недоступен.")
+                            self.exit_event.set()
+                        break
                     try:
-                        # Отправляем проверочное сообщение
-                        self.socket.sendto(b'ping', (self.server_address, self.server_port))
-                        consecutive_timeouts = 0
+                        self.send_heartbeat(reregister=missed_heartbeats > 0)
+                        missed_heartbeats += 1
                     except socket.error:
                         if not self.exit_event.is_set():
                             print("\nПотеряно соединение с сервером. Возможно, сервер недоступен.")
@@ -153,10 +338,8 @@ class ChatClient:
         listener_thread = Thread(target=self.listen_for_messages, daemon=True)
         listener_thread.start()
 
-        # Отправляем регистрационное сообщение с добавлением IP клиента
         try:
-            self.socket.sendto(f"reg:{self.username}:{self.client_ip}".encode(),
-                               (self.server_address, self.server_port))
+            self.send_register()
         except socket.error as e:
             print(f"Ошибка при регистрации: {e}")
             print("Сервер недоступен. Попробуйте позже.")
@@ -165,15 +348,22 @@ class ChatClient:
 
         try:
             while not self.exit_event.is_set():
-                message = input()
+                try:
+                    message = input()
+                except EOFError:
+                    break  # Конец сценария (ввод из файла или канала)
                 if not message:
                     continue
+                if message.startswith("!sleep "):
+                    # Пауза в сценарии: "!sleep 0.5"
+                    time.sleep(float(message[7:]))
+                    continue
                 if message.lower() == 'exit':
-                    self.socket.sendto(b'exit', (self.server_address, self.server_port))
+                    self.send_exit()
                     break
 
                 try:
-                    self.socket.sendto(message.encode(), (self.server_address, self.server_port))
+                    self.send_message(message)
                 except socket.error as e:
                     print(f"\nОшибка при отправке сообщения: {e}")
                     print("Сервер может быть недоступен.")
@@ -186,8 +376,36 @@ class ChatClient:
             self.disconnect()
 
 
+def parse_options(args):
+    """--name=, --server=IP:порт, --bind=IP, --port= из командной строки; --headless - без вопросов вообще"""
+    options = dict(arg[2:].split("=", 1) for arg in args
+                   if arg.startswith(("--name=", "--server=", "--bind=", "--port=")))
+    settings = {"username": options.get("name"), "client_ip": options.get("bind")}
+    if "server" in options:
+        host, _, port = options["server"].rpartition(":")
+        settings["server_address"] = host or '127.0.0.1'
+        settings["server_port"] = int(port)
+    if "port" in options:
+        settings["client_port"] = int(options["port"])
+    if "--headless" in args:
+        # Все, что не указано, берется по умолчанию: локальный адрес, порт клиента выбирает система
+        if "server_port" not in settings:
+            sys.exit("В режиме --headless нужен адрес сервера: --server=IP:порт")
+        settings["username"] = settings["username"] or f"bot-{os.getpid()}"
+        settings["client_ip"] = settings["client_ip"] or '127.0.0.1'
+        settings.setdefault("client_port", 0)
+        # Вывод читает другая программа: строки не должны задерживаться в буфере
+        sys.stdout.reconfigure(line_buffering=True)
+    return settings
+
+
 if __name__ == "__main__":
-    client = ChatClient()
+    # --text: текстовый протокол для совместимости со старыми серверами;
+    # --reliable: надежная доставка; --loss=0.1 --reorder=0.05: имитация ненадежной сети на приеме.
+    # Без интерактивного ввода: --headless --server=127.0.0.1:9000 [--name=bot] [--bind=IP] [--port=N];
+    # сообщения и команды читаются построчно из stdin ("!sleep 0.5" - пауза), конец ввода - выход
+    client = ChatClient(text_protocol="--text" in sys.argv[1:], reliable="--reliable" in sys.argv[1:],
+                        simulator=LossSimulator.from_args(sys.argv[1:]), **parse_options(sys.argv[1:]))
     try:
         client.run()
     except Exception as e:
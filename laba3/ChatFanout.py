@@ -0,0 +1,318 @@
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+
+SENDER_WORKERS = 2  # Потоков отправки; получатель всегда обслуживается одним потоком, порядок сохраняется
+RECIPIENT_QUEUE_LIMIT = 256  # Сообщений в очереди одного получателя; при переполнении отбрасываются старые
+SEND_BATCH = 64  # Датаграмм за один вызов sendmmsg
+LATENCY_SAMPLES = 8192  # Последних замеров задержки рассылки для перцентилей
+SEND_WAIT_TIMEOUT = 1.0  # Сколько ждать освобождения буфера отправки сокета, с
+
+
+# Отправка пачки датаграмм системным вызовом sendmmsg (Linux) через ctypes.
+# Структуры mmsghdr собираются в заранее выделенном буфере, адреса получателей кэшируются
+class MmsgSender:
+    MMSGHDR = struct.Struct('@PIPNPNi4xI4x')  # struct mmsghdr: msghdr + msg_len
+    IOVEC = struct.Struct('@PN')
+
+    def __init__(self, sock, batch=SEND_BATCH):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.sendmmsg = libc.sendmmsg
+        self.sendmmsg.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int)
+        self.sock = sock
+        self.headers = (ctypes.c_char * (self.MMSGHDR.size * batch))()
+        self.vectors = (ctypes.c_char * (self.IOVEC.size * batch))()
+        self.headers_address = ctypes.addressof(self.headers)
+        self.vectors_address = ctypes.addressof(self.vectors)
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    @staticmethod
+    def pack_address(address):
+        """Готовая sockaddr для получателя (буфер, его адрес, длина); хранится в Recipient"""
+        host, port = address[0], address[1]
+        if ':' in host:
+            packed = struct.pack('=H', socket.AF_INET6) + struct.pack('!HI', port, 0) + \
+                socket.inet_pton(socket.AF_INET6, host) + struct.pack('=I', 0)
+        else:
+            packed = struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) + \
+                socket.inet_aton(host) + bytes(8)
+        buffer = ctypes.create_string_buffer(packed, len(packed))
+        return buffer, ctypes.addressof(buffer), len(packed)
+
+    def send(self, items):
+        """Отправляет пачку (получатель, датаграмма); возвращает число отправленных или бросает OSError"""
+        # Одна и та же датаграмма обычно идет многим получателям: iovec для нее один на всю пачку
+        vectors = {}
+        pack_header = self.MMSGHDR.pack_into
+        headers = self.headers
+        header_size = self.MMSGHDR.size
+        for i, (recipient, payload) in enumerate(items):
+            vector = vectors.get(id(payload))
+            if vector is None:
+                vector = self.vectors_address + len(vectors) * self.IOVEC.size
+                self.IOVEC.pack_into(self.vectors, len(vectors) * self.IOVEC.size,
+                                     ctypes.cast(ctypes.c_char_p(payload), ctypes.c_void_p).value, len(payload))
+                vectors[id(payload)] = vector
+            _, sockaddr, sockaddr_size = recipient.sockaddr
+            pack_header(headers, i * header_size, sockaddr, sockaddr_size, vector, 1, 0, 0, 0, 0)
+        sent = self.sendmmsg(self.sock.fileno(), self.headers_address, len(items), 0)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, errno.errorcode.get(error, str(error)))
+        return sent
+
+
+# Запасной вариант для систем без sendmmsg: по одному sendto на датаграмму
+class SendtoSender:
+    def __init__(self, sock, batch=SEND_BATCH):
+        self.sock = sock
+
+    @staticmethod
+    def pack_address(address):
+        return None
+
+    def send(self, items):
+        sent = 0
+        for recipient, payload in items:
+            try:
+                self.sock.sendto(payload, recipient.address)
+            except OSError:
+                if sent:
+                    return sent
+                raise
+            sent += 1
+        return sent
+
+
+class Recipient:
+    __slots__ = ('address', 'sockaddr', 'queue', 'worker', 'scheduled')
+
+    def __init__(self, address, sockaddr, worker):
+        self.address = address
+        self.sockaddr = sockaddr
+        self.queue = deque()  # (датаграмма, время постановки в очередь)
+        self.worker = worker  # Номер потока отправки, за которым закреплен получатель
+        self.scheduled = False  # Получатель стоит в очереди готовых своего потока отправки
+
+
+class SenderWorker:
+    def __init__(self, fanout, sender):
+        self.fanout = fanout
+        self.sender = sender
+        self.lock = threading.Lock()
+        self.ready = deque()  # Получатели с непустой очередью
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        items, stamps = [], []
+        while True:
+            with self.lock:
+                while not self.ready and self.fanout.running:
+                    self.wakeup.wait()
+                if not self.ready:
+                    return
+                # Набираем пачку: понемногу от каждого готового получателя, чтобы никто не ждал долго
+                while self.ready and len(items) < SEND_BATCH:
+                    recipient = self.ready.popleft()
+                    queue = recipient.queue
+                    for _ in range(min(len(queue), max(1, SEND_BATCH - len(items)))):
+                        payload, stamp = queue.popleft()
+                        items.append((recipient, payload))
+                        stamps.append(stamp)
+                    if queue:
+                        self.ready.append(recipient)
+                    else:
+                        recipient.scheduled = False
+            self.send_batch(items, stamps)
+            items.clear()
+            stamps.clear()
+
+    def send_batch(self, items, stamps):
+        position = 0
+        failed = 0
+        while position < len(items):
+            try:
+                position += self.sender.send(items[position:])
+            except BlockingIOError:
+                # Буфер отправки сокета полон: ждем освобождения, не занимая процессор
+                select.select([], [self.fanout.sock], [], SEND_WAIT_TIMEOUT)
+            except OSError:
+                # Ошибка относится к первой неотправленной датаграмме: получатель недоступен
+                self.fanout.report_failure(items[position][0].address)
+                position += 1
+                failed += 1
+        self.fanout.record_sent(len(items) - failed, stamps)
+
+
+# Рассылка сообщений чата. Цикл приема только ставит задание в очередь (O(1)) и сразу
+# возвращается к приему; поток-распределитель раскладывает датаграмму по очередям
+# получателей, а потоки отправки отправляют их пачками через sendmmsg там, где он есть.
+# Каждый получатель закреплен за одним потоком отправки, поэтому порядок его сообщений сохраняется.
+# Очередь получателя ограничена: медленный или недоступный получатель теряет старые
+# сообщения, но не задерживает остальных
+class FanOut:
+    def __init__(self, sock, workers=SENDER_WORKERS, queue_limit=RECIPIENT_QUEUE_LIMIT):
+        self.sock = sock
+        self.queue_limit = queue_limit
+        self.running = True
+        self.jobs = deque()
+        self.jobs_ready = threading.Condition()
+        self.recipients = {}  # адрес -> Recipient; изменяется только потоком-распределителем
+        self.failures = deque()  # Адреса, отправка на которые завершилась ошибкой
+        self.idle = threading.Event()  # Все задания распределены, очереди пусты
+        self.idle.set()
+
+        sender_class = MmsgSender if MmsgSender.available() else SendtoSender
+        self.pack_address = sender_class.pack_address
+        self.workers = [SenderWorker(self, sender_class(sock)) for _ in range(max(1, workers))]
+
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latencies = array('d', bytes(8 * LATENCY_SAMPLES))
+        self.latency_count = 0
+
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+
+    def start(self):
+        self.dispatcher.start()
+        for worker in self.workers:
+            worker.thread.start()
+
+    def submit(self, payload, recipients, exclude=None):
+        """Рассылка уже закодированной датаграммы; recipients - снимок адресов получателей"""
+        with self.jobs_ready:
+            self.idle.clear()
+            self.jobs.append((payload, recipients, exclude, time.perf_counter()))
+            self.jobs_ready.notify()
+
+    def submit_each(self, items):
+        """Рассылка разных датаграмм разным получателям: список (адрес, датаграмма)"""
+        stamp = time.perf_counter()
+        with self.jobs_ready:
+            self.idle.clear()
+            for address, payload in items:
+                self.jobs.append((payload, (address,), None, stamp))
+            self.jobs_ready.notify()
+
+    def discard(self, address):
+        """Удаление получателя; выполняется распределителем после уже поставленных заданий"""
+        with self.jobs_ready:
+            self.jobs.append((None, address, None, None))
+            self.jobs_ready.notify()
+
+    def dispatch(self):
+        while True:
+            with self.jobs_ready:
+                while not self.jobs and self.running:
+                    self.jobs_ready.wait()
+                if not self.jobs:
+                    return
+                payload, recipients, exclude, stamp = self.jobs.popleft()
+                if not self.jobs:
+                    self.idle.set()
+
+            if payload is None:
+                self.recipients.pop(recipients, None)
+                continue
+            self.distribute(payload, recipients, exclude, stamp)
+
+    def distribute(self, payload, recipients, exclude, stamp):
+        # Раскладываем датаграмму по потокам отправки, захватывая блокировку каждого один раз
+        workers = self.workers
+        groups = [[] for _ in workers]
+        for address in recipients:
+            if address == exclude:
+                continue
+            recipient = self.recipients.get(address)
+            if recipient is None:
+                recipient = self.recipients[address] = Recipient(address, self.pack_address(address),
+                                                                 hash(address) % len(workers))
+            groups[recipient.worker].append(recipient)
+
+        item = (payload, stamp)
+        dropped = 0
+        submitted = 0
+        limit = self.queue_limit
+        for worker, group in zip(workers, groups):
+            if not group:
+                continue
+            with worker.lock:
+                for recipient in group:
+                    queue = recipient.queue
+                    if len(queue) >= limit:
+                        queue.popleft()
+                        dropped += 1
+                    queue.append(item)
+                    if not recipient.scheduled:
+                        recipient.scheduled = True
+                        worker.ready.append(recipient)
+                worker.wakeup.notify()
+            submitted += len(group)
+        with self.stats_lock:
+            self.submitted += submitted
+            self.dropped += dropped
+
+    def report_failure(self, address):
+        with self.stats_lock:
+            self.errors += 1
+        self.failures.append(address)
+
+    def record_sent(self, count, stamps):
+        now = time.perf_counter()
+        with self.stats_lock:
+            self.sent += count
+            latencies = self.latencies
+            index = self.latency_count
+            for stamp in stamps:
+                latencies[index % LATENCY_SAMPLES] = now - stamp
+                index += 1
+            self.latency_count = index
+
+    def flush(self, timeout=2.0):
+        """Ожидание отправки всего поставленного в очередь (например, перед завершением)"""
+        deadline = time.monotonic() + timeout
+        self.idle.wait(timeout)
+        while time.monotonic() < deadline:
+            with self.stats_lock:
+                if self.sent + self.dropped + self.errors >= self.submitted and self.idle.is_set():
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def close(self):
+        self.running = False
+        with self.jobs_ready:
+            self.jobs_ready.notify_all()
+        for worker in self.workers:
+            with worker.lock:
+                worker.wakeup.notify_all()
+
+    def stats(self):
+        with self.stats_lock:
+            count = min(self.latency_count, LATENCY_SAMPLES)
+            samples = sorted(self.latencies[:count])
+            return {
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "batching": "sendmmsg" if isinstance(self.workers[0].sender, MmsgSender) else "sendto",
+                "latency_p50_ms": samples[count // 2] * 1000 if count else 0.0,
+                "latency_p99_ms": samples[min(count - 1, count * 99 // 100)] * 1000 if count else 0.0,
+                "latency_max_ms": samples[-1] * 1000 if count else 0.0,
+            }
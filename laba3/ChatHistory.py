@@ -0,0 +1,299 @@
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+import ChatProtocol as protocol
+from ChatProtocol import HEADER, MAX_PAYLOAD, VERSION
+
+HISTORY_DIR = "chat_history"  # Каталог журнала истории
+HISTORY_MESSAGES = 256  # Сообщений в кольцевом буфере комнаты
+HISTORY_BYTES = 256 * 1024  # Байт в кольцевом буфере комнаты
+HISTORY_ROOMS = 1024  # Комнат, чья история держится в памяти; остальные читаются из журнала
+SEGMENT_SIZE = 4 * 1024 * 1024  # Размер сегмента журнала, после которого начинается новый
+MAX_SEGMENTS = 16  # Сегментов на диске; самые старые удаляются
+CATCHUP_BATCH = 64  # Сообщений в одной порции догоняющей выдачи
+CATCHUP_ON_JOIN = 20  # Сколько последних сообщений получает клиент без известного номера
+
+# Запись журнала: crc32 и длина тела; тело - длина имени комнаты (1 байт), имя комнаты, запись истории
+LOG_HEADER = struct.Struct('!II')
+# Запись истории - готовый кадр HISTORY (номер комнаты в заголовке 0, подставляется при выдаче):
+# сессия - отправитель, номер - порядковый номер сообщения в комнате,
+# нагрузка - длина имени (1 байт), имя отправителя, текст
+NAME_LENGTH = struct.Struct('!B')
+
+
+def pack_record(session, seq, name, text):
+    name = name[:255]
+    payload = NAME_LENGTH.pack(len(name)) + name + text[:MAX_PAYLOAD - 1 - len(name)]
+    return HEADER.pack(VERSION, protocol.HISTORY, 0, session, seq, len(payload)) + payload
+
+
+def unpack_record(record):
+    """(сессия, номер, имя, текст) из записи истории или кадра HISTORY"""
+    _, _, _, session, seq, _ = HEADER.unpack_from(record)
+    name_length = record[HEADER.size]
+    name_end = HEADER.size + 1 + name_length
+    return session, seq, bytes(record[HEADER.size + 1:name_end]), bytes(record[name_end:])
+
+
+# Кольцевой буфер последних сообщений комнаты. Записи лежат подряд в одном bytearray
+# (растет по мере надобности до max_bytes), их смещения и длины - в массивах array,
+# поэтому накладные расходы - 8 байт на сообщение, а не объект на каждое.
+# При нехватке места или слотов вытесняются самые старые записи
+class RoomHistory:
+    __slots__ = ('max_bytes', 'data', 'offsets', 'lengths', 'head', 'count', 'write', 'first_seq', 'next_seq')
+
+    def __init__(self, max_messages=HISTORY_MESSAGES, max_bytes=HISTORY_BYTES):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+        self.offsets = array('I', bytes(4 * max_messages))
+        self.lengths = array('I', bytes(4 * max_messages))
+        self.head = 0  # Слот самой старой записи
+        self.count = 0
+        self.write = 0  # Смещение для следующей записи
+        self.first_seq = 1  # Номер самой старой записи в буфере
+        self.next_seq = 1  # Номер, который получит следующее сообщение
+
+    def append(self, record, seq):
+        size = len(record)
+        if size > self.max_bytes:
+            raise ValueError("запись больше буфера истории")
+        capacity = len(self.offsets)
+        if self.count == capacity:
+            self.evict()
+
+        position = self.write
+        wrapped = position + size > self.max_bytes
+        if wrapped:
+            position = 0
+        # Порядок в памяти (по кругу) совпадает с возрастом: сначала вытесняем записи за точкой
+        # заворота (они старше всех), затем самые старые, пересекающиеся с местом новой записи
+        while self.count:
+            offset = self.offsets[self.head]
+            if (wrapped and offset >= self.write) or \
+                    (offset < position + size and position < offset + self.lengths[self.head]):
+                self.evict()
+            else:
+                break
+        if not self.count:
+            position = 0
+
+        end = position + size
+        if end > len(self.data):
+            self.data.extend(bytes(end - len(self.data)))
+        self.data[position:end] = record
+        slot = (self.head + self.count) % capacity
+        self.offsets[slot] = position
+        self.lengths[slot] = size
+        self.count += 1
+        self.write = end
+        self.next_seq = seq + 1
+        self.first_seq = self.next_seq - self.count
+
+    def evict(self):
+        self.head = (self.head + 1) % len(self.offsets)
+        self.count -= 1
+
+    def since(self, seq, limit):
+        """Записи с номерами больше seq (не больше limit); копии, буфер может измениться"""
+        start = max(seq + 1, self.first_seq)
+        records = []
+        for current in range(start, min(self.next_seq, start + limit)):
+            slot = (self.head + current - self.first_seq) % len(self.offsets)
+            offset = self.offsets[slot]
+            records.append(bytes(self.data[offset:offset + self.lengths[slot]]))
+        return records
+
+
+# История сообщений всех комнат: кольцевые буферы в памяти и журнал из сегментов на диске.
+# Журнал только дописывается (пачкой за вызов flush), сегменты ротируются по размеру,
+# старые удаляются, поэтому и память, и диск ограничены. При запуске сегменты читаются
+# через mmap и восстанавливают буферы; недописанный хвост последнего сегмента отрезается.
+# Сообщения старше кольцевого буфера выдаются прямо из сегментов (тоже через mmap): индекс сегмента
+# хранит смещения записей каждой комнаты (4 байта на запись, журнал на диске ограничен - значит,
+# и индекс), поэтому порция читается прямо по смещениям, без просмотра сегмента с начала и без
+# повторной проверки crc (сегменты проверены при восстановлении или записаны нами)
+class HistoryStore:
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self.rooms = OrderedDict()  # комната -> RoomHistory, в порядке последнего использования
+        # [номер сегмента, путь, {комната: [первый номер, последний номер, смещения записей]}];
+        # номера записей комнаты в сегменте идут подряд, смещение записи seq - offsets[seq - first]
+        self.segments = []
+        self.pending = bytearray()
+        self.file = None
+        self.segment_size = 0
+        self.recovered = 0
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f"{number:08d}.log")
+
+    def recover(self):
+        started = time.perf_counter()
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                         if name.endswith(".log") and name[:-4].isdigit())
+        for number in numbers:
+            path = self.segment_path(number)
+            index = {}
+            valid = 0
+            size = os.path.getsize(path)
+            if size:
+                with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for room, record, end in self.scan(mapped):
+                        seq = HEADER.unpack_from(record)[4]
+                        self.ring(room).append(record, seq)
+                        self.index_record(index, room, seq, valid)
+                        valid = end
+                        self.recovered += 1
+            if valid < size:
+                # Обрыв записи при аварийном завершении: отрезаем неполный хвост
+                os.truncate(path, valid)
+            self.segments.append([number, path, index])
+        self.open_segment(numbers[-1] if numbers else 0)
+        self.recovery_time = time.perf_counter() - started
+
+    @staticmethod
+    def index_record(index, room, seq, offset):
+        """Учет записи комнаты в индексе сегмента; offset - смещение записи в сегменте"""
+        entry = index.get(room)
+        if entry is None:
+            index[room] = [seq, seq, array('I', [offset])]
+        else:
+            entry[1] = seq
+            entry[2].append(offset)
+
+    @staticmethod
+    def scan(mapped):
+        """Записи сегмента: (комната, запись истории, смещение конца записи); останавливается на битой"""
+        view = memoryview(mapped)
+        position = 0
+        try:
+            while position + LOG_HEADER.size <= len(view):
+                checksum, length = LOG_HEADER.unpack_from(view, position)
+                body_start = position + LOG_HEADER.size
+                body = view[body_start:body_start + length]
+                if len(body) < length or zlib.crc32(body) != checksum or not length:
+                    break
+                room_end = 1 + body[0]
+                room = str(body[1:room_end], 'utf-8')
+                position = body_start + length
+                yield room, bytes(body[room_end:]), position
+        finally:
+            view.release()
+
+    def open_segment(self, number):
+        if self.file is not None:
+            self.file.close()
+        path = self.segment_path(number)
+        self.file = open(path, "ab", buffering=0)
+        self.segment_size = self.file.tell()
+        if not self.segments or self.segments[-1][0] != number:
+            self.segments.append([number, path, {}])
+        # Ограничение на диске: удаляем самые старые сегменты
+        while len(self.segments) > MAX_SEGMENTS:
+            _, old_path, _ = self.segments.pop(0)
+            os.remove(old_path)
+
+    def ring(self, room):
+        history = self.rooms.get(room)
+        if history is None:
+            history = self.rooms[room] = RoomHistory()
+            history.first_seq = history.next_seq = self.log_next_seq(room)
+            if len(self.rooms) > HISTORY_ROOMS:
+                # Буфер давно неактивной комнаты освобождается; ее история (и следующий номер)
+                # остается в журнале
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        return history
+
+    def log_next_seq(self, room):
+        """Следующий номер комнаты по индексам сегментов; когда ее сегменты удалены, нумерация
+        начинается заново, поэтому память на комнаты ограничена тем же, чем и журнал"""
+        for _, _, index in reversed(self.segments):
+            entry = index.get(room)
+            if entry is not None:
+                return entry[1] + 1
+        return 1
+
+    def next_seq(self, room):
+        history = self.rooms.get(room)
+        return history.next_seq if history is not None else self.log_next_seq(room)
+
+    def append(self, room, session, name, text):
+        """Сохраняет сообщение; возвращает его номер в комнате"""
+        history = self.ring(room)
+        seq = history.next_seq
+        record = pack_record(session, seq, name, text)
+        history.append(record, seq)
+
+        room_name = room.encode()
+        body = NAME_LENGTH.pack(len(room_name)) + room_name + record
+        # Запись попадет в текущий сегмент: ротация - только в flush, после записи накопленного
+        self.index_record(self.segments[-1][2], room, seq, self.segment_size + len(self.pending))
+        self.pending += LOG_HEADER.pack(zlib.crc32(body), len(body))
+        self.pending += body
+        return seq
+
+    def flush(self):
+        """Дописывает накопленные записи в журнал одним системным вызовом"""
+        if not self.pending:
+            return
+        data = self.pending
+        self.pending = bytearray()
+        written = 0
+        while written < len(data):
+            written += os.write(self.file.fileno(), data[written:])
+        self.segment_size += written
+        if self.segment_size >= SEGMENT_SIZE:
+            self.open_segment(self.segments[-1][0] + 1)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def since(self, room, seq, limit=CATCHUP_BATCH):
+        """До limit записей комнаты с номерами больше seq; seq=0 - последние CATCHUP_ON_JOIN"""
+        next_seq = self.next_seq(room)
+        if seq <= 0:
+            seq = max(0, next_seq - 1 - CATCHUP_ON_JOIN)
+        history = self.rooms.get(room)
+        first_in_memory = history.first_seq if history is not None else next_seq
+        records = []
+        if seq + 1 < first_in_memory:
+            records = self.read_log(room, seq, min(limit, first_in_memory - seq - 1))
+            if records:
+                seq = HEADER.unpack_from(records[-1])[4]
+        if history is not None and len(records) < limit:
+            records += history.since(seq, limit - len(records))
+        return records
+
+    def read_log(self, room, seq, limit):
+        """Старые записи комнаты из сегментов журнала через mmap, прямо по смещениям из индекса"""
+        self.flush()
+        records = []
+        for _, path, index in self.segments:
+            entry = index.get(room)
+            if entry is None or entry[1] <= seq:
+                continue
+            first, last, offsets = entry
+            with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for current in range(max(seq + 1, first), last + 1):
+                    offset = offsets[current - first]
+                    _, length = LOG_HEADER.unpack_from(mapped, offset)
+                    body = mapped[offset + LOG_HEADER.size:offset + LOG_HEADER.size + length]
+                    record = body[1 + body[0]:]
+                    if HEADER.unpack_from(record)[4] != current:
+                        break  # Индекс не сходится с сегментом: лучше выдать меньше, чем чужое
+                    records.append(record)
+                    if len(records) >= limit:
+                        return records
+        return records
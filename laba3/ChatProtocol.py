@@ -0,0 +1,70 @@
+import struct
+
+# Служебные датаграммы текстового протокола. Начинаются с нулевого байта, который нельзя ввести
+# с клавиатуры, поэтому их невозможно спутать с обычным сообщением пользователя
+HEARTBEAT = b"\x00hb"  # Клиент жив; сервер не рассылает его, а отвечает HEARTBEAT_ACK
+HEARTBEAT_ACK = b"\x00hb-ack"  # Ответ сервера: сессия клиента активна
+
+HEARTBEAT_INTERVAL = 10.0  # Клиент шлет heartbeat, если ничего не отправлял столько секунд
+MAX_MISSED_HEARTBEATS = 3  # Сколько heartbeat подряд без ответа до признания сервера недоступным
+SESSION_TIMEOUT = 35.0  # Сервер удаляет клиента, от которого ничего не было столько секунд
+
+# Двоичный протокол. Каждая датаграмма - кадр с заголовком фиксированной длины:
+#   версия (1 байт) | тип (1) | номер комнаты (2) | сессия (4) | порядковый номер (4) | длина (2)
+# и полезная нагрузка указанной длины. Байт версии 0xF1 не встречается в начале текста UTF-8,
+# поэтому сервер отличает кадр от сообщения текстового протокола по первому байту.
+# Отправитель в кадре - номер сессии, выданный сервером при регистрации (имена передаются
+# один раз по запросу WHOIS), поэтому сервер пересылает текст сообщения, не декодируя его
+VERSION = 0xF1
+HEADER = struct.Struct('!BBHIIH')
+# Начало заголовка (версия, тип, комната): его меняет сервер при выдаче записей истории
+ROUTE = struct.Struct('!BBH')
+MAX_PAYLOAD = 65535 - HEADER.size
+
+# Клиент -> сервер
+REGISTER = 1  # нагрузка: имя
+MESSAGE = 2  # нагрузка: текст для текущей комнаты; номер - счетчик сообщений клиента
+COMMAND = 3  # нагрузка: команда комнат (/join, /leave, /rooms)
+WHOIS = 4  # сессия: чье имя нужно
+PING = 5  # heartbeat
+EXIT = 6
+HISTORY_REQUEST = 7  # комната: чья история, номер: последний известный клиенту (0 - последние сообщения)
+
+# Сервер -> клиент
+WELCOME = 16  # сессия: выданный номер
+DELIVER = 17  # сессия - отправителя, номер - порядковый номер в комнате, комната - куда, нагрузка - текст как есть
+NOTICE = 18  # нагрузка: служебное сообщение сервера
+ROOM = 19  # комната: номер, нагрузка: имя комнаты
+NAME = 20  # сессия: номер, нагрузка: имя
+PONG = 21
+SHUTDOWN = 22  # нагрузка: текст уведомления
+HISTORY = 23  # сообщение из истории: как DELIVER, нагрузка - длина имени (1 байт), имя отправителя, текст
+HISTORY_END = 24  # конец порции истории: номер - последний выданный, сессия - 1, если есть еще
+
+# Надежная доставка (ChatReliable), в обе стороны
+DATA = 32  # номер - порядковый номер датаграммы у отправителя, нагрузка - кадры с 2-байтовой длиной
+ACK = 33  # номер - все датаграммы до него получены, нагрузка - диапазоны полученных сверх того (SACK)
+
+
+class FrameError(ValueError):
+    pass
+
+
+def pack_frame(kind, payload=b'', session=0, seq=0, room=0):
+    return HEADER.pack(VERSION, kind, room, session, seq, len(payload)) + payload
+
+
+def is_frame(data):
+    return len(data) >= HEADER.size and data[0] == VERSION
+
+
+def parse_frame(data):
+    """Разбор кадра: (тип, комната, сессия, номер, нагрузка); нагрузка - срез без копирования"""
+    if len(data) < HEADER.size:
+        raise FrameError("короткий кадр")
+    version, kind, room, session, seq, length = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise FrameError(f"неизвестная версия протокола {version:#x}")
+    if HEADER.size + length != len(data):
+        raise FrameError("длина нагрузки не совпадает с заголовком")
+    return kind, room, session, seq, data[HEADER.size:]
@@ -0,0 +1,352 @@
+import random
+import struct
+import time
+from collections import deque
+
+import ChatProtocol as protocol
+from ChatProtocol import HEADER, pack_frame
+from ChatTimers import TimerWheel
+
+PATH_MTU = 1400  # Размер датаграммы, до которого склеиваются мелкие кадры (Ethernet за вычетом IP/UDP)
+WINDOW = 64  # Датаграмм в полете на одного получателя
+RECV_WINDOW = 256  # Насколько далеко вперед принимаются датаграммы вне порядка
+MAX_PENDING = 4096  # Кадров в очереди получателя, ожидающих окна; сверх этого отбрасываются старые
+INITIAL_RTO = 0.3  # Тайм-аут повтора до первого замера RTT, с
+MIN_RTO = 0.02
+MAX_RTO = 5.0
+MAX_RETRANSMITS = 10  # Повторов одной датаграммы до признания получателя недоступным
+DUPLICATE_THRESHOLD = 3  # Сколько более поздних датаграмм должно быть подтверждено до быстрого повтора
+ACK_BLOCKS = 4  # Диапазонов SACK в одном ACK
+RETRANSMIT_TICK = 0.01  # Шаг колеса таймеров повтора, с
+
+LENGTH = struct.Struct('!H')
+BLOCK = struct.Struct('!II')
+
+
+# Имитация ненадежной сети для проверки на localhost: теряет и переставляет датаграммы.
+# Подключается на приеме: fn(датаграмма, адрес) -> список датаграмм, которые нужно обработать сейчас
+class LossSimulator:
+    def __init__(self, loss=0.0, reorder=0.0, seed=None):
+        self.loss = loss
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.held = None  # Задержанная датаграмма; будет обработана после следующей
+        self.dropped = 0
+        self.reordered = 0
+
+    def __call__(self, datagram, address):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return []
+        if self.held is None and self.random.random() < self.reorder:
+            # Копия нужна: датаграмма может лежать в буфере приема, который будет перезаписан
+            self.held = (bytes(datagram), address)
+            self.reordered += 1
+            return []
+        delivered = [(datagram, address)]
+        if self.held is not None:
+            delivered.append(self.held)
+            self.held = None
+        return delivered
+
+    @staticmethod
+    def from_args(args):
+        """--loss=0.1 --reorder=0.05 [--seed=1] из командной строки; None, если имитация не нужна"""
+        options = dict(arg[2:].split("=", 1) for arg in args if arg.startswith(("--loss=", "--reorder=", "--seed=")))
+        if not options:
+            return None
+        return LossSimulator(float(options.get("loss", 0)), float(options.get("reorder", 0)),
+                             int(options["seed"]) if "seed" in options else None)
+
+
+class Outstanding:
+    __slots__ = ('datagram', 'sent_at', 'retransmits', 'fast', 'size')
+
+    def __init__(self, datagram, sent_at, size):
+        self.datagram = datagram
+        self.sent_at = sent_at
+        self.retransmits = 0
+        self.fast = False  # Уже повторена как потерянная по SACK; следующий повтор - только по тайм-ауту
+        self.size = size  # Байт полезных кадров
+
+
+class Peer:
+    __slots__ = ('address', 'next_seq', 'unacked', 'pending', 'srtt', 'rttvar', 'rto',
+                 'expected', 'out_of_order', 'ack_due')
+
+    def __init__(self, address):
+        self.address = address
+        # Отправка
+        self.next_seq = 1
+        self.unacked = {}  # номер -> Outstanding, в порядке отправки
+        self.pending = deque()  # Кадры, ждущие места в окне
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        # Прием
+        self.expected = 1  # Следующий номер, который можно доставить по порядку
+        self.out_of_order = {}  # номер -> нагрузка датаграммы, пришедшей раньше предыдущих
+        self.ack_due = False
+
+
+# Надежная упорядоченная доставка поверх UDP: у каждой пары отправитель-получатель
+# свои порядковые номера датаграмм, накопительные и выборочные (SACK) подтверждения,
+# скользящее окно и тайм-аут повтора по измеренному RTT (RFC 6298, алгоритм Карна).
+# Мелкие кадры склеиваются в одну датаграмму до PATH_MTU; подтверждения тоже копятся
+# и уходят одним ACK на получателя за вызов flush(). Объект не потокобезопасен:
+# сервер вызывает его из цикла событий, клиент - под собственной блокировкой.
+# transmit(список (адрес, датаграмма)) отправляет подготовленные датаграммы
+class ReliableChannel:
+    def __init__(self, transmit, now=None):
+        now = time.monotonic() if now is None else now
+        self.transmit = transmit
+        self.peers = {}  # адрес -> Peer
+        self.dirty = set()  # Получатели, у которых есть что отправить или подтвердить
+        self.timers = TimerWheel(now, tick=RETRANSMIT_TICK)  # Тайм-ауты повтора, ключ - адрес
+        self.started = now
+
+        self.datagrams_sent = 0
+        self.frames_sent = 0
+        self.retransmissions = 0
+        self.fast_retransmissions = 0
+        self.acks_sent = 0
+        self.acked_bytes = 0
+        self.delivered_frames = 0
+        self.delivered_bytes = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.overflow = 0
+
+    def peer(self, address):
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = Peer(address)
+        return peer
+
+    def remove(self, address):
+        peer = self.peers.pop(address, None)
+        if peer is not None:
+            self.dirty.discard(peer)
+            self.timers.cancel(address)
+
+    def queue(self, address, frame):
+        """Ставит кадр в очередь надежной отправки; уйдет при ближайшем flush()"""
+        peer = self.peer(address)
+        if len(peer.pending) >= MAX_PENDING:
+            peer.pending.popleft()
+            self.overflow += 1
+        peer.pending.append(frame)
+        self.dirty.add(peer)
+
+    def receive(self, kind, seq, payload, address, now):
+        """Обработка DATA или ACK; возвращает кадры, которые теперь можно доставить по порядку"""
+        peer = self.peer(address)
+        if kind == protocol.ACK:
+            self.on_ack(peer, seq, payload, now)
+            return []
+
+        peer.ack_due = True
+        self.dirty.add(peer)
+        if seq < peer.expected or seq in peer.out_of_order:
+            self.duplicates += 1  # Повтор уже полученной датаграммы: наш ACK потерялся
+            return []
+        if seq >= peer.expected + RECV_WINDOW:
+            return []
+        if seq > peer.expected:
+            peer.out_of_order[seq] = bytes(payload)
+            self.out_of_order += 1
+            return []
+
+        delivered = self.split(payload)
+        peer.expected += 1
+        while peer.expected in peer.out_of_order:
+            delivered.extend(self.split(peer.out_of_order.pop(peer.expected)))
+            peer.expected += 1
+        self.delivered_frames += len(delivered)
+        self.delivered_bytes += sum(len(frame) for frame in delivered)
+        return delivered
+
+    @staticmethod
+    def split(payload):
+        frames = []
+        position = 0
+        while position + LENGTH.size <= len(payload):
+            size, = LENGTH.unpack_from(payload, position)
+            position += LENGTH.size
+            frames.append(payload[position:position + size])
+            position += size
+        return frames
+
+    def on_ack(self, peer, cumulative, payload, now):
+        unacked = peer.unacked
+        newly_acked = []
+        # Накопительное подтверждение: номера в unacked идут по возрастанию
+        for seq in list(unacked):
+            if seq > cumulative:
+                break
+            newly_acked.append((seq, unacked.pop(seq)))
+
+        highest = 0
+        for position in range(0, len(payload) - BLOCK.size + 1, BLOCK.size):
+            first, last = BLOCK.unpack_from(payload, position)
+            highest = max(highest, last)
+            for seq in [seq for seq in unacked if first <= seq <= last]:
+                newly_acked.append((seq, unacked.pop(seq)))
+
+        acked = sum(entry.size for _, entry in newly_acked)
+        # RTT меряется по самой поздней подтвержденной датаграмме: ACK вызван ею, а не ожиданием
+        # потерянного ACK. Если подтверждение покрывает повтор, замер неоднозначен (алгоритм Карна)
+        sample = None
+        if newly_acked and not any(entry.retransmits for _, entry in newly_acked):
+            sample = now - max(newly_acked, key=lambda item: item[0])[1].sent_at
+
+        # Быстрый повтор (как в RFC 6675): датаграмма считается потерянной, если подтверждено
+        # не меньше DUPLICATE_THRESHOLD более поздних
+        retransmit = []
+        below = [seq for seq in unacked if seq < highest]
+        for index, seq in enumerate(below):
+            acknowledged_above = (highest - seq) - (len(below) - index - 1)
+            entry = unacked[seq]
+            if acknowledged_above >= DUPLICATE_THRESHOLD and not entry.fast:
+                entry.fast = True
+                entry.retransmits += 1
+                entry.sent_at = now
+                retransmit.append((peer.address, entry.datagram))
+        if retransmit:
+            self.retransmissions += len(retransmit)
+            self.fast_retransmissions += len(retransmit)
+            self.transmit(retransmit)
+
+        if sample is not None:
+            self.update_rtt(peer, sample)
+        elif newly_acked and peer.srtt is not None:
+            # Новые данные подтверждены - связь есть: отменяем экспоненциальную отсрочку
+            peer.rto = self.base_rto(peer)
+        if acked:
+            self.acked_bytes += acked
+            # Подтверждение новых данных перезапускает таймер повтора (RFC 6298, 5.3)
+            if unacked:
+                self.timers.schedule(peer.address, peer.rto, now)
+            else:
+                self.timers.cancel(peer.address)
+        if peer.pending:
+            self.dirty.add(peer)  # Окно освободилось
+
+    @staticmethod
+    def update_rtt(peer, sample):
+        if peer.srtt is None:
+            peer.srtt = sample
+            peer.rttvar = sample / 2
+        else:
+            peer.rttvar = 0.75 * peer.rttvar + 0.25 * abs(peer.srtt - sample)
+            peer.srtt = 0.875 * peer.srtt + 0.125 * sample
+        peer.rto = ReliableChannel.base_rto(peer)
+
+    @staticmethod
+    def base_rto(peer):
+        return min(MAX_RTO, max(MIN_RTO, peer.srtt + max(RETRANSMIT_TICK, 4 * peer.rttvar)))
+
+    def flush(self, now):
+        """Отправляет накопленные ACK и склеенные датаграммы в пределах окна"""
+        if not self.dirty:
+            return
+        batch = []
+        for peer in self.dirty:
+            if peer.ack_due:
+                peer.ack_due = False
+                batch.append((peer.address, self.ack_frame(peer)))
+                self.acks_sent += 1
+
+            pending = peer.pending
+            while pending and len(peer.unacked) < WINDOW:
+                parts = []
+                size = HEADER.size
+                # Склеиваем кадры, пока датаграмма помещается в PATH_MTU (хотя бы один кадр всегда)
+                while pending and (not parts or size + LENGTH.size + len(pending[0]) <= PATH_MTU):
+                    frame = pending.popleft()
+                    parts.append(LENGTH.pack(len(frame)))
+                    parts.append(frame)
+                    size += LENGTH.size + len(frame)
+                seq = peer.next_seq
+                peer.next_seq += 1
+                datagram = pack_frame(protocol.DATA, b''.join(parts), seq=seq)
+                peer.unacked[seq] = Outstanding(datagram, now, size - HEADER.size)
+                batch.append((peer.address, datagram))
+                self.datagrams_sent += 1
+                self.frames_sent += len(parts) // 2
+            if peer.unacked and peer.address not in self.timers:
+                self.timers.schedule(peer.address, peer.rto, now)
+        self.dirty.clear()
+        if batch:
+            self.transmit(batch)
+
+    def ack_frame(self, peer):
+        # Диапазоны полученного вне порядка - для выборочного подтверждения
+        blocks = []
+        for seq in sorted(peer.out_of_order):
+            if blocks and blocks[-1][1] == seq - 1:
+                blocks[-1][1] = seq
+            elif len(blocks) < ACK_BLOCKS:
+                blocks.append([seq, seq])
+            else:
+                break
+        return pack_frame(protocol.ACK, b''.join(BLOCK.pack(first, last) for first, last in blocks),
+                          seq=peer.expected - 1)
+
+    def expire(self, now):
+        """Повтор по тайм-ауту; возвращает адреса получателей, признанных недоступными"""
+        batch = []
+        failed = []
+        for address in self.timers.advance(now):
+            peer = self.peers.get(address)
+            if peer is None or not peer.unacked:
+                continue
+            # Экспоненциальная отсрочка и повтор самой ранней датаграммы (RFC 6298, 5.4-5.5);
+            # остальные потери восстановит быстрый повтор по SACK из ответа на нее
+            peer.rto = min(MAX_RTO, peer.rto * 2)
+            entry = next(iter(peer.unacked.values()))
+            entry.retransmits += 1
+            entry.sent_at = now
+            entry.fast = False
+            batch.append((address, entry.datagram))
+            self.retransmissions += 1
+            if entry.retransmits > MAX_RETRANSMITS:
+                failed.append(address)
+                self.remove(address)
+            else:
+                self.timers.schedule(address, peer.rto, now)
+        if batch:
+            self.transmit(batch)
+        return failed
+
+    def next_timeout(self, now):
+        return self.timers.next_timeout(now)
+
+    def stats(self, now=None):
+        elapsed = max(1e-9, (time.monotonic() if now is None else now) - self.started)
+        sent = self.datagrams_sent + self.retransmissions
+        return {
+            "datagrams_sent": self.datagrams_sent,
+            "frames_sent": self.frames_sent,
+            "frames_per_datagram": self.frames_sent / self.datagrams_sent if self.datagrams_sent else 0.0,
+            "retransmissions": self.retransmissions,
+            "fast_retransmissions": self.fast_retransmissions,
+            "retransmission_rate": self.retransmissions / sent if sent else 0.0,
+            "acks_sent": self.acks_sent,
+            "goodput_out_kbps": self.acked_bytes * 8 / elapsed / 1000,
+            "goodput_in_kbps": self.delivered_bytes * 8 / elapsed / 1000,
+            "delivered_frames": self.delivered_frames,
+            "duplicates": self.duplicates,
+            "out_of_order": self.out_of_order,
+            "overflow": self.overflow,
+        }
+
+    @staticmethod
+    def format_stats(stats):
+        return (f"Надежная доставка: датаграмм {stats['datagrams_sent']} "
+                f"(кадров на датаграмму {stats['frames_per_datagram']:.2f}), "
+                f"повторов {stats['retransmissions']} ({stats['retransmission_rate']:.1%}, "
+                f"быстрых {stats['fast_retransmissions']}), ACK {stats['acks_sent']}; "
+                f"полезная скорость: отправка {stats['goodput_out_kbps']:.1f} кбит/с, "
+                f"прием {stats['goodput_in_kbps']:.1f} кбит/с; "
+                f"дубликатов {stats['duplicates']}, вне порядка {stats['out_of_order']}")
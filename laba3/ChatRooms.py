@@ -0,0 +1,106 @@
+import sys
+
+DEFAULT_ROOM = "general"  # Комната, в которую попадает каждый клиент при регистрации
+MAX_ROOMS_PER_MEMBER = 32  # Сколько комнат одновременно может быть у одного клиента
+MAX_ROOM_NAME = 32  # Максимальная длина имени комнаты
+MAX_ROOMS = 65535  # Номер комнаты в двоичном протоколе занимает 2 байта
+
+
+# Индексы комнат чата: комната -> участники и участник -> комнаты.
+# Вступление и выход - O(1) по размеру комнаты, рассылка затрагивает только участников комнаты.
+# Большинство клиентов состоит в одной комнате, поэтому для них обратный индекс хранит
+# не множество, а саму строку имени (имена интернированы и не дублируются в памяти).
+# Если комнат несколько, хранится список в порядке вступления; текущая комната - последняя
+class RoomIndex:
+    def __init__(self):
+        self.rooms = {}  # имя -> множество адресов участников
+        self.member_rooms = {}  # адрес -> имя комнаты или список имен
+        # Короткие номера комнат для двоичного протокола; номер удаленной комнаты освобождается
+        self.ids = {}  # имя -> номер
+        self.free_ids = []
+        self.next_id = 1
+
+    @staticmethod
+    def valid_name(room):
+        return 0 < len(room) <= MAX_ROOM_NAME and room.isprintable() and not any(c.isspace() for c in room)
+
+    def join(self, address, room):
+        """Добавляет участника в комнату и делает ее текущей; False, если превышен лимит комнат"""
+        room = sys.intern(room)
+        if room not in self.rooms and not self.free_ids and self.next_id > MAX_ROOMS:
+            return False
+        joined = self.member_rooms.get(address)
+        if joined is None:
+            self.member_rooms[address] = room
+        else:
+            if isinstance(joined, str):
+                joined = [joined]
+            if room in joined:
+                joined.remove(room)  # Повторное вступление только делает комнату текущей
+            elif len(joined) >= MAX_ROOMS_PER_MEMBER:
+                return False
+            joined.append(room)
+            self.member_rooms[address] = joined[0] if len(joined) == 1 else joined
+
+        members = self.rooms.get(room)
+        if members is None:
+            members = self.rooms[room] = set()
+            if self.free_ids:
+                self.ids[room] = self.free_ids.pop()
+            else:
+                self.ids[room] = self.next_id
+                self.next_id += 1
+        members.add(address)
+        return True
+
+    def leave(self, address, room):
+        """Удаляет участника из комнаты; False, если он в ней не состоял"""
+        joined = self.member_rooms.get(address)
+        if joined is None or (joined != room if isinstance(joined, str) else room not in joined):
+            return False
+        if isinstance(joined, str):
+            del self.member_rooms[address]
+        else:
+            joined.remove(room)
+            self.member_rooms[address] = joined[0] if len(joined) == 1 else joined
+
+        members = self.rooms[room]
+        members.discard(address)
+        if not members:
+            self.remove_room(room)
+        return True
+
+    def leave_all(self, address):
+        """Удаляет участника из всех комнат; возвращает их список"""
+        joined = self.member_rooms.pop(address, None)
+        if joined is None:
+            return []
+        joined = [joined] if isinstance(joined, str) else joined
+        for room in joined:
+            members = self.rooms[room]
+            members.discard(address)
+            if not members:
+                self.remove_room(room)
+        return joined
+
+    def remove_room(self, room):
+        del self.rooms[room]
+        self.free_ids.append(self.ids.pop(room))
+
+    def room_id(self, room):
+        return self.ids[room]
+
+    def current_room(self, address):
+        joined = self.member_rooms.get(address)
+        if joined is None or isinstance(joined, str):
+            return joined
+        return joined[-1]
+
+    def rooms_of(self, address):
+        joined = self.member_rooms.get(address)
+        if joined is None:
+            return []
+        return [joined] if isinstance(joined, str) else list(joined)
+
+    def members(self, room):
+        return self.rooms.get(room, ())
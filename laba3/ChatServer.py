@@ -1,26 +1,81 @@
 import socket
 import sys
 import signal
+import selectors
 import time
 
+from ChatFanout import FanOut
+import ChatProtocol as protocol
+from ChatProtocol import HEADER, HEARTBEAT, HEARTBEAT_ACK, ROUTE, SESSION_TIMEOUT, VERSION, pack_frame
+from ChatHistory import CATCHUP_BATCH, HISTORY_DIR, HistoryStore, unpack_record
+from ChatReliable import LossSimulator, ReliableChannel
+from ChatRooms import DEFAULT_ROOM, RoomIndex
+from ChatTimers import TimerWheel
+
+# Максимальный размер UDP-датаграммы: буфер такого размера никогда не обрезает сообщение
+MAX_DATAGRAM_SIZE = 65535
+# Буфер приема ядра: пачка датаграмм переживает паузу в обработке без потерь
+# (фактический размер ограничен net.core.rmem_max)
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+# Сколько имен перечислять в общем уведомлении об истекших сессиях
+EXPIRY_NAMES_LISTED = 10
+# Как часто при непрерывном потоке датаграмм отправлять накопленные ACK и склеенные кадры
+RELIABLE_FLUSH_EVERY = 256
+
 
 class ChatServer:
-    def __init__(self):
-        self.server_ip = self.get_valid_ip()
-        self.server_port = self.get_valid_port()
+    def __init__(self, server_ip=None, server_port=None, simulator=None, history_dir=HISTORY_DIR):
+        self.server_ip = server_ip or self.get_valid_ip()
+        self.server_port = server_port or self.get_valid_port()
         self.connected_clients = {}
+        # Номера сессий выдаются всем клиентам: в двоичном протоколе отправитель - это номер,
+        # а не адрес. Клиенты текстового протокола (режим совместимости) перечислены в text_clients
+        self.session_ids = {}  # адрес -> номер сессии
+        self.session_addresses = {}  # номер сессии -> адрес
+        self.next_session = 0
+        self.text_clients = set()
+        # Клиенты, попросившие надежную доставку (прислали кадр DATA); им все уходит через ReliableChannel
+        self.reliable_clients = set()
+        # Имитация потерь и перестановок на приеме (LossSimulator) для проверки на localhost
+        self.simulator = simulator
+        # Комнаты: рассылка идет только участникам комнаты, а не всем подключенным клиентам
+        self.rooms = RoomIndex()
+        # Сроки сессий: клиент, от которого долго ничего не приходит, удаляется
+        self.now = time.monotonic()
+        self.sessions = TimerWheel(self.now)
+        # История комнат: последние сообщения в памяти, журнал на диске переживает перезапуск
+        self.history = HistoryStore(history_dir)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.running = True
+        self.closed = False
+
+        # Датаграммы принимаются в заранее выделенный буфер без создания новых объектов bytes
+        self.recv_buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+
+        # Цикл событий: сокет сервера и канал пробуждения (self-pipe) для сигналов завершения
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
 
         # Настройка обработчиков сигналов для корректного завершения
         signal.signal(signal.SIGINT, self.handle_shutdown)
         signal.signal(signal.SIGTERM, self.handle_shutdown)
 
         try:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
             self.server_socket.bind((self.server_ip, self.server_port))
-            # Устанавливаем таймаут для сокета, чтобы можно было периодически проверять статус
-            self.server_socket.settimeout(1.0)
+            self.server_socket.setblocking(False)
+            self.selector.register(self.server_socket, selectors.EVENT_READ, self.drain_datagrams)
+            self.selector.register(self.wakeup_reader, selectors.EVENT_READ, None)
+            # Рассылка выполняется отдельными потоками, цикл приема на ней не блокируется
+            self.fanout = FanOut(self.server_socket)
+            self.fanout.start()
+            self.reliable = ReliableChannel(self.fanout.submit_each, self.now)
             print(f"\nСервер запущен на {self.server_ip}: {self.server_port}")
+            print(f"История: восстановлено сообщений {self.history.recovered} из журнала {history_dir} "
+                  f"за {self.history.recovery_time * 1000:.1f} мс")
             print("Ожидание подключений\n")
             print("Нажмите Ctrl+C для завершения работы сервера")
         except socket.error as e:
@@ -28,27 +83,43 @@ class ChatServer:
             sys.exit(1)
 
     def handle_shutdown(self, signum, frame):
-        """Обработчик сигналов завершения"""
+        """Обработчик сигналов завершения: будит цикл событий, завершение выполняет сам цикл"""
         print("\nПолучен сигнал завершения. Закрытие сервера...")
-        self.shutdown()
+        self.stop()
+
+    def stop(self):
+        """Запрос остановки цикла событий (можно вызывать из любого потока)"""
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Цикл уже разбужен или остановлен
 
     def shutdown(self):
         """Корректное завершение работы сервера"""
-        if not self.running:
+        if self.closed:
             return
 
+        self.closed = True
         self.running = False
-        # Уведомляем всех клиентов о закрытии сервера
-        shutdown_message = "Сервер закрывается. Соединение будет прервано."
-        for client_address, client_info in self.connected_clients.items():
-            try:
-                self.server_socket.sendto(shutdown_message.encode(), client_address)
-            except:
-                pass  # Игнорируем ошибки при завершении
+        # Уведомляем всех клиентов о закрытии сервера и дожидаемся отправки очередей
+        self.broadcast_message("Сервер закрывается. Соединение будет прервано.", kind=protocol.SHUTDOWN)
+        self.reliable.flush(time.monotonic())
+        self.fanout.flush()
+        self.fanout.close()
+        self.history.close()
+        self.print_fanout_stats()
+        print(f"Сессий истекло по тайм-ауту: {self.sessions.expired}")
+        if self.reliable.datagrams_sent or self.reliable.delivered_frames:
+            print(self.reliable.format_stats(self.reliable.stats()))
+        if self.simulator is not None:
+            print(f"Имитация сети: потеряно {self.simulator.dropped}, переставлено {self.simulator.reordered}")
 
-        # Закрываем сокет
+        # Закрываем сокеты и цикл событий
         try:
+            self.selector.close()
             self.server_socket.close()
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
         except:
             pass
 
@@ -75,96 +146,382 @@ class ChatServer:
             except ValueError:
                 print("Введите число")
 
-    def broadcast_message(self, message, sender_address=None):
-        """Отправка сообщения всем клиентам, кроме отправителя"""
-        disconnected_clients = []
-
-        for client_address, client_info in self.connected_clients.items():
-            if client_address != sender_address:
-                try:
-                    client_name, client_ip, client_port = client_info
-                    self.server_socket.sendto(message.encode(), client_address)
-                except socket.error as e:
-                    print(f"Ошибка отправки {client_info[0]}: {e}")
-                    disconnected_clients.append(client_address)
-
-        # Удаляем отключенных клиентов
-        for client in disconnected_clients:
+    def broadcast_message(self, message, sender_address=None, room=None, kind=protocol.NOTICE):
+        """Отправка служебного сообщения участникам комнаты (или всем клиентам), кроме отправителя"""
+        recipients = self.connected_clients.keys() if room is None else self.rooms.members(room)
+        payload = message.encode()
+        self.submit(recipients, pack_frame(kind, payload), lambda: payload, sender_address)
+
+    def submit(self, recipients, frame, make_text, sender_address=None):
+        """Рассылка с учетом протокола получателей: кадр - двоичным клиентам, make_text() - текстовым"""
+        # Датаграмма собирается один раз; в очередь рассылки уходит снимок адресов получателей.
+        # Разбиение на текстовых и двоичных клиентов - операции над множествами, выполняемые в C
+        text_recipients = recipients & self.text_clients if self.text_clients else None
+        if text_recipients:
+            self.fanout.submit(make_text(), tuple(text_recipients), sender_address)
+            recipients = recipients - text_recipients
+        reliable_recipients = recipients & self.reliable_clients if self.reliable_clients else None
+        if reliable_recipients:
+            # У каждого такого получателя свои номера датаграмм: кадр ставится в его очередь
+            for address in reliable_recipients:
+                if address != sender_address:
+                    self.reliable.queue(address, frame)
+            recipients = recipients - reliable_recipients
+        if recipients:
+            self.fanout.submit(frame, tuple(recipients), sender_address)
+
+    def reply(self, client_address, message, kind=protocol.NOTICE):
+        """Ответ одному клиенту в его протоколе"""
+        if client_address in self.text_clients:
+            self.server_socket.sendto(message.encode(), client_address)
+        else:
+            self.send_frame(client_address, pack_frame(kind, message.encode()))
+
+    def send_frame(self, client_address, frame):
+        """Отправка кадра одному двоичному клиенту, с надежной доставкой, если он ее использует"""
+        if client_address in self.reliable_clients:
+            self.reliable.queue(client_address, frame)
+        else:
+            self.server_socket.sendto(frame, client_address)
+
+    def register(self, client_address, client_name, client_ip, text_protocol, reliable=False):
+        session = self.next_session = self.next_session % 0xFFFFFFFF + 1
+        while session in self.session_addresses:
+            session = self.next_session = self.next_session % 0xFFFFFFFF + 1
+        self.session_ids[client_address] = session
+        self.session_addresses[session] = client_address
+        if text_protocol:
+            self.text_clients.add(client_address)
+        elif reliable:
+            self.reliable_clients.add(client_address)
+        self.connected_clients[client_address] = (client_name, client_ip, client_address[1])
+        self.rooms.join(client_address, DEFAULT_ROOM)
+        self.sessions.schedule(client_address, SESSION_TIMEOUT, self.now)
+        if not text_protocol:
+            self.send_frame(client_address, pack_frame(protocol.WELCOME, session=session))
+            self.send_room(client_address, DEFAULT_ROOM)
+        print(f"Подключился (-ась) {client_name} ({client_ip}: {client_address[1]})"
+              + ("" if text_protocol else f", сессия {session}") + (", надежная доставка" if reliable else ""))
+        self.broadcast_message(f"Пользователь {client_name} вошел в чат", client_address, DEFAULT_ROOM)
+
+    def send_room(self, client_address, room):
+        """Сообщает двоичному клиенту номер комнаты, чтобы он мог подписывать ее сообщения"""
+        if client_address not in self.text_clients:
+            self.send_frame(client_address, pack_frame(protocol.ROOM, room.encode(), room=self.rooms.room_id(room)))
+
+    def disconnect_client(self, client_address, notify=True):
+        """Удаление клиента из чата и из всех его комнат; возвращает имя клиента и его комнаты"""
+        client_name = self.connected_clients.pop(client_address)[0]
+        del self.session_addresses[self.session_ids.pop(client_address)]
+        self.text_clients.discard(client_address)
+        self.reliable_clients.discard(client_address)
+        self.reliable.remove(client_address)
+        self.sessions.cancel(client_address)
+        self.fanout.discard(client_address)
+        rooms = self.rooms.leave_all(client_address)
+        if notify:
+            # Уведомление получают соседи по всем комнатам клиента, каждый по одному разу
+            neighbours = set()
+            for room in rooms:
+                neighbours.update(self.rooms.members(room))
+            if neighbours:
+                payload = f"Пользователь {client_name} вышел из чата".encode()
+                self.submit(neighbours, pack_frame(protocol.NOTICE, payload), lambda: payload)
+        return client_name, rooms
+
+    def remove_unreachable_clients(self):
+        """Удаление клиентов, отправка которым завершилась ошибкой"""
+        failures = self.fanout.failures
+        while failures:
+            client = failures.popleft()
             if client in self.connected_clients:
-                print(f"Отключен клиент {self.connected_clients[client][0]} из-за ошибки связи")
-                del self.connected_clients[client]
+                print(f"Отключен клиент {self.disconnect_client(client)[0]} из-за ошибки связи")
+
+    def print_fanout_stats(self):
+        stats = self.fanout.stats()
+        print(f"Рассылка ({stats['batching']}): отправлено {stats['sent']}, отброшено {stats['dropped']}, "
+              f"ошибок {stats['errors']}; задержка p50 {stats['latency_p50_ms']:.2f} мс, "
+              f"p99 {stats['latency_p99_ms']:.2f} мс, максимум {stats['latency_max_ms']:.2f} мс")
+
+    def expire_sessions(self):
+        """Удаление клиентов, чьи сессии истекли"""
+        expired = self.sessions.advance(self.now)
+        # Уведомления собираются по комнатам: одна рассылка на комнату за шаг колеса,
+        # иначе массовое истечение стоило бы O(клиентов * соседей)
+        departed = {}
+        for client_address in expired:
+            if client_address in self.connected_clients:
+                client_name, rooms = self.disconnect_client(client_address, notify=False)
+                for room in rooms:
+                    departed.setdefault(room, []).append(client_name)
+        for room, names in departed.items():
+            if len(names) == 1:
+                message = f"Пользователь {names[0]} вышел из чата (истекло время ожидания)"
+            elif len(names) <= EXPIRY_NAMES_LISTED:
+                message = f"Пользователи {', '.join(names)} вышли из чата (истекло время ожидания)"
+            else:
+                message = f"{len(names)} пользователей вышли из чата (истекло время ожидания)"
+            self.broadcast_message(message, room=room)
+        if expired:
+            print(f"Истекло сессий: {len(expired)} (всего {self.sessions.expired}), "
+                  f"подключено клиентов: {len(self.connected_clients)}")
+
+    def retransmit(self):
+        """Повторы надежной доставки по тайм-ауту; недоступные получатели отключаются"""
+        for client_address in self.reliable.expire(self.now):
+            if client_address in self.connected_clients:
+                print(f"Отключен клиент {self.disconnect_client(client_address)[0]}: "
+                      f"нет подтверждений доставки")
+        self.reliable.flush(self.now)
+
+    def next_timeout(self):
+        """До ближайшего шага колес сессий и повторов; None - ждать без таймаута"""
+        now = time.monotonic()
+        timeouts = [timeout for timeout in (self.sessions.next_timeout(now), self.reliable.next_timeout(now))
+                    if timeout is not None]
+        return min(timeouts) if timeouts else None
 
     def run(self):
+        """Цикл событий: без подключенных клиентов ждет без таймаута, иначе - до следующего шага колес таймеров"""
+        while self.running:
+            for key, _ in self.selector.select(self.next_timeout()):
+                if key.data is None:
+                    # Сигнал завершения пришел через канал пробуждения
+                    self.running = False
+                    break
+                key.data()
+            self.now = time.monotonic()
+            self.expire_sessions()
+            self.retransmit()
+        self.shutdown()
+
+    def drain_datagrams(self):
+        """Обработка всех датаграмм, накопившихся в сокете к моменту готовности"""
+        view = self.recv_view
+        self.now = time.monotonic()
+        received = 0
         while self.running:
             try:
-                # Получаем данные с таймаутом
-                data, client_address = self.server_socket.recvfrom(1024)
-                data = data.decode()
-
-                if client_address not in self.connected_clients:
-                    if data.startswith("reg:"):
-                        parts = data.split(":")
-                        if len(parts) >= 3:
-                            client_name = parts[1]
-                            client_ip = parts[2]
-                            # Проверяем, что предоставленный IP соответствует адресу, с которого пришло сообщение
-                            if client_ip != client_address[0]:
-                                self.server_socket.sendto(
-                                    f"Ошибка: Указанный IP ({client_ip}) не соответствует фактическому ({client_address[0]})".encode(),
-                                    client_address)
-                                continue
-
-                            self.connected_clients[client_address] = (client_name, client_ip, client_address[1])
-                            print(f"Подключился (-ась) {client_name} ({client_ip}: {client_address[1]})")
-                            self.broadcast_message(f"Пользователь {client_name} вошел в чат", client_address)
-                        else:
-                            self.server_socket.sendto("Ошибка: Неверный формат регистрации".encode(), client_address)
-                        continue
-
-                if data.lower() == 'exit':
-                    if client_address in self.connected_clients:
-                        client_name = self.connected_clients[client_address][0]
-                        del self.connected_clients[client_address]
-                        print(f"{client_name} отключился")
-                        self.broadcast_message(f"Пользователь {client_name} вышел из чата", client_address)
-                    continue
-
-                if client_address in self.connected_clients:
-                    client_name = self.connected_clients[client_address][0]
-                    message = f"{client_name}: {data}"
-                    print(message)
-                    self.broadcast_message(message, client_address)
-
-            except socket.timeout:
-                # Таймаут сокета - нормальная ситуация, используем для проверки флага running
+                size, client_address = self.server_socket.recvfrom_into(self.recv_buffer)
+            except BlockingIOError:
+                self.remove_unreachable_clients()
+                # ACK и склеенные кадры уходят один раз за пачку принятых датаграмм
+                self.reliable.flush(self.now)
+                # Новые сообщения истории дописываются в журнал одной записью за пачку
+                self.history.flush()
+                return  # Очередь сокета пуста
+            except ConnectionError:
+                # ICMP "порт недоступен" от ушедшего клиента; сокет при этом остается рабочим
                 continue
-            except ConnectionResetError as e:
-                print(f"Соединение сброшено: {e}")
-                # Попытка переинициализировать сокет
-                try:
-                    self.server_socket.close()
-                    self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    self.server_socket.bind((self.server_ip, self.server_port))
-                    self.server_socket.settimeout(1.0)
-                    print("Сокет переинициализирован")
-                except socket.error as se:
-                    print(f"Невозможно восстановить сокет: {se}")
-                    self.shutdown()
-            except socket.error as e:
-                print(f"Ошибка сокета: {e}")
-                if not self.running:
-                    break
-            except KeyboardInterrupt:
-                print("\nПрерывание с клавиатуры. Завершение работы...")
-                self.shutdown()
-            except Exception as e:
-                print(f"Непредвиденная ошибка: {e}")
-                if not self.running:
+            if self.simulator is None:
+                self.process_datagram(view[:size], client_address)
+            else:
+                for datagram, address in self.simulator(view[:size], client_address):
+                    self.process_datagram(datagram, address)
+            received += 1
+            if received % RELIABLE_FLUSH_EVERY == 0:
+                self.reliable.flush(self.now)
+
+    def process_datagram(self, datagram, client_address):
+        if client_address in self.connected_clients:
+            # Любая датаграмма продлевает сессию; heartbeat дальше не обрабатывается
+            self.sessions.touch(client_address, SESSION_TIMEOUT, self.now)
+            if datagram == HEARTBEAT:
+                self.server_socket.sendto(HEARTBEAT_ACK, client_address)
+                return
+        elif datagram == HEARTBEAT:
+            return  # Сессия уже удалена: клиент поймет это по отсутствию ответа
+        try:
+            if len(datagram) and datagram[0] == VERSION:
+                # Кадр двоичного протокола: нагрузка не декодируется
+                self.handle_frame(datagram, client_address)
+            else:
+                self.handle_datagram(str(datagram, 'utf-8', 'replace'), client_address)
+        except Exception as e:
+            print(f"Непредвиденная ошибка: {e}")
+
+    def handle_datagram(self, data, client_address):
+        if client_address not in self.connected_clients:
+            if data.startswith("reg:"):
+                parts = data.split(":")
+                if len(parts) >= 3:
+                    client_name = parts[1]
+                    client_ip = parts[2]
+                    # Проверяем, что предоставленный IP соответствует адресу, с которого пришло сообщение
+                    if client_ip != client_address[0]:
+                        self.server_socket.sendto(
+                            f"Ошибка: Указанный IP ({client_ip}) не соответствует фактическому ({client_address[0]})".encode(),
+                            client_address)
+                        return
+
+                    self.register(client_address, client_name, client_ip, text_protocol=True)
+                else:
+                    self.server_socket.sendto("Ошибка: Неверный формат регистрации".encode(), client_address)
+                return
+
+        if data.lower() == 'exit':
+            if client_address in self.connected_clients:
+                print(f"{self.disconnect_client(client_address)[0]} отключился")
+            return
+
+        if client_address in self.connected_clients:
+            client_name = self.connected_clients[client_address][0]
+            if data.startswith("/"):
+                self.handle_command(data, client_address, client_name)
+                return
+            # Сообщение уходит в текущую комнату отправителя (последнюю, в которую он вошел)
+            room = self.rooms.current_room(client_address)
+            if room is None:
+                self.reply(client_address, "Вы не состоите ни в одной комнате: /join <комната>")
+                return
+            message = f"{client_name}: {data}" if room == DEFAULT_ROOM else f"[{room}] {client_name}: {data}"
+            print(message)
+            text = data.encode()
+            session = self.session_ids[client_address]
+            seq = self.history.append(room, session, client_name.encode(), text)
+            frame = pack_frame(protocol.DELIVER, text, session, seq, self.rooms.room_id(room))
+            self.submit(self.rooms.members(room), frame, message.encode, client_address)
+
+    def handle_frame(self, frame, client_address, reliable=False):
+        """Обработка кадра двоичного протокола; reliable - кадр пришел внутри DATA"""
+        try:
+            kind, room_id, session, seq, payload = protocol.parse_frame(frame)
+        except protocol.FrameError as e:
+            print(f"Отброшен кадр от {client_address[0]}:{client_address[1]}: {e}")
+            return
+
+        if kind == protocol.DATA or kind == protocol.ACK:
+            for inner in self.reliable.receive(kind, seq, payload, client_address, self.now):
+                self.handle_frame(inner, client_address, reliable=True)
+            if client_address not in self.connected_clients:
+                # Регистрация не состоялась: подтверждаем полученное и не храним состояние доставки
+                self.reliable.flush(self.now)
+                self.reliable.remove(client_address)
+            return
+
+        if client_address not in self.connected_clients:
+            if kind == protocol.REGISTER:
+                client_name = str(payload, 'utf-8', 'replace').strip()
+                if client_name:
+                    self.register(client_address, client_name, client_address[0], text_protocol=False,
+                                  reliable=reliable)
+                else:
+                    self.reply(client_address, "Ошибка: Неверный формат регистрации")
+            elif kind not in (protocol.PING, protocol.EXIT):
+                # На PING не отвечаем: клиент сам поймет по отсутствию PONG, что сессия удалена
+                self.reply(client_address, "Ошибка: клиент не зарегистрирован")
+            return
+
+        own_session = self.session_ids[client_address]
+        if kind == protocol.MESSAGE:
+            if session != own_session:
+                return  # Кадр от прежней сессии этого адреса
+            room = self.rooms.current_room(client_address)
+            if room is None:
+                self.reply(client_address, "Вы не состоите ни в одной комнате: /join <комната>")
+                return
+            # Кадр для получателей - новый заголовок (тип, комната, номер сообщения в комнате)
+            # и нагрузка принятого кадра; текст не декодируется и не форматируется
+            seq = self.history.append(room, own_session, self.connected_clients[client_address][0].encode(),
+                                      bytes(payload))
+            delivered = HEADER.pack(VERSION, protocol.DELIVER, self.rooms.room_id(room), own_session, seq,
+                                    len(payload)) + payload
+            self.submit(self.rooms.members(room), delivered,
+                        lambda: self.text_prefix(client_address, room) + payload, client_address)
+        elif kind == protocol.HISTORY_REQUEST:
+            for room in self.rooms.rooms_of(client_address):
+                if self.rooms.room_id(room) == room_id:
+                    self.send_history(client_address, room, seq)
                     break
+            else:
+                self.reply(client_address, "Ошибка: вы не состоите в этой комнате")
+        elif kind == protocol.WHOIS:
+            address = self.session_addresses.get(session)
+            name = self.connected_clients[address][0] if address else "?"
+            self.send_frame(client_address, pack_frame(protocol.NAME, name.encode(), session))
+        elif kind == protocol.PING:
+            self.send_frame(client_address, pack_frame(protocol.PONG, session=own_session))
+        elif kind == protocol.COMMAND:
+            self.handle_command(str(payload, 'utf-8', 'replace'), client_address,
+                                self.connected_clients[client_address][0])
+        elif kind == protocol.EXIT:
+            print(f"{self.disconnect_client(client_address)[0]} отключился")
+        elif kind == protocol.REGISTER:
+            # Повтор регистрации (ответ потерялся): напоминаем номер сессии
+            self.send_frame(client_address, pack_frame(protocol.WELCOME, session=own_session))
+
+    def send_history(self, client_address, room, since):
+        """Порция истории комнаты после номера since (0 - последние сообщения), не больше CATCHUP_BATCH"""
+        records = self.history.since(room, since, CATCHUP_BATCH + 1)
+        more = len(records) > CATCHUP_BATCH
+        del records[CATCHUP_BATCH:]
+        last = HEADER.unpack_from(records[-1])[4] if records else self.history.next_seq(room) - 1
+        if client_address in self.text_clients:
+            for record in records:
+                _, seq, name, text = unpack_record(record)
+                line = f"[история #{seq}] {str(name, 'utf-8', 'replace')}: {str(text, 'utf-8', 'replace')}"
+                self.server_socket.sendto((line if room == DEFAULT_ROOM else f"[{room}] {line}").encode(),
+                                          client_address)
+            self.server_socket.sendto((f"Еще есть история: /history {last}" if more
+                                       else "Конец истории").encode(), client_address)
+            return
+        # Записи хранятся готовыми кадрами HISTORY: меняется только номер комнаты в начале заголовка
+        route = ROUTE.pack(VERSION, protocol.HISTORY, self.rooms.room_id(room))
+        for record in records:
+            self.send_frame(client_address, route + record[ROUTE.size:])
+        # Конец порции: клиент запрашивает следующую сам, поэтому поток истории не переполняет его буфер
+        self.send_frame(client_address, pack_frame(protocol.HISTORY_END, session=int(more), seq=last,
+                                                   room=self.rooms.room_id(room)))
+
+    def text_prefix(self, client_address, room):
+        """Подпись сообщения для клиентов текстового протокола"""
+        client_name = self.connected_clients[client_address][0]
+        return (f"{client_name}: " if room == DEFAULT_ROOM else f"[{room}] {client_name}: ").encode()
+
+    def handle_command(self, data, client_address, client_name):
+        """Команды комнат: /join, /leave, /rooms, /history"""
+        command, _, room = data.partition(" ")
+        room = room.strip()
+        command = command.lower()
+        if command == "/history":
+            current = self.rooms.current_room(client_address)
+            if current is None:
+                reply = "Вы не состоите ни в одной комнате: /join <комната>"
+            elif room and not room.isdigit():
+                reply = "Ошибка: /history [номер последнего известного сообщения]"
+            else:
+                self.send_history(client_address, current, int(room or 0))
+                return
+        elif command in ("/join", "/leave") and not self.rooms.valid_name(room):
+            reply = "Ошибка: укажите имя комнаты без пробелов (не длиннее 32 символов)"
+        elif command == "/join":
+            if self.rooms.join(client_address, room):
+                self.send_room(client_address, room)
+                reply = f"Вы в комнате {room}"
+                print(f"{client_name} вошел (-ла) в комнату {room}")
+                self.broadcast_message(f"Пользователь {client_name} вошел в комнату {room}", client_address, room)
+            else:
+                reply = "Ошибка: слишком много комнат, сначала покиньте одну из них (/leave)"
+        elif command == "/leave":
+            if self.rooms.leave(client_address, room):
+                current = self.rooms.current_room(client_address)
+                reply = f"Вы покинули комнату {room}" + (f", текущая комната: {current}" if current else "")
+                print(f"{client_name} покинул (-а) комнату {room}")
+                self.broadcast_message(f"Пользователь {client_name} покинул комнату {room}", client_address, room)
+            else:
+                reply = f"Вы не состоите в комнате {room}"
+        elif command == "/rooms":
+            joined = self.rooms.rooms_of(client_address)
+            reply = ("Ваши комнаты: " + ", ".join(joined) + f" (текущая: {joined[-1]})") if joined \
+                else "Вы не состоите ни в одной комнате"
+        else:
+            reply = "Команды: /join <комната>, /leave <комната>, /rooms, /history [номер]"
+        self.reply(client_address, reply)
 
 
 if __name__ == "__main__":
-    server = ChatServer()
+    # --loss=0.1 --reorder=0.05: имитация ненадежной сети на приеме (для проверки на localhost)
+    server = ChatServer(simulator=LossSimulator.from_args(sys.argv[1:]))
     try:
         server.run()
     except KeyboardInterrupt:
@@ -0,0 +1,105 @@
+TIMER_TICK = 1.0  # Шаг колеса таймеров, с
+WHEEL_BITS = 6  # 64 ячейки на уровень
+WHEEL_LEVELS = 4  # 64^4 шагов - больше 190 суток при шаге в 1 с
+
+
+# Иерархическое колесо таймеров для истечения сессий.
+# Уровень L хранит сроки с точностью 64^L шагов; когда текущий шаг доходит до ячейки
+# верхнего уровня, ее содержимое переносится на нижние уровни ("каскад").
+# Продление срока (touch) ленивое: меняется только запись в deadlines, а элемент остается
+# в старой ячейке. Когда ячейка срабатывает, элемент с продленным сроком просто
+# перекладывается дальше. Поэтому и продление, и истечение стоят O(1) на сессию
+class TimerWheel:
+    def __init__(self, now, tick=TIMER_TICK, levels=WHEEL_LEVELS):
+        self.tick = tick
+        self.levels = levels
+        self.slots = 1 << WHEEL_BITS
+        self.mask = self.slots - 1
+        self.wheels = [[set() for _ in range(self.slots)] for _ in range(levels)]
+        self.current = int(now / tick)
+        self.deadlines = {}  # ключ -> шаг истечения (актуальный)
+        self.positions = {}  # ключ -> ячейка, в которой лежит ключ
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, timeout, now):
+        """Назначает или продлевает срок ключа: истечет через timeout секунд от now"""
+        deadline = max(int((now + timeout) / self.tick) + 1, self.current + 1)
+        previous = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        if previous is None:
+            self._insert(key, deadline)
+        elif deadline < previous:
+            # Срок сократился: ключ может лежать в слишком поздней ячейке, перекладываем
+            self.positions[key].discard(key)
+            self._insert(key, deadline)
+
+    touch = schedule
+
+    def cancel(self, key):
+        if self.deadlines.pop(key, None) is not None:
+            self.positions.pop(key).discard(key)
+
+    def _insert(self, key, deadline):
+        # Уровень выбирается так, чтобы ячейка была не дальше одного оборота этого уровня
+        current = self.current
+        level = 0
+        shift = 0
+        while (deadline >> shift) - (current >> shift) >= self.slots and level < self.levels - 1:
+            level += 1
+            shift += WHEEL_BITS
+        if (deadline >> shift) - (current >> shift) >= self.slots:
+            # Срок дальше всего колеса: кладем в самую дальнюю ячейку, оттуда ключ переложится
+            deadline = ((current >> shift) + self.mask) << shift
+        slot = self.wheels[level][(deadline >> shift) & self.mask]
+        slot.add(key)
+        self.positions[key] = slot
+
+    def next_timeout(self, now):
+        """Сколько ждать до следующего шага колеса; None, если ждать нечего"""
+        if not self.deadlines:
+            return None
+        return max(0.0, (self.current + 1) * self.tick - now)
+
+    def advance(self, now):
+        """Продвигает колесо до момента now; возвращает список истекших ключей"""
+        target = int(now / self.tick)
+        expired = []
+        if not self.deadlines:
+            self.current = max(self.current, target)
+            return expired
+
+        while self.current < target:
+            self.current += 1
+            current = self.current
+            # Каскад: ячейки верхних уровней, чья граница совпала с текущим шагом, разносятся ниже
+            for level in range(self.levels - 1, 0, -1):
+                shift = level * WHEEL_BITS
+                if current & ((1 << shift) - 1) == 0:
+                    self._reinsert(self.wheels[level][(current >> shift) & self.mask], expired)
+
+            self._reinsert(self.wheels[0][current & self.mask], expired)
+
+        self.expired += len(expired)
+        return expired
+
+    def _reinsert(self, slot, expired):
+        if not slot:
+            return
+        keys = list(slot)
+        slot.clear()
+        deadlines = self.deadlines
+        current = self.current
+        for key in keys:
+            deadline = deadlines[key]
+            if deadline <= current:
+                del deadlines[key]
+                del self.positions[key]
+                expired.append(key)
+            else:
+                self._insert(key, deadline)
@@ -0,0 +1,308 @@
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+
+import ChatProtocol as protocol
+from ChatProtocol import HEARTBEAT_INTERVAL, pack_frame, parse_frame
+
+# Нагрузочный тест сервера чата: N клиентов двоичного протокола на localhost в одном процессе
+# (сокет на клиента, общий цикл selectors) отправляют сообщения с заданной общей частотой.
+# Измеряются задержка доставки от отправки до приема каждым получателем (перцентили),
+# доля доставленных сообщений и загрузка процессора сервером; результат - JSON для сравнения запусков.
+# Запуск: python bench_load.py [--clients=1000] [--rate=200] [--duration=10] [--rooms=1]
+#         [--senders=0] [--size=64] [--setup-timeout=30] [--server=IP:порт | --server-pid=PID]
+#         [--output=results.json]
+# Без --server сервер запускается отдельным процессом с временным каталогом истории
+CLIENTS = 100  # Клиентов
+RATE = 100.0  # Сообщений в секунду от всех отправителей вместе
+DURATION = 10.0  # Длительность замера, с
+ROOMS = 1  # Комнат; клиенты распределяются по ним поровну, при 1 все в общей комнате
+SENDERS = 0  # Сколько клиентов отправляют сообщения (0 - все)
+SIZE = 64  # Байт в сообщении
+REGISTER_BATCH = 100  # Регистраций за раз, чтобы не переполнить буфер приема сервера
+SETUP_TIMEOUT = 30.0  # Сколько ждать регистрации и входа в комнаты, с (каждый вход рассылается всей комнате)
+DRAIN_TIME = 2.0  # Сколько принимать после последней отправки, с
+RECV_BUFFER_SIZE = 256 * 1024  # Буфер приема сокета клиента
+MARK = b"load "  # Начало текста нагрузочного сообщения: load <отправитель> <номер> <время отправки, нс>
+
+
+class LoadClient:
+    __slots__ = ('index', 'socket', 'session', 'room', 'room_id', 'ready', 'sent')
+
+    def __init__(self, index, room):
+        self.index = index
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.setblocking(False)
+        self.session = 0
+        self.room = room
+        self.room_id = None  # Номер комнаты нагрузки; известен после ответа ROOM
+        self.ready = False
+        self.sent = 0
+
+
+def parse_options(args):
+    options = dict(arg[2:].split("=", 1) for arg in args if arg.startswith("--") and "=" in arg)
+    return {
+        "clients": int(options.get("clients", CLIENTS)),
+        "rate": float(options.get("rate", RATE)),
+        "duration": float(options.get("duration", DURATION)),
+        "rooms": int(options.get("rooms", ROOMS)),
+        "senders": int(options.get("senders", SENDERS)),
+        "size": int(options.get("size", SIZE)),
+        "setup_timeout": float(options.get("setup-timeout", SETUP_TIMEOUT)),
+        "server": options.get("server"),
+        "server_pid": int(options["server-pid"]) if "server-pid" in options else None,
+        "output": options.get("output"),
+    }
+
+
+def process_cpu(pid):
+    """Процессорное время процесса (user, system) в секундах из /proc (Linux); None, если недоступно"""
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return int(fields[11]) / ticks, int(fields[12]) / ticks
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+
+def start_server():
+    """Сервер в отдельном процессе на свободном порту; история пишется во временный каталог"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    directory = tempfile.mkdtemp(prefix="chat_load_")
+    log = open(os.path.join(directory, "server.log"), "w+")
+    code = (f"import ChatServer; ChatServer.ChatServer('127.0.0.1', {port}, "
+            f"history_dir={os.path.join(directory, 'history')!r}).run()")
+    process = subprocess.Popen([sys.executable, "-u", "-c", code], stdout=log, stderr=subprocess.STDOUT,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    time.sleep(0.5)
+    return process, ('127.0.0.1', port), log
+
+
+class LoadGenerator:
+    def __init__(self, settings, server_address):
+        self.settings = settings
+        self.server_address = server_address
+        self.selector = selectors.DefaultSelector()
+        self.recv_buffer = bytearray(65535)
+        rooms = settings["rooms"]
+        self.clients = [LoadClient(i, "general" if rooms == 1 else f"load-{i % rooms}")
+                        for i in range(settings["clients"])]
+        for client in self.clients:
+            self.selector.register(client.socket, selectors.EVENT_READ, client)
+        self.room_sizes = {}
+        for client in self.clients:
+            self.room_sizes[client.room] = self.room_sizes.get(client.room, 0) + 1
+        self.latencies = array('d')  # мс
+        self.received = 0
+        self.expected = 0
+        self.sent = 0
+        self.other_frames = 0
+        self.last_ping = time.monotonic()
+
+    def send(self, client, frame):
+        try:
+            client.socket.sendto(frame, self.server_address)
+        except (BlockingIOError, ConnectionError):
+            pass  # Буфер отправки переполнен или ICMP от сервера: сообщение считается потерянным
+
+    def receive(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            client = key.data
+            while True:
+                try:
+                    size = client.socket.recv_into(self.recv_buffer)
+                except (BlockingIOError, ConnectionError):
+                    break
+                self.handle(client, memoryview(self.recv_buffer)[:size])
+
+    def handle(self, client, data):
+        received_at = time.monotonic_ns()
+        try:
+            kind, room, session, _, payload = parse_frame(data)
+        except protocol.FrameError:
+            return
+        if kind == protocol.DELIVER and payload[:len(MARK)] == MARK:
+            sent_at = int(bytes(payload[len(MARK):]).split(b" ", 3)[2])
+            self.latencies.append((received_at - sent_at) / 1e6)
+            self.received += 1
+        elif kind == protocol.WELCOME and not client.session:
+            client.session = session
+            if client.room == "general":
+                return
+            self.send(client, pack_frame(protocol.COMMAND, f"/join {client.room}".encode(), session))
+        elif kind == protocol.ROOM and str(payload, 'utf-8') == client.room:
+            client.room_id = room
+            client.ready = True
+        else:
+            self.other_frames += 1
+
+    def setup(self):
+        """Регистрация всех клиентов и вход в комнаты нагрузки"""
+        started = time.monotonic()
+        for start in range(0, len(self.clients), REGISTER_BATCH):
+            for client in self.clients[start:start + REGISTER_BATCH]:
+                self.send(client, pack_frame(protocol.REGISTER, f"load-{client.index}".encode()))
+            self.receive(0.01)
+        while time.monotonic() - started < self.settings["setup_timeout"]:
+            self.receive(0.05)
+            if all(client.ready for client in self.clients):
+                break
+        # Уведомления о входе других клиентов дочитываются, чтобы не смешивать их с замером
+        quiet = time.monotonic()
+        while time.monotonic() - quiet < 0.5:
+            before = self.other_frames
+            self.receive(0.1)
+            if self.other_frames != before:
+                quiet = time.monotonic()
+        return time.monotonic() - started
+
+    def heartbeat(self, now):
+        # Получатели, которые сами ничего не отправляют, не должны терять сессию по тайм-ауту
+        if now - self.last_ping >= HEARTBEAT_INTERVAL:
+            self.last_ping = now
+            for client in self.clients:
+                self.send(client, pack_frame(protocol.PING, session=client.session))
+
+    def run(self):
+        settings = self.settings
+        ready = [client for client in self.clients if client.ready]
+        senders = ready[:settings["senders"]] if settings["senders"] else ready
+        interval = 1.0 / settings["rate"]
+        padding = b"x" * settings["size"]
+        started = time.monotonic()
+        deadline = started + settings["duration"]
+        next_send = started
+        turn = 0
+        while senders:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            while next_send <= now:
+                client = senders[turn % len(senders)]
+                turn += 1
+                client.sent += 1
+                text = MARK + f"{client.index} {client.sent} {time.monotonic_ns()} ".encode()
+                text += padding[:max(0, settings["size"] - len(text))]
+                self.send(client, pack_frame(protocol.MESSAGE, text, client.session, client.sent))
+                self.sent += 1
+                self.expected += self.room_sizes[client.room] - 1
+                next_send += interval
+            self.heartbeat(now)
+            self.receive(max(0.0, min(next_send, deadline) - time.monotonic()))
+        sending_time = time.monotonic() - started
+        drain_until = time.monotonic() + DRAIN_TIME
+        while time.monotonic() < drain_until:
+            self.receive(0.05)
+        return sending_time
+
+    def close(self):
+        for client in self.clients:
+            try:
+                client.socket.sendto(pack_frame(protocol.EXIT, session=client.session), self.server_address)
+            except OSError:
+                pass
+            client.socket.close()
+        self.selector.close()
+
+
+def main():
+    settings = parse_options(sys.argv[1:])
+    process = log = None
+    if settings["server"]:
+        host, _, port = settings["server"].rpartition(":")
+        server_address = (host or '127.0.0.1', int(port))
+        server_pid = settings["server_pid"]
+    else:
+        process, server_address, log = start_server()
+        server_pid = process.pid
+
+    generator = LoadGenerator(settings, server_address)
+    try:
+        setup_time = generator.setup()
+        ready = sum(client.ready for client in generator.clients)
+        print(f"Зарегистрировано клиентов: {ready} из {len(generator.clients)} за {setup_time:.2f} с")
+
+        server_before = process_cpu(server_pid) if server_pid else None
+        own_before = os.times()
+        wall_started = time.monotonic()
+        sending_time = generator.run()
+        wall = time.monotonic() - wall_started
+        own_after = os.times()
+        server_after = process_cpu(server_pid) if server_pid else None
+    finally:
+        generator.close()
+        report = []
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.seek(0)
+            report = log.read().splitlines()[-4:]
+            log.close()
+
+    ordered = sorted(generator.latencies)
+    results = {
+        "settings": settings,
+        "server": f"{server_address[0]}:{server_address[1]}",
+        "clients_ready": ready,
+        "setup_s": round(setup_time, 3),
+        "sending_s": round(sending_time, 3),
+        "sent": generator.sent,
+        "sent_rate": round(generator.sent / sending_time, 1) if sending_time else 0,
+        "expected_deliveries": generator.expected,
+        "delivered": generator.received,
+        "delivery_ratio": round(generator.received / generator.expected, 6) if generator.expected else None,
+        "latency_ms": {name: (round(percentile(ordered, fraction), 3) if ordered else None)
+                       for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999),
+                                              ("max", 1.0))},
+        # Процессор за время замера (отправка и дочитывание хвоста), % одного ядра
+        "server_cpu": None if not server_before or not server_after else {
+            "user_s": round(server_after[0] - server_before[0], 3),
+            "system_s": round(server_after[1] - server_before[1], 3),
+            "percent": round((sum(server_after) - sum(server_before)) / wall * 100, 1),
+        },
+        # Генератор работает на той же машине: если он сам близок к 100%, узкое место - он, а не сервер
+        "generator_cpu_percent": round((own_after.user + own_after.system - own_before.user - own_before.system)
+                                       / wall * 100, 1),
+        "server_report": report,
+    }
+
+    latency = results["latency_ms"]
+    print(f"Отправлено {results['sent']} ({results['sent_rate']}/с), доставлено {results['delivered']} "
+          f"из {results['expected_deliveries']} ({(results['delivery_ratio'] or 0) * 100:.2f}%)")
+    if ordered:
+        print(f"Задержка доставки, мс: p50 {latency['p50']}, p90 {latency['p90']}, p99 {latency['p99']}, "
+              f"p99.9 {latency['p999']}, максимум {latency['max']}")
+    if results["server_cpu"]:
+        print(f"Процессор сервера: {results['server_cpu']['percent']}%, "
+              f"генератора: {results['generator_cpu_percent']}%")
+    if settings["output"]:
+        with open(settings["output"], "w") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {settings['output']}")
+    else:
+        print(json.dumps(results, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
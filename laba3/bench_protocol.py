@@ -0,0 +1,64 @@
+import time
+
+import ChatProtocol as protocol
+from ChatProtocol import HEADER, VERSION, pack_frame, parse_frame
+
+# Бенчмарк разбора и сборки сообщений чата на сервере: текстовый протокол (декодирование
+# датаграммы, поиск отправителя по адресу, форматирование "имя: текст", кодирование)
+# против двоичного (разбор заголовка, проверка сессии, новый заголовок + исходные байты нагрузки)
+ITERATIONS = 200_000
+CLIENT_ADDRESS = ('192.168.1.17', 50123)
+CLIENT_NAME = "Анастасия"
+SESSION = 1234
+
+
+def text_path(datagram, connected_clients):
+    data = str(datagram, 'utf-8', 'replace')
+    client_name = connected_clients[CLIENT_ADDRESS][0]
+    return f"{client_name}: {data}".encode()
+
+
+def binary_path(datagram, session_ids, room_id):
+    kind, _, session, _, payload = parse_frame(datagram)
+    if session != session_ids[CLIENT_ADDRESS]:
+        return None
+    return HEADER.pack(VERSION, protocol.DELIVER, room_id, session, 1, len(payload)) + payload
+
+
+def measure(function, *args):
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        function(*args)
+    return (time.perf_counter() - started) / ITERATIONS * 1e9
+
+
+def run(name, text):
+    connected_clients = {CLIENT_ADDRESS: (CLIENT_NAME, CLIENT_ADDRESS[0], CLIENT_ADDRESS[1])}
+    session_ids = {CLIENT_ADDRESS: SESSION}
+
+    # Датаграммы лежат в буфере приема, как на сервере: разбор идет по memoryview
+    text_datagram = memoryview(bytearray(text.encode()))
+    binary_datagram = memoryview(bytearray(pack_frame(protocol.MESSAGE, text.encode(), SESSION, 1)))
+
+    text_server = measure(text_path, text_datagram, connected_clients)
+    binary_server = measure(binary_path, binary_datagram, session_ids, 1)
+    # Клиент: сборка исходящего сообщения
+    text_client = measure(str.encode, text)
+    binary_client = measure(lambda: pack_frame(protocol.MESSAGE, text.encode(), SESSION, 1))
+
+    print(f"{name:<22} {len(text.encode()):>7} {text_server:>14.0f} {binary_server:>14.0f} "
+          f"{text_client:>14.0f} {binary_client:>14.0f}")
+
+
+def main():
+    print(f"{'сообщение':<22} {'байт':>7} {'сервер текст':>14} {'сервер двоич':>14} "
+          f"{'клиент текст':>14} {'клиент двоич':>14}   (нс на сообщение)")
+    run("короткое, латиница", "ok, see you at 5")
+    run("короткое, кириллица", "Привет! Как дела?")
+    run("абзац, кириллица", "Съешь же ещё этих мягких французских булок, да выпей чаю. " * 8)
+    run("4 КБ, кириллица", "Съешь же ещё этих мягких французских булок, да выпей чаю. " * 40)
+    run("16 КБ, латиница", "The quick brown fox jumps over the lazy dog. " * 364)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import random
+import string
+import sys
+import time
+
+from proxy_server import BlacklistMatcher
+
+# Микробенчмарк проверки черного списка: время одной проверки при росте списка.
+# Для сравнения измеряется и прежний линейный алгоритм (список + перебор префиксов)
+SIZES = (1_000, 10_000, 100_000, 500_000)
+LOOKUPS = 50_000
+LEGACY_MAX_SIZE = 10_000  # Линейный алгоритм на больших списках слишком медленный
+
+
+def random_label(rng, length):
+    return ''.join(rng.choices(string.ascii_lowercase, k=length))
+
+
+def generate_entries(rng, size):
+    entries = []
+    for i in range(size):
+        domain = f"{random_label(rng, 8)}.{random_label(rng, 6)}.com"
+        if i % 4 == 0:
+            entries.append(f"http://{domain}/{random_label(rng, 10)}")
+        else:
+            entries.append(domain)
+    return entries
+
+
+def generate_urls(rng, entries, count):
+    urls = []
+    for i in range(count):
+        if i % 2 == 0:
+            # Заблокированные: поддомен из списка или продолжение заблокированного URL
+            entry = rng.choice(entries)
+            if entry.startswith('http://'):
+                urls.append(f"{entry}/{random_label(rng, 5)}?q=1")
+            else:
+                urls.append(f"http://www.{entry}/{random_label(rng, 12)}")
+        else:
+            urls.append(f"http://{random_label(rng, 10)}.example.net/{random_label(rng, 12)}")
+    return urls
+
+
+# Прежняя реализация is_blacklisted для сравнения
+def legacy_is_blacklisted(url, blacklist):
+    from urllib.parse import urlparse
+
+    host = urlparse(url).netloc
+    if ':' in host:
+        host = host.split(':')[0]
+    if host in blacklist:
+        return True
+    for item in blacklist:
+        if item == url or (item.startswith('http') and url.startswith(item)):
+            return True
+    return False
+
+
+def measure(check, urls):
+    started = time.perf_counter()
+    for url in urls:
+        check(url)
+    return (time.perf_counter() - started) / len(urls) * 1e9
+
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    rng = random.Random(seed)
+
+    print(f"{'записей':>10} {'сборка, с':>10} {'проверка, нс':>14} {'линейно, нс':>14}")
+    for size in SIZES:
+        entries = generate_entries(rng, size)
+        urls = generate_urls(rng, entries, LOOKUPS)
+
+        started = time.perf_counter()
+        matcher = BlacklistMatcher(entries)
+        build_time = time.perf_counter() - started
+
+        indexed = measure(matcher.is_blocked, urls)
+
+        legacy = "-"
+        if size <= LEGACY_MAX_SIZE:
+            sample = urls[:max(1, LOOKUPS * 1_000 // size // 10)]
+            legacy = f"{measure(lambda url: legacy_is_blacklisted(url, entries), sample):.0f}"
+
+        print(f"{size:>10} {build_time:>10.2f} {indexed:>14.0f} {legacy:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+
+# Нагрузочный тест прокси-сервера. Запускает локальный сервер назначения с заданными
+# размерами ответов и задержкой, затем прокси в каждом из сравниваемых режимов, и нагружает
+# его клиентами с keep-alive и без. Результат: запросов в секунду, p50/p99/p999 задержки,
+# загрузка CPU и память (RSS) процессов прокси. Итог пишется в JSON для сравнения запусков
+#
+# Пример: python bench_load.py --modes threaded asyncio asyncio-x4 --sizes 1024 65536 --output results.json
+HOST = '127.0.0.1'
+ORIGIN_PORT = 9300
+PROXY_PORT = 9301
+STARTUP_TIMEOUT = 10  # Сколько ждать запуска прокси, с
+REQUEST_TIMEOUT = 10  # Таймаут одного запроса клиента, с
+SAMPLE_INTERVAL = 0.25  # Период опроса CPU и памяти прокси, с
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+# Сервер назначения: GET /<размер>?delay=<мс> возвращает тело указанного размера
+async def handle_origin(reader, writer, bodies):
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            target = head.split(b' ', 2)[1].decode()
+            path, _, query = target.partition('?')
+            size = int(path.rsplit('/', 1)[1] or 0)
+            delay = int(query.partition('delay=')[2] or 0) if 'delay=' in query else 0
+            keep_alive = b'connection: close' not in head.lower()
+
+            if delay:
+                await asyncio.sleep(delay / 1000)
+            body = bodies.get(size)
+            if body is None:
+                body = bodies[size] = b'x' * size
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                         b"Cache-Control: no-store\r\nContent-Length: " + str(size).encode() +
+                         (b"\r\n\r\n" if keep_alive else b"\r\nConnection: close\r\n\r\n"))
+            writer.write(body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_origin(port):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def serve():
+        bodies = {}
+        server = await asyncio.start_server(lambda r, w: handle_origin(r, w, bodies), HOST, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+# Один клиент: последовательные запросы до истечения времени теста
+async def client_loop(proxy, url, keep_alive, deadline, latencies, counters):
+    origin = url.split('/', 3)[2]
+    if proxy is None:
+        host, port = origin.split(':')
+        request_target = '/' + url.split('/', 3)[3]
+    else:
+        host, port = proxy
+        request_target = url
+    connection = "" if keep_alive else "Connection: close\r\n"
+    request = f"GET {request_target} HTTP/1.1\r\nHost: {origin}\r\n{connection}\r\n".encode()
+
+    writer = None
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), REQUEST_TIMEOUT)
+            writer.write(request)
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line[:15].lower() == b'content-length:':
+                    length = int(line[15:])
+            await asyncio.wait_for(reader.readexactly(length), REQUEST_TIMEOUT)
+            if not head.startswith(b'HTTP/1.1 200'):
+                raise ValueError(head.split(b'\r\n', 1)[0])
+            latencies.append(time.perf_counter() - started)
+            counters['bytes'] += length
+            if not keep_alive or b'connection: close' in head.lower():
+                writer.close()
+                writer = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            counters['errors'] += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+    if writer is not None:
+        writer.close()
+
+
+# Процесс нагрузки: concurrency клиентов в одном цикле событий
+def run_load(proxy, url, keep_alive, concurrency, duration, results):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    latencies = array('d')
+    counters = {'errors': 0, 'bytes': 0}
+
+    async def main():
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(client_loop(proxy, url, keep_alive, deadline, latencies, counters)
+                               for _ in range(concurrency)))
+
+    asyncio.run(main())
+    results.put((latencies.tobytes(), counters['errors'], counters['bytes']))
+
+
+# Процессы прокси: основной и его потомки (обработчики в режиме нескольких процессов)
+def process_tree(root_pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, ()))
+    return tree
+
+
+def sample_usage(root_pid):
+    """Суммарное процессорное время (с) и RSS (байт) дерева процессов"""
+    cpu, rss = 0.0, 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{pid}/statm') as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu, rss
+
+
+def wait_for_port(port, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Прокси завершился с кодом {process.returncode}")
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Порт {port} не открылся за {STARTUP_TIMEOUT} с")
+
+
+# Режим: threaded, asyncio, threaded-xN / asyncio-xN (N процессов) или direct (без прокси)
+def start_proxy(mode, blacklist_path, extra_args):
+    if mode == 'direct':
+        return None
+    proxy_mode, _, workers = mode.partition('-x')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy_server.py'),
+               '--mode', proxy_mode, '--host', HOST, '--port', str(PROXY_PORT),
+               '--blacklist', blacklist_path, '--no-cache', *extra_args]
+    if workers:
+        command += ['--workers', workers]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_proxy(process):
+    if process is None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(20)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_scenario(mode, size, keep_alive, options, blacklist_path):
+    process = start_proxy(mode, blacklist_path, options.proxy_args)
+    try:
+        if process is not None:
+            wait_for_port(PROXY_PORT, process)
+        proxy = None if process is None else (HOST, PROXY_PORT)
+        url = f"http://{HOST}:{ORIGIN_PORT}/{size}?delay={options.latency}"
+
+        # Прогрев: соединения пула, потоки и кэши интерпретатора
+        if options.warmup:
+            warmup = multiprocessing.Queue()
+            loader = multiprocessing.Process(target=run_load, args=(proxy, url, keep_alive,
+                                                                    min(options.concurrency, 8), options.warmup, warmup))
+            loader.start()
+            warmup.get()
+            loader.join()
+
+        results = multiprocessing.Queue()
+        per_process = -(-options.concurrency // options.load_processes)
+        loaders = [multiprocessing.Process(target=run_load,
+                                           args=(proxy, url, keep_alive, per_process, options.duration, results))
+                   for _ in range(options.load_processes)]
+
+        cpu_before, _ = sample_usage(process.pid) if process else (0.0, 0)
+        started = time.perf_counter()
+        for loader in loaders:
+            loader.start()
+
+        peak_rss = 0
+        collected = []
+        while len(collected) < len(loaders):
+            if process is not None:
+                peak_rss = max(peak_rss, sample_usage(process.pid)[1])
+            try:
+                collected.append(results.get(timeout=SAMPLE_INTERVAL))
+            except queue.Empty:
+                pass
+        elapsed = time.perf_counter() - started
+        cpu_after, _ = sample_usage(process.pid) if process else (0.0, 0)
+        for loader in loaders:
+            loader.join()
+    finally:
+        stop_proxy(process)
+
+    latencies = array('d')
+    errors = transferred = 0
+    for raw, process_errors, process_bytes in collected:
+        latencies.frombytes(raw)
+        errors += process_errors
+        transferred += process_bytes
+    ordered = sorted(latencies)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "mode": mode,
+        "size": size,
+        "keep_alive": keep_alive,
+        "concurrency": options.concurrency,
+        "latency_ms": options.latency,
+        "duration_s": round(elapsed, 3),
+        "requests": len(ordered),
+        "errors": errors,
+        "requests_per_s": round(len(ordered) / elapsed, 1),
+        "throughput_mb_s": round(transferred / elapsed / 1024 / 1024, 2),
+        "p50_ms": ms(percentile(ordered, 0.50)),
+        "p99_ms": ms(percentile(ordered, 0.99)),
+        "p999_ms": ms(percentile(ordered, 0.999)),
+        "max_ms": ms(ordered[-1] if ordered else None),
+        "proxy_cpu_percent": round((cpu_after - cpu_before) / elapsed * 100, 1) if process else None,
+        "proxy_peak_rss_mb": round(peak_rss / 1024 / 1024, 1) if process else None,
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест HTTP прокси-сервера")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"],
+                        help="режимы прокси: threaded, asyncio, threaded-xN, asyncio-xN (N процессов), direct")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1024, 65536], help="размеры ответов, байт")
+    parser.add_argument("--latency", type=int, default=0, help="задержка ответа сервера назначения, мс")
+    parser.add_argument("--keep-alive", choices=("on", "off", "both"), default="both",
+                        help="клиенты с keep-alive, без него или оба варианта")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных клиентов")
+    parser.add_argument("--load-processes", type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help="процессов, создающих нагрузку")
+    parser.add_argument("--duration", type=float, default=10, help="длительность каждого сценария, с")
+    parser.add_argument("--warmup", type=float, default=1, help="прогрев перед сценарием, с")
+    parser.add_argument("--proxy-args", nargs=argparse.REMAINDER, default=[],
+                        help="дополнительные аргументы proxy_server.py (указываются последними)")
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_arguments()
+    keep_alive_variants = {"on": [True], "off": [False], "both": [True, False]}[options.keep_alive]
+
+    origin = multiprocessing.Process(target=run_origin, args=(ORIGIN_PORT,), daemon=True)
+    origin.start()
+    wait_for_port(ORIGIN_PORT, None)
+
+    # Пустой черный список, чтобы результат не зависел от blacklist.conf
+    blacklist = tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False)
+    blacklist.write("[Blacklist]\n")
+    blacklist.close()
+
+    scenarios = []
+    try:
+        print(f"{'режим':<14} {'размер':>8} {'keep-alive':>10} {'запр/с':>9} {'p50, мс':>8} {'p99, мс':>8} "
+              f"{'p999, мс':>9} {'ошибок':>7} {'CPU, %':>7} {'RSS, МБ':>8}")
+        for mode in options.modes:
+            for size in options.sizes:
+                for keep_alive in keep_alive_variants:
+                    result = run_scenario(mode, size, keep_alive, options, blacklist.name)
+                    scenarios.append(result)
+                    print(f"{mode:<14} {size:>8} {'да' if keep_alive else 'нет':>10} "
+                          f"{result['requests_per_s']:>9} {result['p50_ms']!s:>8} {result['p99_ms']!s:>8} "
+                          f"{result['p999_ms']!s:>9} {result['errors']:>7} {result['proxy_cpu_percent']!s:>7} "
+                          f"{result['proxy_peak_rss_mb']!s:>8}")
+    finally:
+        os.unlink(blacklist.name)
+        origin.terminate()
+
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "settings": {key: value for key, value in vars(options).items() if key != "output"},
+        "scenarios": scenarios,
+    }
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {options.output}")
+
+
+if __name__ == "__main__":
+    main()
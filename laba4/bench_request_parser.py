@@ -0,0 +1,116 @@
+import re
+import time
+
+import proxy_server
+from proxy_server import Relay, body_framing, parse_request_head, recv_head, relay_body, split_target
+
+# Бенчмарк разбора и перезаписи запроса: прежний путь (чтение до "короткого" recv,
+# регулярное выражение, декодирование всего запроса и str.replace) против
+# инкрементального разбора заголовка с потоковой пересылкой тела
+ITERATIONS = 2_000
+BROWSER_HEADERS = (
+    "Host: example.com\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    "Accept-Language: ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3\r\n"
+    "Accept-Encoding: gzip, deflate\r\n"
+    "Proxy-Connection: keep-alive\r\n"
+    "Cookie: session=0123456789abcdef; theme=dark\r\n"
+)
+
+
+# Сокет в памяти: отдает данные порциями фиксированного размера, как сеть
+class MemorySocket:
+    def __init__(self, data, segment_size):
+        self.data = memoryview(data)
+        self.position = 0
+        self.segment_size = segment_size
+        self.sent = 0
+
+    def recv(self, size):
+        size = min(size, self.segment_size)
+        chunk = self.data[self.position:self.position + size].tobytes()
+        self.position += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer, size=0):
+        size = min(size or len(buffer), self.segment_size, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+    def gettimeout(self):
+        return None
+
+
+def legacy_path(client_socket, server_socket):
+    request_data = b''
+    while True:
+        chunk = client_socket.recv(proxy_server.BUFFER_SIZE)
+        request_data += chunk
+        if len(chunk) < proxy_server.BUFFER_SIZE or not chunk:
+            break
+
+    first_line = request_data.split(b'\n')[0].decode('utf-8', 'ignore')
+    method, url, version = re.match(r'(\w+)\s+(http://[^\s]+)\s+HTTP/(\d\.\d)', first_line).groups()
+    path = split_target(url)[2]
+    modified_request = request_data.decode('utf-8', 'ignore')
+    modified_request = modified_request.replace(f"{method} {url}", f"{method} {path}")
+    server_socket.sendall(modified_request.encode('utf-8'))
+    return len(request_data)
+
+
+def incremental_path(client_socket, server_socket, relay):
+    buffer = bytearray()
+    request = parse_request_head(recv_head(client_socket, buffer, relay))
+    path = split_target(request.target)[2]
+    server_socket.sendall(request.rewrite(path))
+    relay_body(client_socket, buffer, server_socket, body_framing(request.headers, is_request=True), relay)
+
+
+def run(name, request, segment_size):
+    # Пересылка через splice требует настоящих сокетов, поэтому здесь измеряется путь через буфер
+    proxy_server.SPLICE_SUPPORTED = False
+    relay = Relay()
+
+    legacy_sink = MemorySocket(b'', segment_size)
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        legacy_read = legacy_path(MemorySocket(request, segment_size), legacy_sink)
+    legacy_time = (time.perf_counter() - started) / ITERATIONS * 1e6
+
+    sink = MemorySocket(b'', segment_size)
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        incremental_path(MemorySocket(request, segment_size), sink, relay)
+    incremental_time = (time.perf_counter() - started) / ITERATIONS * 1e6
+
+    # Прежний путь теряет байты: обрывает чтение на коротком сегменте и выбрасывает
+    # байты тела, которые не декодируются как UTF-8
+    legacy_ok = legacy_read == len(request) and legacy_sink.sent // ITERATIONS >= sink.sent // ITERATIONS
+    print(f"{name:<28} {len(request):>9} {legacy_time:>12.1f} {incremental_time:>12.1f} "
+          f"{'да' if legacy_ok else 'нет':>14}")
+
+
+def main():
+    get_request = f"GET http://example.com/index.html?page=1 HTTP/1.1\r\n{BROWSER_HEADERS}\r\n".encode()
+    binary_body = bytes(range(256)) * 256
+    post_request = (f"POST http://example.com/upload HTTP/1.1\r\n{BROWSER_HEADERS}"
+                    f"Content-Type: application/octet-stream\r\nContent-Length: {len(binary_body)}\r\n\r\n"
+                    ).encode() + binary_body
+    large_body = binary_body * 16
+    large_request = (f"POST http://example.com/upload HTTP/1.1\r\n{BROWSER_HEADERS}"
+                     f"Content-Length: {len(large_body)}\r\n\r\n").encode() + large_body
+
+    print(f"{'запрос':<28} {'байт':>9} {'прежний, мкс':>12} {'новый, мкс':>12} {'прежний цел?':>14}")
+    run("GET, один сегмент", get_request, 65536)
+    run("GET, сегменты по 100 байт", get_request, 100)
+    run("POST 64 КБ двоичных данных", post_request, 65536)
+    run("POST 1 МБ двоичных данных", large_request, 65536)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,86 @@ import socket
 import sys
 import threading
 import re
-import configparser
-from urllib.parse import urlparse
+import argparse
+import asyncio
+import select
+import bisect
+import ipaddress
+import concurrent.futures
+import signal
+import queue
+import multiprocessing
+import selectors
+import errno
+import time
+import os
+import json
+import struct
+import hashlib
+import email.utils
+from collections import deque, OrderedDict
 
 # Настройки прокси
 PROXY_HOST = '127.0.0.1'  # Адрес прокси-сервера
 PROXY_PORT = 8080  # Порт прокси-сервера
 BUFFER_SIZE = 8192  # Размер буфера для приема данных
 TIMEOUT = 10  # Таймаут для сокетов
+MAX_CONNECTIONS = 1000  # Максимум одновременно обслуживаемых клиентских соединений
+MAX_CONNECTIONS_PER_IP = 256  # Максимум одновременных соединений с одного IP-адреса
+LISTEN_BACKLOG = 1024  # Очередь установленных, но еще не принятых соединений
+ADMISSION_SWEEP_INTERVAL = 60  # Период удаления состояний неактивных клиентов, с
+MAX_HEAD_SIZE = 65536  # Максимальный размер заголовков HTTP-сообщения
+CLIENT_IDLE_TIMEOUT = 30  # Сколько keep-alive соединение клиента ждет следующего запроса
+
+# Пересылка тел сообщений
+SPLICE_SUPPORTED = hasattr(os, 'splice')  # os.splice есть только в Linux (Python 3.10+)
+SPLICE_MIN_SIZE = 64 * 1024  # Меньшие тела выгоднее копировать через буфер
+SPLICE_CHUNK_SIZE = 64 * 1024  # Не больше емкости pipe по умолчанию
+ASYNC_CHUNK_SIZE = 64 * 1024  # Порция чтения в asyncio-режиме (совпадает с лимитом буфера StreamReader)
+
+# Настройки пула соединений с серверами назначения
+POOL_MAX_IDLE = 256  # Всего простаивающих соединений
+POOL_MAX_PER_HOST = 8  # Простаивающих соединений на один (host, port)
+POOL_IDLE_TIMEOUT = 60  # Время жизни простаивающего соединения, с
+
+# Настройки кэша DNS
+DNS_POSITIVE_TTL = 60  # Время жизни разрешенного имени, с (getaddrinfo не сообщает TTL записи)
+DNS_NEGATIVE_TTL = 10  # Время жизни ошибки разрешения имени, с
+DNS_CACHE_SIZE = 4096  # Имен в кэше
+DNS_WORKERS = 8  # Потоков для одновременных поисков разных имен
+
+BLACKLIST_PATH = "blacklist.conf"  # Файл черного списка
+BLACKLIST_RELOAD_INTERVAL = 2  # Период проверки файла черного списка на изменения, с
+
+# Метрики и журнал доступа
+METRICS_PATH = "/metrics"  # Путь метрик на порту прокси (запрос к самому прокси, не к серверу)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Границы корзин, с
+ACCESS_LOG_QUEUE_SIZE = 10000  # Записей в очереди журнала; сверх этого записи отбрасываются
+ACCESS_LOG_BATCH = 256  # Записей за один вызов write
+ACCESS_LOG_CLOSE_TIMEOUT = 5  # Сколько при завершении ждать записи хвоста журнала, с
+
+# Настройки режима нескольких процессов
+DRAIN_TIMEOUT = 10  # Сколько при завершении ждать окончания начатых запросов, с
+STATS_INTERVAL = 2  # Период отправки статистики супервизору, с
+WORKER_RESTART_DELAY = 1  # Минимальное время между перезапусками процесса-обработчика, с
+
+# Настройки туннелей CONNECT
+TUNNEL_CHUNK_SIZE = 8 * 1024  # Порция пересылки; на туннель не больше двух таких порций в памяти
+TUNNEL_MEMORY_BUDGET = 512 * 1024 * 1024  # Память под данные туннелей, байт
+MAX_TUNNELS = TUNNEL_MEMORY_BUDGET // (2 * TUNNEL_CHUNK_SIZE)  # 32768 туннелей
+TUNNEL_IDLE_TIMEOUT = 300  # Туннель без трафика в обе стороны закрывается, с
+
+# Настройки кэша ответов
+CACHE_DIR = "cache"  # Каталог дискового уровня кэша
+CACHE_MEMORY_LIMIT = 64 * 1024 * 1024  # Объем тел ответов в памяти, байт
+CACHE_DISK_LIMIT = 1024 * 1024 * 1024  # Объем тел ответов на диске, байт
+CACHE_MAX_OBJECT_SIZE = 16 * 1024 * 1024  # Ответы больше этого размера не кэшируются
+CACHE_HEURISTIC_LIMIT = 24 * 60 * 60  # Верхняя граница эвристической свежести, с
+CACHEABLE_STATUS_CODES = {200, 203, 204, 300, 301, 404, 405, 410, 414, 501}
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS', 'TRACE'}
+
+# Hop-by-hop заголовки, которые прокси не передает дальше
+HOP_BY_HOP_HEADERS = {'connection', 'proxy-connection', 'keep-alive'}
 
 # Страница блокировки для черного списка
 BLOCKED_PAGE_TEMPLATE = """
@@ -42,198 +114,2920 @@ Connection: close
 """
 
 
+# Префиксное дерево (radix trie) для URL из черного списка.
+# Ребра подписаны строками, поэтому число узлов пропорционально числу записей
+class PrefixTrie:
+    __slots__ = ('children', 'terminal')
+
+    def __init__(self):
+        self.children = {}  # первый символ ребра -> (метка ребра, узел)
+        self.terminal = False
+
+    def insert(self, key):
+        node = self
+        while True:
+            if node.terminal:
+                return  # Более короткий префикс уже блокирует все продолжения
+            if not key:
+                node.terminal = True
+                node.children = {}
+                return
+
+            edge = node.children.get(key[0])
+            if edge is None:
+                leaf = PrefixTrie()
+                leaf.terminal = True
+                node.children[key[0]] = (key, leaf)
+                return
+
+            label, child = edge
+            common = 1
+            limit = min(len(label), len(key))
+            while common < limit and label[common] == key[common]:
+                common += 1
+
+            if common < len(label):
+                # Разбиваем ребро на общую часть и остаток
+                middle = PrefixTrie()
+                middle.children[label[common]] = (label[common:], child)
+                node.children[key[0]] = (label[:common], middle)
+                child = middle
+
+            node = child
+            key = key[common:]
+
+    def matches_prefix_of(self, text):
+        """Есть ли в дереве строка, являющаяся префиксом text"""
+        node = self
+        position = 0
+        while not node.terminal:
+            if position >= len(text):
+                return False
+            edge = node.children.get(text[position])
+            if edge is None or not text.startswith(edge[0], position):
+                return False
+            position += len(edge[0])
+            node = edge[1]
+        return True
+
+
+# Скомпилированный черный список: множество доменов (блокируются и все поддомены)
+# и префиксное дерево полных URL. Время проверки не зависит от размера списка
+class BlacklistMatcher:
+    def __init__(self, entries=()):
+        self.domains = set()
+        self.urls = PrefixTrie()
+        self.size = 0
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        entry = entry.strip()
+        if not entry:
+            return
+        if entry.startswith(('http://', 'https://')):
+            self.urls.insert(normalize_url(entry))
+        else:
+            # "*.badsite.com" и "badsite.com" означают одно и то же: домен вместе с поддоменами
+            self.domains.add(entry.lower().lstrip('*.').rstrip('.'))
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def is_blocked(self, url):
+        url = normalize_url(url)
+        host = url_host(url)
+        if host and self.domains:
+            # Проверяем сам хост и все его родительские домены: sub.badsite.com -> badsite.com -> com
+            while True:
+                if host in self.domains:
+                    return True
+                dot = host.find('.')
+                if dot < 0:
+                    break
+                host = host[dot + 1:]
+        return self.urls.matches_prefix_of(url)
+
+
+# Схема и хост URL не зависят от регистра, путь сохраняется как есть
+def normalize_url(url):
+    scheme_end = url.find('://')
+    if scheme_end < 0:
+        return url
+    host_end = len(url)
+    for delimiter in '/?#':
+        position = url.find(delimiter, scheme_end + 3)
+        if 0 <= position < host_end:
+            host_end = position
+    return url[:host_end].lower() + url[host_end:]
+
+
+# Хост из абсолютного URL без учетных данных и порта
+def url_host(url):
+    start = url.find('://')
+    start = start + 3 if start >= 0 else 0
+    end = len(url)
+    for delimiter in '/?#':
+        position = url.find(delimiter, start)
+        if 0 <= position < end:
+            end = position
+    host = url[start:end].rpartition('@')[2]
+    if host.startswith('['):
+        return host[1:host.find(']')]
+    return host.partition(':')[0].rstrip('.')
+
+
+# Чтение файла черного списка: секция [Blacklist], строки вида "элемент = true".
+# URL сами содержат ':' и '=', поэтому разделителем считается последний '=' в строке
+def read_blacklist_entries(config_path):
+    entries = []
+    in_section = False
+    with open(config_path, encoding='utf-8') as config_file:
+        for line in config_file:
+            line = line.strip()
+            if not line or line[0] in ';#':
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                in_section = line[1:-1].strip() == 'Blacklist'
+                continue
+            if not in_section:
+                continue
+
+            key, separator, value = line.rpartition('=')
+            if not separator:
+                key, separator, value = line.rpartition(':')
+            if separator and value.strip().lower() == 'true':
+                entries.append(key.strip())
+    return entries
+
+
 # Загрузка черного списка из конфигурационного файла
-def load_blacklist(config_path="blacklist.conf"):
-    blacklist = []
+def load_blacklist(config_path=BLACKLIST_PATH):
     try:
-        config = configparser.ConfigParser()
-        config.read(config_path)
-
-        if 'Blacklist' in config:
-            for key, value in config['Blacklist'].items():
-                if value.lower() == 'true':
-                    blacklist.append(key)
+        return BlacklistMatcher(read_blacklist_entries(config_path))
     except Exception as e:
         print(f"Ошибка при загрузке черного списка: {e}")
-
-    return blacklist
+        return BlacklistMatcher()
 
 
 # Проверка, находится ли URL в черном списке
 def is_blacklisted(url, blacklist):
     if not blacklist:
         return False
+    return blacklist.is_blocked(url)
 
-    parsed_url = urlparse(url)
-    host = parsed_url.netloc
 
-    # Удаляем порт из хоста, если он есть
-    if ':' in host:
-        host = host.split(':')[0]
+# Черный список, который перечитывается при изменении файла.
+# Новый список собирается целиком и подменяется одной операцией присваивания,
+# поэтому обрабатываемые запросы не прерываются и не видят частично загруженных данных
+class ReloadingBlacklist:
+    def __init__(self, config_path=BLACKLIST_PATH, interval=BLACKLIST_RELOAD_INTERVAL):
+        self.config_path = config_path
+        self.interval = interval
+        self.signature = self._file_signature()
+        self.matcher = load_blacklist(config_path)
+        self.reloads = 0
 
-    # Проверяем домен
-    if host in blacklist:
-        return True
+    def __len__(self):
+        return len(self.matcher)
 
-    # Проверяем полный URL
-    for item in blacklist:
-        if item == url or (item.startswith('http') and url.startswith(item)):
-            return True
+    def is_blocked(self, url):
+        return self.matcher.is_blocked(url)
 
-    return False
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
 
+    def check(self):
+        """Перезагружает список, если файл изменился"""
+        signature = self._file_signature()
+        if signature is not None and signature != self.signature:
+            self.reload(signature)
 
-# Обработка клиентского соединения
-def handle_client(client_socket, client_addr, blacklist):
-    try:
-        # Получаем запрос от клиента
-        request_data = b''
+    def reload(self, signature=None):
+        signature = signature or self._file_signature()
+        try:
+            matcher = BlacklistMatcher(read_blacklist_entries(self.config_path))
+        except Exception as e:
+            # При ошибке продолжаем работать со старым списком
+            print(f"Ошибка при перезагрузке черного списка: {e}")
+            return
+        self.matcher = matcher
+        self.signature = signature
+        self.reloads += 1
+        print(f"Черный список перезагружен: {len(matcher)} элементов")
+
+    def start(self):
+        watcher = threading.Thread(target=self._watch, daemon=True)
+        watcher.start()
+
+    def _watch(self):
         while True:
-            chunk = client_socket.recv(BUFFER_SIZE)
-            request_data += chunk
-            if len(chunk) < BUFFER_SIZE or not chunk:
-                break
+            time.sleep(self.interval)
+            self.check()
 
-        if not request_data:
-            client_socket.close()
-            return
 
-        # Парсим первую строку HTTP-запроса
-        first_line = request_data.split(b'\n')[0].decode('utf-8', 'ignore')
+# Сведения об одном обслуженном запросе для журнала доступа и метрик
+class AccessRecord:
+    __slots__ = ('started', 'client', 'method', 'url', 'status', 'reason', 'note', 'bytes_in', 'bytes_out',
+                 'ttfb', 'error')
+
+    def __init__(self, client, method, url, bytes_in=0):
+        self.started = time.monotonic()
+        self.client = client
+        self.method = method
+        self.url = url
+        self.status = 0  # 0 - ответ клиенту не отправлен
+        self.reason = ""
+        self.note = None  # Пометка для журнала: Cache HIT, Blacklisted и т.п.
+        self.bytes_in = bytes_in  # Получено от клиента (заголовок и тело запроса)
+        self.bytes_out = 0  # Отправлено клиенту
+        self.ttfb = None  # Время до первого байта ответа сервера назначения, с
+        self.error = None
+
+    def respond(self, status, reason, bytes_out, note=None):
+        self.status = status
+        self.reason = reason
+        self.bytes_out += bytes_out
+        self.note = note
+
+
+# Гистограмма с фиксированными границами корзин (как histogram в Prometheus)
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Последняя корзина - больше всех границ
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        plain = f'{{{labels.rstrip(",")}}}' if labels else ""
+        lines.append(f'{name}_sum{plain} {self.total:.6f}')
+        lines.append(f'{name}_count{plain} {self.count}')
+        return lines
+
+
+# Метрики запросов, отдаются по METRICS_PATH в текстовом формате Prometheus
+class ProxyMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ttfb = Histogram()
+        self.duration = Histogram()
+        self.responses = {}  # код ответа -> число ответов
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blacklist_hits = 0
+        self.upstream_errors = 0
+
+    def observe(self, record, duration):
+        with self.lock:
+            self.requests += 1
+            self.responses[record.status] = self.responses.get(record.status, 0) + 1
+            self.bytes_in += record.bytes_in
+            self.bytes_out += record.bytes_out
+            self.duration.observe(duration)
+            if record.ttfb is not None:
+                self.ttfb.observe(record.ttfb)
+            if record.note == "Blacklisted":
+                self.blacklist_hits += 1
+            if record.status == 502:
+                self.upstream_errors += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "blacklist_hits": self.blacklist_hits,
+                "upstream_errors": self.upstream_errors,
+            }
+
+    def render(self, context):
+        # В режиме нескольких процессов каждый обработчик отдает свои метрики с меткой worker
+        labels = f'worker="{context.worker_id}",' if context.worker_id is not None else ""
+        plain = f"{{{labels.rstrip(',')}}}" if labels else ""
+        with context.lock:
+            active_connections = context.active_connections
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        with self.lock:
+            metric("proxy_requests_total", "counter", "Requests served, by response status",
+                   [f'proxy_requests_total{{{labels}code="{code}"}} {count}'
+                    for code, count in sorted(self.responses.items())])
+            metric("proxy_upstream_ttfb_seconds", "histogram", "Time to first upstream response byte",
+                   self.ttfb.render("proxy_upstream_ttfb_seconds", labels))
+            metric("proxy_request_duration_seconds", "histogram", "Total request handling time",
+                   self.duration.render("proxy_request_duration_seconds", labels))
+            metric("proxy_received_bytes_total", "counter", "Bytes received from clients",
+                   [f"proxy_received_bytes_total{plain} {self.bytes_in}"])
+            metric("proxy_sent_bytes_total", "counter", "Bytes sent to clients",
+                   [f"proxy_sent_bytes_total{plain} {self.bytes_out}"])
+            metric("proxy_blacklist_hits_total", "counter", "Requests rejected by the blacklist",
+                   [f"proxy_blacklist_hits_total{plain} {self.blacklist_hits}"])
+            metric("proxy_upstream_errors_total", "counter", "Failed upstream connections and exchanges",
+                   [f"proxy_upstream_errors_total{plain} {self.upstream_errors}"])
+        metric("proxy_active_connections", "gauge", "Open client connections",
+               [f"proxy_active_connections{plain} {active_connections}"])
+        metric("proxy_active_tunnels", "gauge", "Open CONNECT tunnels",
+               [f"proxy_active_tunnels{plain} {context.tunnels.stats()['active']}"])
+        admission = context.admission.stats()
+        metric("proxy_shed_total", "counter", "Connections and requests rejected by admission control",
+               [f'proxy_shed_total{{{labels}reason="{reason}"}} {admission[key]}'
+                for reason, key in (("connections", "rejected_connections"), ("per_ip", "rejected_per_ip"),
+                                    ("request_rate", "limited_requests"), ("byte_rate", "limited_bytes"))])
+        metric("proxy_access_log_dropped_total", "counter", "Access log records dropped on a full queue",
+               [f"proxy_access_log_dropped_total{plain} {context.access_log.dropped}"])
+        return ("\n".join(lines) + "\n").encode()
 
-        # Проверяем, является ли запрос CONNECT-запросом
-        connect_match = re.match(r'CONNECT\s+([^\s:]+):(\d+)\s+HTTP/(\d\.\d)', first_line)
-        if connect_match:
-            # Отправляем сообщение, что HTTPS не поддерживается
-            error_response = "HTTP/1.1 501 Not Implemented\r\nContent-Type: text/html\r\n\r\n<h1>501 Not Implemented</h1><p>HTTPS connections are not supported</p>"
-            client_socket.send(error_response.encode('utf-8'))
-            print(f"HTTPS-соединение отклонено: {first_line}")
-            client_socket.close()
-            return
 
-        # Обработка обычных HTTP-запросов как раньше
-        url_match = re.match(r'(\w+)\s+(http://[^\s]+)\s+HTTP/(\d\.\d)', first_line)
+def metrics_response(context):
+    body = context.metrics.render(context)
+    return (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
 
-        if not url_match:
-            print(f"Некорректный формат запроса: {first_line}")
-            client_socket.close()
+
+# Журнал доступа с отдельным потоком записи. Запросы только кладут запись в ограниченную
+# очередь; при переполнении запись отбрасывается, поэтому медленный диск не задерживает ответы.
+# Без файла журнал выводится на консоль в прежнем текстовом виде, с файлом - в JSON по строке на запрос
+class AccessLog:
+    def __init__(self, path=None, max_queue=ACCESS_LOG_QUEUE_SIZE):
+        self.path = path
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.writer = None
+
+    def start(self):
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def log(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Дописывает оставшиеся записи и останавливает поток записи"""
+        if self.writer is None:
+            return
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
             return
+        self.writer.join(ACCESS_LOG_CLOSE_TIMEOUT)
+
+    def _write(self):
+        if self.path is None:
+            fd, format_record = sys.stdout.fileno(), format_access_text
+        elif self.path == "-":
+            fd, format_record = sys.stdout.fileno(), format_access_json
+        else:
+            # O_APPEND: записи нескольких процессов-обработчиков не перезаписывают друг друга
+            fd, format_record = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644), format_access_json
+
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < ACCESS_LOG_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+            # Пачка записывается одним вызовом write, чтобы строки разных процессов не перемешивались
+            data = "".join(format_record(record) for record in batch).encode()
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+            except OSError as e:
+                print(f"Ошибка записи журнала доступа: {e}", file=sys.stderr)
+
+
+def format_access_text(record):
+    if record["method"] == 'CONNECT':
+        return (f"CONNECT {record['url']} - {record['status']} {record['reason']}"
+                f"{' (' + record['note'] + ')' if record['note'] else ''}: "
+                f"отправлено {record['bytes_in']} Б, получено {record['bytes_out']} Б\n")
+    note = record['note'] or record['error']
+    return f"{record['url']} - {record['status']} {record['reason']}{' (' + note + ')' if note else ''}\n"
+
+
+def format_access_json(record):
+    return json.dumps(record, ensure_ascii=False) + "\n"
 
-        method, url, version = url_match.groups()
 
-        # Проверка на черный список
-        if is_blacklisted(url, blacklist):
-            blocked_page = BLOCKED_PAGE_TEMPLATE.format(url=url).encode('utf-8')
-            client_socket.send(blocked_page)
-            print(f"{url} - 403 Forbidden (Blacklisted)")
-            client_socket.close()
+# Состояние одного IP-адреса клиента: число соединений и два маркерных ведра (token bucket)
+class ClientState:
+    __slots__ = ('connections', 'request_tokens', 'byte_tokens', 'updated')
+
+    def __init__(self, request_tokens, byte_tokens, now):
+        self.connections = 0
+        self.request_tokens = request_tokens
+        self.byte_tokens = byte_tokens
+        self.updated = now
+
+
+# Контроль допуска: общий лимит соединений, лимит соединений с одного IP и ограничение
+# частоты запросов и объема трафика по IP. Отказ отправляется сразу, до подключения к серверу.
+# Трафик учитывается после ответа: ведро байтов уходит в минус, и следующие запросы
+# отклоняются, пока оно не восстановится
+class AdmissionControl:
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_ip=MAX_CONNECTIONS_PER_IP,
+                 request_rate=0, request_burst=0, byte_rate=0, byte_burst=0):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.request_rate = request_rate  # Запросов в секунду на IP, 0 - без ограничения
+        self.request_burst = request_burst or max(1, request_rate)
+        self.byte_rate = byte_rate  # Байт в секунду на IP, 0 - без ограничения
+        self.byte_burst = byte_burst or byte_rate
+        self.lock = threading.Lock()
+        self.clients = {}  # IP -> ClientState
+        self.connections = 0
+        self.next_sweep = time.monotonic() + ADMISSION_SWEEP_INTERVAL
+
+        self.rejected_connections = 0  # Общий лимит соединений
+        self.rejected_per_ip = 0  # Лимит соединений с одного IP
+        self.limited_requests = 0  # Превышена частота запросов
+        self.limited_bytes = 0  # Превышен объем трафика
+
+    def _client(self, ip, now):
+        state = self.clients.get(ip)
+        if state is None:
+            state = self.clients[ip] = ClientState(self.request_burst, self.byte_burst, now)
+            return state
+        elapsed = now - state.updated
+        state.updated = now
+        if self.request_rate:
+            state.request_tokens = min(self.request_burst, state.request_tokens + elapsed * self.request_rate)
+        if self.byte_rate:
+            state.byte_tokens = min(self.byte_burst, state.byte_tokens + elapsed * self.byte_rate)
+        return state
+
+    def admit(self, ip):
+        """Регистрирует новое соединение; возвращает ответ с отказом или None, если соединение принято"""
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            if self.connections >= self.max_connections:
+                self.rejected_connections += 1
+                return OVERLOADED_RESPONSE
+            state = self._client(ip, now)
+            if state.connections >= self.max_per_ip:
+                self.rejected_per_ip += 1
+                return TOO_MANY_REQUESTS_RESPONSE
+            state.connections += 1
+            self.connections += 1
+            return None
+
+    def release(self, ip):
+        with self.lock:
+            self.connections -= 1
+            state = self.clients.get(ip)
+            if state is not None:
+                state.connections -= 1
+
+    def allow_request(self, ip):
+        """Снимает маркер запроса; False, если клиент превысил частоту запросов или объем трафика"""
+        if not self.request_rate and not self.byte_rate:
+            return True
+        with self.lock:
+            state = self._client(ip, time.monotonic())
+            if self.byte_rate and state.byte_tokens <= 0:
+                self.limited_bytes += 1
+                return False
+            if self.request_rate:
+                if state.request_tokens < 1:
+                    self.limited_requests += 1
+                    return False
+                state.request_tokens -= 1
+            return True
+
+    def consume_bytes(self, ip, size):
+        if not self.byte_rate:
             return
+        with self.lock:
+            state = self._client(ip, time.monotonic())
+            state.byte_tokens -= size
+
+    def _sweep(self, now):
+        # Клиенты без соединений, чьи ведра уже полны, ничем не отличаются от новых
+        self.next_sweep = now + ADMISSION_SWEEP_INTERVAL
+        for ip in [ip for ip, state in self.clients.items()
+                   if not state.connections and now - state.updated >= ADMISSION_SWEEP_INTERVAL
+                   and self._client(ip, now).request_tokens >= self.request_burst
+                   and state.byte_tokens >= self.byte_burst]:
+            del self.clients[ip]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rejected_connections": self.rejected_connections,
+                "rejected_per_ip": self.rejected_per_ip,
+                "limited_requests": self.limited_requests,
+                "limited_bytes": self.limited_bytes,
+                "clients": len(self.clients),
+            }
+
+
+# Быстрый отказ в соединении из цикла приема: без потока обработчика и без ожидания записи
+def reject_connection(client_socket, response):
+    try:
+        client_socket.setblocking(False)
+        client_socket.send(response)
+        client_socket.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+
+# Общие объекты прокси-сервера, разделяемые всеми соединениями
+class ProxyContext:
+    def __init__(self, blacklist, pool, cache=None, max_tunnels=MAX_TUNNELS, tunnel_idle_timeout=TUNNEL_IDLE_TIMEOUT,
+                 resolver=None, access_log=None, admission=None):
+        self.blacklist = blacklist
+        self.pool = pool
+        self.resolver = resolver or DnsResolver()
+        self.cache = cache  # None, если кэширование отключено
+        self.tunnels = TunnelStats()
+        self.max_tunnels = max_tunnels
+        self.tunnel_idle_timeout = tunnel_idle_timeout
+        self.tunnel_relay = None  # Поток пересылки туннелей (только в потоковом режиме)
+        self.worker_id = None  # Номер процесса-обработчика в режиме нескольких процессов
+        self.draining = False  # Сервер завершается: keep-alive соединения закрываются после ответа
+        self.lock = threading.Lock()
+        self.active_connections = 0
+        self.accepted_connections = 0
+        self.metrics = ProxyMetrics()
+        self.access_log = access_log or AccessLog()
+        self.admission = admission or AdmissionControl()
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+            self.accepted_connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+
+    def finish_request(self, record):
+        """Учитывает запрос в метриках и передает запись потоку журнала доступа"""
+        duration = time.monotonic() - record.started
+        self.metrics.observe(record, duration)
+        if record.client:
+            self.admission.consume_bytes(record.client[0], record.bytes_in + record.bytes_out)
+        self.access_log.log({
+            "time": round(time.time(), 3),
+            "worker": self.worker_id,
+            "client": f"{record.client[0]}:{record.client[1]}" if record.client else None,
+            "method": record.method,
+            "url": record.url,
+            "status": record.status,
+            "reason": record.reason,
+            "note": record.note,
+            "bytes_in": record.bytes_in,
+            "bytes_out": record.bytes_out,
+            "ttfb_ms": round(record.ttfb * 1000, 3) if record.ttfb is not None else None,
+            "duration_ms": round(duration * 1000, 3),
+            "error": record.error,
+        })
+
 
-        # Парсим URL
-        parsed_url = urlparse(url)
-        protocol = parsed_url.scheme
-        host = parsed_url.netloc
-        path = parsed_url.path
+# Системное разрешение имени: список (семейство, адрес) для TCP-подключения
+def system_resolve(host):
+    return [(family, sockaddr[0])
+            for family, _, _, _, sockaddr in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)]
 
-        if not path:
-            path = "/"
 
-        if parsed_url.query:
-            path += "?" + parsed_url.query
+# Кэширующий резолвер адресов серверов назначения.
+# Успешные ответы хранятся DNS_POSITIVE_TTL, ошибки - DNS_NEGATIVE_TTL. Одновременные запросы
+# одного имени объединяются в один поиск (single-flight), сам поиск выполняется в отдельных
+# потоках, поэтому asyncio-режим не блокирует цикл событий. Функцию разрешения можно подменить
+class DnsResolver:
+    def __init__(self, resolve=system_resolve, positive_ttl=DNS_POSITIVE_TTL, negative_ttl=DNS_NEGATIVE_TTL,
+                 max_entries=DNS_CACHE_SIZE, workers=DNS_WORKERS):
+        self.resolve_function = resolve
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="dns")
+        self.entries = OrderedDict()  # имя -> (время истечения, адреса или исключение)
+        self.pending = {}  # имя -> Future выполняющегося поиска
+        self.lock = threading.Lock()
 
-        # Определяем порт
-        if ':' in host:
-            host, port = host.split(':')
-            port = int(port)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.lookup_time_total = 0.0
+
+    def lookup(self, host):
+        """Возвращает Future с адресами; поиск запускается, только если имени нет в кэше"""
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
         else:
-            port = 80  # Стандартный HTTP-порт
+            future = concurrent.futures.Future()
+            future.set_result([(socket.AF_INET6 if ':' in host else socket.AF_INET, host)])
+            return future
 
-        # Создаем соединение с целевым сервером
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.settimeout(TIMEOUT)
+        host = host.lower()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(host)
+                future = concurrent.futures.Future()
+                if isinstance(entry[1], Exception):
+                    self.negative_hits += 1
+                    future.set_exception(entry[1])
+                else:
+                    self.hits += 1
+                    future.set_result(entry[1])
+                return future
+
+            future = self.pending.get(host)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            self.misses += 1
+            future = self.executor.submit(self._resolve, host)
+            self.pending[host] = future
+            return future
 
+    def resolve(self, host):
+        return self.lookup(host).result()
+
+    async def resolve_async(self, host):
+        return await asyncio.wrap_future(self.lookup(host))
+
+    def _resolve(self, host):
+        started = time.monotonic()
         try:
-            server_socket.connect((host, port))
+            addresses = self.resolve_function(host)
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME, f"Нет адресов для {host}")
+        except OSError as e:
+            self._store(host, e, self.negative_ttl, started)
+            raise
+        self._store(host, addresses, self.positive_ttl, started)
+        return addresses
 
-            # Модифицируем запрос для сервера назначения (меняем полный URL на путь)
-            modified_request = request_data.decode('utf-8', 'ignore')
-            modified_request = modified_request.replace(f"{method} {url}", f"{method} {path}")
+    def _store(self, host, result, ttl, started):
+        now = time.monotonic()
+        with self.lock:
+            self.lookup_time_total += now - started
+            self.pending.pop(host, None)
+            self.entries[host] = (now + ttl, result)
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
-            # Отправляем модифицированный запрос серверу
-            server_socket.send(modified_request.encode('utf-8'))
+    def invalidate(self, host):
+        with self.lock:
+            self.entries.pop(host.lower(), None)
 
-            # Получаем ответ от сервера
-            response_data = b''
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_ratio": (self.hits + self.negative_hits + self.coalesced) / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "lookup_ms": self.lookup_time_total * 1000,
+            }
 
-            # Получаем заголовки
-            while True:
-                chunk = server_socket.recv(BUFFER_SIZE)
-                if not chunk:
-                    break
 
-                response_data += chunk
-                client_socket.send(chunk)
-
-                # Анализируем код ответа после получения первого чанка
-                if len(response_data) > 0 and b"HTTP/" in response_data:
-                    status_line = response_data.split(b'\n')[0].decode('utf-8', 'ignore')
-                    status_match = re.search(r'HTTP/\d\.\d (\d+) ([^\r\n]+)', status_line)
-                    if status_match:
-                        status_code = status_match.group(1)
-                        status_message = status_match.group(2)
-                        print(f"{url} - {status_code} {status_message}")
-
-        except socket.error as e:
-            print(f"Ошибка при подключении к {host}:{port}: {e}")
-            error_response = f"HTTP/1.1 502 Bad Gateway\r\nContent-Type: text/html\r\n\r\n<h1>502 Bad Gateway</h1><p>Error connecting to {host}:{port}</p>"
-            client_socket.send(error_response.encode('utf-8'))
-        finally:
-            server_socket.close()
+# Подключение к серверу по адресам из резолвера: адреса перебираются по порядку,
+# как в socket.create_connection
+def connect_upstream(resolver, host, port, timeout=TIMEOUT):
+    error = None
+    for family, address in resolver.resolve(host):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect((address, port))
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
 
-    except Exception as e:
-        print(f"Ошибка при обработке запроса: {e}")
-    finally:
-        client_socket.close()
+
+async def connect_upstream_async(resolver, host, port, limit=ASYNC_CHUNK_SIZE):
+    error = None
+    for family, address in await resolver.resolve_async(host):
+        try:
+            return await asyncio.open_connection(address, port, family=family, limit=limit)
+        except OSError as e:
+            error = e
+    raise error
 
 
-# Основная функция прокси-сервера
-def run_proxy_server():
+# Соединение с сервером назначения (потоковый режим)
+class UpstreamConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()  # Данные, прочитанные из сокета, но еще не разобранные
+
+    def is_alive(self):
+        """Простаивающее соединение живо, если сервер ничего не прислал и не закрыл его"""
+        if self.buffer:
+            return False
+        try:
+            poller = select.poll()
+            poller.register(self.sock, select.POLLIN)
+            return not poller.poll(0)
+        except (OSError, ValueError):
+            return False
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# Соединение с сервером назначения (asyncio-режим)
+class AsyncUpstreamConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def is_alive(self):
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+# Пул простаивающих keep-alive соединений с серверами назначения по ключу (host, port)
+class UpstreamPool:
+    def __init__(self, max_idle=POOL_MAX_IDLE, max_per_host=POOL_MAX_PER_HOST, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # (host, port) -> deque[(соединение, время возврата в пул)]
+        self.idle_count = 0
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connects = 0
+        self.connect_time_total = 0.0
+
+    def acquire(self, key):
+        """Возвращает живое простаивающее соединение или None, если его нужно открыть"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.idle.get(key)
+            while bucket:
+                conn, released_at = bucket.pop()  # Самое "теплое" соединение
+                self.idle_count -= 1
+                if now - released_at <= self.idle_timeout and conn.is_alive():
+                    self.hits += 1
+                    return conn
+                conn.close()
+                self.evictions += 1
+
+            if bucket is not None:
+                del self.idle[key]
+            self.misses += 1
+            return None
+
+    def release(self, key, conn):
+        """Возвращает соединение в пул; лишние соединения закрываются"""
+        now = time.monotonic()
+        with self.lock:
+            self._sweep_expired(now)
+            bucket = self.idle.setdefault(key, deque())
+            if len(bucket) >= self.max_per_host or self.idle_count >= self.max_idle:
+                if not bucket:
+                    del self.idle[key]
+                conn.close()
+                self.evictions += 1
+                return
+
+            bucket.append((conn, now))
+            self.idle_count += 1
+
+    def record_connect(self, seconds):
+        with self.lock:
+            self.connects += 1
+            self.connect_time_total += seconds
+
+    def _sweep_expired(self, now):
+        # Просроченные соединения удаляются не чаще раза в секунду
+        if now - self.last_sweep < 1.0:
+            return
+        self.last_sweep = now
+
+        for key in list(self.idle):
+            bucket = self.idle[key]
+            while bucket and now - bucket[0][1] > self.idle_timeout:
+                conn, _ = bucket.popleft()
+                conn.close()
+                self.idle_count -= 1
+                self.evictions += 1
+            if not bucket:
+                del self.idle[key]
+
+    def close_all(self):
+        with self.lock:
+            for bucket in self.idle.values():
+                for conn, _ in bucket:
+                    conn.close()
+            self.idle.clear()
+            self.idle_count = 0
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            avg_connect = self.connect_time_total / self.connects if self.connects else 0.0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "idle": self.idle_count,
+                "evictions": self.evictions,
+                "avg_connect_ms": avg_connect * 1000,
+                # Каждое попадание экономит в среднем одно установление TCP-соединения
+                "saved_connect_ms": self.hits * avg_connect * 1000,
+            }
+
+
+# Запись кэша: сохраненный ответ сервера. Тело хранится либо в памяти (body),
+# либо в файле дискового уровня (path, body_offset)
+class CacheEntry:
+    __slots__ = ('key', 'url', 'status_line', 'headers', 'body', 'body_size', 'path', 'body_offset',
+                 'request_time', 'response_time', 'date_value', 'age_value', 'freshness_lifetime')
+
+    def __init__(self, key, url, status_line, headers, body, body_size, request_time, response_time):
+        self.key = key
+        self.url = url
+        self.status_line = status_line
+        self.headers = headers
+        self.body = body
+        self.body_size = body_size
+        self.path = None
+        self.body_offset = 0
+        self.request_time = request_time
+        self.response_time = response_time
+        self.date_value = parse_http_date(get_header(headers, 'date')) or response_time
+        try:
+            self.age_value = max(0, int(get_header(headers, 'age') or 0))
+        except ValueError:
+            self.age_value = 0
+        self.freshness_lifetime = freshness_lifetime(headers, self.date_value)
+
+    def current_age(self, now):
+        apparent_age = max(0.0, self.response_time - self.date_value)
+        corrected_age = self.age_value + (self.response_time - self.request_time)
+        return max(apparent_age, corrected_age) + (now - self.response_time)
+
+    def has_validators(self):
+        return get_header(self.headers, 'etag') is not None or get_header(self.headers, 'last-modified') is not None
+
+    def metadata(self):
+        return {
+            "key": self.key, "url": self.url, "status_line": self.status_line, "headers": self.headers,
+            "body_size": self.body_size, "request_time": self.request_time, "response_time": self.response_time,
+        }
+
+
+# Накопитель тела ответа для кэша; слишком большие ответы не сохраняются
+class CacheSink:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.parts = []
+        self.size = 0
+        self.overflow = False
+
+    def __call__(self, data):
+        if self.overflow:
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.overflow = True
+            self.parts = []
+            return
+        self.parts.append(bytes(data))
+
+    def body(self):
+        return b''.join(self.parts)
+
+
+def parse_http_date(value):
+    if not value:
+        return None
     try:
-        # Загружаем черный список
-        blacklist = load_blacklist()
-        if blacklist:
-            print(f"Загружен черный список из {len(blacklist)} элементов")
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
 
-        # Создаем сокет сервера
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((PROXY_HOST, PROXY_PORT))
-        server_socket.listen(100)
 
-        print(f"HTTP прокси-сервер запущен на {PROXY_HOST}:{PROXY_PORT}")
+def parse_cache_control(headers):
+    directives = {}
+    for name, value in headers:
+        if name.lower() == 'cache-control':
+            for part in value.split(','):
+                directive, _, argument = part.strip().partition('=')
+                if directive:
+                    directives[directive.lower()] = argument.strip('"')
+    return directives
 
-        # Основной цикл прокси-сервера
-        while True:
+
+# Время свежести ответа в секундах (s-maxage, max-age, Expires или эвристика по Last-Modified)
+def freshness_lifetime(headers, date_value):
+    cache_control = parse_cache_control(headers)
+    if 'no-cache' in cache_control:
+        return 0
+
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cache_control:
             try:
-                client_socket, client_addr = server_socket.accept()
-                client_thread = threading.Thread(
-                    target=handle_client,
-                    args=(client_socket, client_addr, blacklist)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-            except KeyboardInterrupt:
-                break
-            except Exception as e:
-                print(f"Ошибка при обработке соединения: {e}")
+                return max(0, int(cache_control[directive]))
+            except ValueError:
+                return 0
 
-    except Exception as e:
-        print(f"Ошибка при запуске прокси-сервера: {e}")
-    finally:
-        print("Завершение работы прокси-сервера")
-        server_socket.close()
-        sys.exit(0)
+    expires = get_header(headers, 'expires')
+    if expires is not None:
+        expires_value = parse_http_date(expires)
+        return max(0.0, expires_value - date_value) if expires_value else 0
+
+    last_modified = parse_http_date(get_header(headers, 'last-modified'))
+    if last_modified:
+        return min(CACHE_HEURISTIC_LIMIT, max(0.0, (date_value - last_modified) * 0.1))
+    return 0
+
+
+def vary_names(headers):
+    names = []
+    for name, value in headers:
+        if name.lower() == 'vary':
+            names.extend(token.strip().lower() for token in value.split(',') if token.strip())
+    return tuple(sorted(set(names)))
+
+
+def has_conditional_headers(headers):
+    return any(name.lower() in ('if-none-match', 'if-modified-since') for name, _ in headers)
+
+
+# Условные заголовки для проверки устаревшей записи у сервера
+def conditional_headers(entry):
+    conditional = []
+    etag = get_header(entry.headers, 'etag')
+    if etag is not None:
+        conditional.append(('If-None-Match', etag))
+    last_modified = get_header(entry.headers, 'last-modified')
+    if last_modified is not None:
+        conditional.append(('If-Modified-Since', last_modified))
+    return conditional
+
+
+# Кэш ответов: LRU-уровень в памяти, ограниченный по байтам, вытесняет записи на диск
+class ResponseCache:
+    def __init__(self, cache_dir=CACHE_DIR, memory_limit=CACHE_MEMORY_LIMIT, disk_limit=CACHE_DISK_LIMIT,
+                 max_object_size=CACHE_MAX_OBJECT_SIZE):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.max_object_size = max_object_size
+
+        self.memory = OrderedDict()  # ключ -> CacheEntry с телом в памяти
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # ключ -> CacheEntry с телом в файле
+        self.disk_bytes = 0
+        self.vary = {}  # url -> имена заголовков из Vary
+        self.variants = {}  # url -> ключи всех вариантов ответа
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stores = 0
+        self.bytes_saved = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_disk_index()
+
+    def variant_key(self, url, request_headers):
+        names = self.vary.get(url, ())
+        if not names:
+            return url
+        values = [f"{name}={' '.join((get_header(request_headers, name) or '').split())}" for name in names]
+        return url + '\0' + '\0'.join(values)
+
+    def lookup(self, url, request_headers):
+        with self.lock:
+            key = self.variant_key(url, request_headers)
+            for tier in (self.memory, self.disk):
+                entry = tier.get(key)
+                if entry is not None:
+                    tier.move_to_end(key)
+                    return entry
+            return None
+
+    def open_body(self, entry):
+        """Тело записи: bytes из памяти или открытый файл; None, если файл уже вытеснен"""
+        if entry.body is not None:
+            return entry.body
+        try:
+            return open(entry.path, 'rb')
+        except OSError:
+            return None
+
+    def is_fresh(self, entry, request_headers, now=None):
+        now = time.time() if now is None else now
+        request_cache_control = parse_cache_control(request_headers)
+        pragma = (get_header(request_headers, 'pragma') or '').lower()
+        if 'no-cache' in request_cache_control or 'no-cache' in pragma:
+            return False
+
+        age = entry.current_age(now)
+        if 'max-age' in request_cache_control:
+            try:
+                if age > int(request_cache_control['max-age']):
+                    return False
+            except ValueError:
+                return False
+        return age < entry.freshness_lifetime
+
+    def is_cacheable(self, method, status_code, request_headers, response_headers):
+        if method != 'GET' or status_code not in CACHEABLE_STATUS_CODES:
+            return False
+
+        request_cache_control = parse_cache_control(request_headers)
+        cache_control = parse_cache_control(response_headers)
+        if 'no-store' in request_cache_control or 'no-store' in cache_control or 'private' in cache_control:
+            return False
+        if '*' in vary_names(response_headers):
+            return False
+        if get_header(request_headers, 'authorization') is not None and \
+                'public' not in cache_control and 's-maxage' not in cache_control:
+            return False
+
+        # Без срока свежести ответ имеет смысл хранить, только если его можно проверить у сервера
+        date_value = parse_http_date(get_header(response_headers, 'date')) or time.time()
+        return freshness_lifetime(response_headers, date_value) > 0 or \
+            get_header(response_headers, 'etag') is not None or \
+            get_header(response_headers, 'last-modified') is not None
+
+    def store(self, url, request_headers, status_line, response_headers, body, request_time, response_time):
+        stored_headers = [(name, value) for name, value in response_headers
+                          if name.lower() not in ('transfer-encoding', 'content-length')]
+        with self.lock:
+            self.vary[url] = vary_names(response_headers)
+            key = self.variant_key(url, request_headers)
+            entry = CacheEntry(key, url, status_line, stored_headers, body, len(body), request_time, response_time)
+            self._remove(key)
+            self.variants.setdefault(url, set()).add(key)
+            self.memory[key] = entry
+            self.memory_bytes += entry.body_size
+            self.stores += 1
+            spilled = self._evict_memory()
+
+        for spilled_entry in spilled:
+            self._spill(spilled_entry)
+
+    def refresh(self, entry, response_headers, request_time, response_time):
+        """Обновление записи после ответа 304 Not Modified; возвращает новую запись"""
+        updated_names = {name.lower() for name, _ in response_headers} - {'content-length', 'transfer-encoding'}
+        headers = [(name, value) for name, value in entry.headers if name.lower() not in updated_names]
+        headers.extend((name, value) for name, value in response_headers if name.lower() in updated_names)
+
+        refreshed = CacheEntry(entry.key, entry.url, entry.status_line, headers, entry.body, entry.body_size,
+                               request_time, response_time)
+        refreshed.path = entry.path
+        refreshed.body_offset = entry.body_offset
+
+        with self.lock:
+            for tier in (self.memory, self.disk):
+                if tier.get(entry.key) is entry:
+                    tier[entry.key] = refreshed
+                    tier.move_to_end(entry.key)
+        return refreshed
+
+    def invalidate(self, url):
+        with self.lock:
+            for key in self.variants.pop(url, ()):
+                self._remove(key)
+            self.vary.pop(url, None)
+
+    def record_hit(self, entry, revalidated=False):
+        with self.lock:
+            if revalidated:
+                self.revalidated += 1
+            else:
+                self.hits += 1
+            self.bytes_saved += entry.body_size
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.revalidated + self.misses
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "stores": self.stores,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+            }
+
+    def _remove(self, key):
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry.body_size
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_bytes -= entry.body_size
+            self._unlink(entry.path)
+
+    def _evict_memory(self):
+        spilled = []
+        while self.memory_bytes > self.memory_limit and self.memory:
+            _, entry = self.memory.popitem(last=False)
+            self.memory_bytes -= entry.body_size
+            spilled.append(entry)
+        return spilled
+
+    def _spill(self, entry):
+        # Запись файла выполняется вне блокировки, чтобы не задерживать другие соединения
+        if entry.body_size > self.disk_limit:
+            return
+        path = os.path.join(self.cache_dir, hashlib.sha256(entry.key.encode('utf-8')).hexdigest() + '.cache')
+        metadata = json.dumps(entry.metadata()).encode('utf-8')
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(struct.pack('!I', len(metadata)))
+                cache_file.write(metadata)
+                cache_file.write(entry.body)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Ошибка записи в дисковый кэш: {e}")
+            self._unlink(temp_path)
+            return
+
+        disk_entry = CacheEntry(entry.key, entry.url, entry.status_line, entry.headers, None, entry.body_size,
+                                entry.request_time, entry.response_time)
+        disk_entry.path = path
+        disk_entry.body_offset = 4 + len(metadata)
+
+        with self.lock:
+            # Пока файл записывался, запись могли обновить или удалить
+            if entry.key in self.memory or entry.key not in self.variants.get(entry.url, ()):
+                self._unlink(path)
+                return
+            self._remove(entry.key)
+            self.disk[entry.key] = disk_entry
+            self.disk_bytes += disk_entry.body_size
+            while self.disk_bytes > self.disk_limit and self.disk:
+                _, evicted = self.disk.popitem(last=False)
+                self.disk_bytes -= evicted.body_size
+                self.variants.get(evicted.url, set()).discard(evicted.key)
+                self._unlink(evicted.path)
+
+    def _load_disk_index(self):
+        # Восстановление дискового уровня после перезапуска: читаются только метаданные
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            if file_name.endswith('.tmp'):
+                self._unlink(path)
+                continue
+            if not file_name.endswith('.cache'):
+                continue
+            try:
+                with open(path, 'rb') as cache_file:
+                    metadata_size, = struct.unpack('!I', cache_file.read(4))
+                    metadata = json.loads(cache_file.read(metadata_size))
+                entry = CacheEntry(metadata["key"], metadata["url"], metadata["status_line"],
+                                   [tuple(header) for header in metadata["headers"]], None, metadata["body_size"],
+                                   metadata["request_time"], metadata["response_time"])
+                entry.path = path
+                entry.body_offset = 4 + metadata_size
+                entries.append((os.path.getmtime(path), entry))
+            except (OSError, ValueError, KeyError, struct.error):
+                self._unlink(path)
+
+        for _, entry in sorted(entries, key=lambda item: item[0]):
+            self.disk[entry.key] = entry
+            self.disk_bytes += entry.body_size
+            self.variants.setdefault(entry.url, set()).add(entry.key)
+            self.vary[entry.url] = vary_names(entry.headers)
+
+        while self.disk_bytes > self.disk_limit and self.disk:
+            _, evicted = self.disk.popitem(last=False)
+            self.disk_bytes -= evicted.body_size
+            self.variants.get(evicted.url, set()).discard(evicted.key)
+            self._unlink(evicted.path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# Заголовок ответа из кэша: тело отдается целиком, поэтому длина известна заранее
+def build_cached_head(entry, keep_alive):
+    headers = [(name, value) for name, value in entry.headers if name.lower() != 'age']
+    headers.append(('Content-Length', str(entry.body_size)))
+    headers.append(('Age', str(int(entry.current_age(time.time())))))
+    return build_head(entry.status_line, headers, keep_alive)
+
+
+# Разобранный заголовок HTTP-запроса. Хранит исходные байты и смещения строк заголовков,
+# поэтому при пересылке меняется только строка запроса, а остальные байты копируются как есть
+class RequestHead:
+    __slots__ = ('raw', 'method', 'target', 'version', 'headers', 'fields', 'fields_start')
+
+    def __init__(self, raw, method, target, version, headers, fields, fields_start):
+        self.raw = raw
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # [(имя, значение)] с исходным регистром имен
+        self.fields = fields  # [(имя в нижнем регистре, значение, начало строки, конец строки)]
+        self.fields_start = fields_start
+
+    @property
+    def first_line(self):
+        return self.raw[:self.fields_start - 2].decode('latin-1')
+
+    def get(self, name):
+        name = name.lower()
+        for field_name, value, _, _ in self.fields:
+            if field_name == name:
+                return value
+        return None
+
+    def rewrite(self, target, extra_headers=()):
+        """Заголовок для сервера назначения: новая строка запроса, исходные строки заголовков
+        без hop-by-hop полей и дополнительные заголовки"""
+        dropped = set(HOP_BY_HOP_HEADERS)
+        for field_name, value, _, _ in self.fields:
+            if field_name in ('connection', 'proxy-connection'):
+                dropped.update(token.strip().lower() for token in value.split(','))
+
+        raw = memoryview(self.raw)
+        parts = [f"{self.method} {target} HTTP/{self.version}\r\n".encode('latin-1')]
+        position = self.fields_start
+        for field_name, _, line_start, line_end in self.fields:
+            if field_name in dropped:
+                parts.append(raw[position:line_start])
+                position = line_end
+        parts.append(raw[position:len(self.raw) - 2])
+        for name, value in extra_headers:
+            parts.append(f"{name}: {value}\r\n".encode('latin-1'))
+        parts.append(b"Connection: keep-alive\r\n\r\n")
+        return b''.join(parts)
+
+
+# Разбор заголовка запроса (только заголовка, тело не декодируется). latin-1 сохраняет
+# байты один к одному, поэтому смещения в строке совпадают со смещениями в raw.
+# None - запрос некорректен
+def parse_request_head(raw):
+    lines = raw.decode('latin-1').split('\r\n')
+    request_line = lines[0].split(' ')
+    if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+        return None
+    method, target, version = request_line
+    if not method.isalpha() or not target:
+        return None
+
+    headers = []
+    fields = []
+    fields_start = position = len(lines[0]) + 2
+    for line in lines[1:-2]:  # Заголовок заканчивается на \r\n\r\n, последние две строки пустые
+        end = position + len(line) + 2
+        name, separator, value = line.partition(':')
+        if separator and name:
+            name = name.strip()
+            value = value.strip()
+            headers.append((name, value))
+            fields.append((name.lower(), value, position, end))
+        position = end
+
+    return RequestHead(raw, method, target, version[5:], headers, fields, fields_start)
+
+
+# Разбор заголовка HTTP-сообщения на первую строку и список заголовков
+def parse_head(head):
+    lines = head.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        name, separator, value = line.partition(':')
+        if separator:
+            headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+def get_header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def connection_tokens(headers):
+    tokens = set()
+    for key, value in headers:
+        if key.lower() in ('connection', 'proxy-connection'):
+            tokens.update(token.strip().lower() for token in value.split(','))
+    return tokens
+
+
+# Определяет, хочет ли сторона сохранить соединение после сообщения
+def wants_keep_alive(version, headers):
+    tokens = connection_tokens(headers)
+    if 'close' in tokens:
+        return False
+    if version == '1.1':
+        return True
+    return 'keep-alive' in tokens
+
+
+# Способ определения конца тела сообщения: ('length', n), ('chunked', None) или ('close', None)
+def body_framing(headers, is_request=False, has_body=True):
+    if not has_body:
+        return 'length', 0
+
+    transfer_encoding = get_header(headers, 'transfer-encoding')
+    if transfer_encoding and 'chunked' in transfer_encoding.lower():
+        return 'chunked', None
+
+    content_length = get_header(headers, 'content-length')
+    if content_length is not None:
+        return 'length', int(content_length)
+
+    # Запрос без длины не имеет тела, ответ без длины читается до закрытия соединения
+    return ('length', 0) if is_request else ('close', None)
+
+
+# Сборка заголовка без hop-by-hop полей и с нужным значением Connection
+def build_head(first_line, headers, keep_alive):
+    dropped = HOP_BY_HOP_HEADERS | connection_tokens(headers)
+    lines = [first_line]
+    for name, value in headers:
+        if name.lower() not in dropped:
+            lines.append(f"{name}: {value}")
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def parse_status_line(status_line):
+    status_match = re.match(r'HTTP/(\d\.\d) (\d+) ?([^\r\n]*)', status_line)
+    if not status_match:
+        raise ValueError(f"Некорректная строка статуса: {status_line}")
+    version, status_code, status_message = status_match.groups()
+    return version, int(status_code), status_message
+
+
+def response_has_body(method, status_code):
+    return method != 'HEAD' and status_code not in (204, 304) and not 100 <= status_code < 200
+
+
+# Буферы пересылки одного клиентского соединения: переиспользуемый буфер для recv_into
+# и канал (pipe) для os.splice, через который тело передается без копирования в Python
+class Relay:
+    def __init__(self):
+        self.scratch = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.scratch)
+        self.pipe = None
+
+    def recv_into_buffer(self, sock, buffer):
+        received = sock.recv_into(self.view)
+        if received:
+            buffer += self.view[:received]
+        return received
+
+    def copy(self, source, destination, length, sink=None):
+        """Пересылка length байт тела (None - до закрытия соединения источником); возвращает число байт"""
+        copied = 0
+        if sink is None and SPLICE_SUPPORTED and (length is None or length >= SPLICE_MIN_SIZE):
+            length, copied = self._splice(source, destination, length)
+            if length == 0:
+                return copied
+
+        view = self.view
+        while length is None or length > 0:
+            received = source.recv_into(view, BUFFER_SIZE if length is None else min(BUFFER_SIZE, length))
+            if not received:
+                if length is None:
+                    return copied
+                raise ConnectionError("Соединение закрыто до конца тела сообщения")
+            chunk = view[:received]
+            destination.sendall(chunk)
+            if sink is not None:
+                sink(chunk)
+            copied += received
+            if length is not None:
+                length -= received
+        return copied
+
+    def _splice(self, source, destination, length):
+        # Данные идут сокет -> pipe -> сокет внутри ядра. Сокеты с таймаутом неблокирующие,
+        # поэтому при EAGAIN ждем готовности через poll. Возвращает оставшуюся длину и число переданных байт
+        copied = 0
+        if self.pipe is None:
+            self.pipe = os.pipe()
+        pipe_read, pipe_write = self.pipe
+        source_fd, destination_fd = source.fileno(), destination.fileno()
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+        while length is None or length > 0:
+            size = SPLICE_CHUNK_SIZE if length is None else min(SPLICE_CHUNK_SIZE, length)
+            try:
+                moved = os.splice(source_fd, pipe_write, size, flags=flags)
+            except BlockingIOError:
+                wait_socket(source, select.POLLIN)
+                continue
+            except OSError as e:
+                if e.errno == errno.EINVAL:
+                    return length, copied  # Ядро не поддерживает splice для этих дескрипторов
+                raise
+            if moved == 0:
+                if length is None:
+                    return 0, copied
+                raise ConnectionError("Соединение закрыто до конца тела сообщения")
+
+            # Канал опустошается полностью, поэтому запись в него никогда не блокируется
+            pending = moved
+            while pending:
+                try:
+                    pending -= os.splice(pipe_read, destination_fd, pending, flags=flags)
+                except BlockingIOError:
+                    wait_socket(destination, select.POLLOUT)
+
+            copied += moved
+            if length is not None:
+                length -= moved
+        return 0, copied
+
+    def close(self):
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+
+# Ожидание готовности сокета; poll, в отличие от select, не ограничен дескрипторами < 1024
+def wait_socket(sock, events, timeout=None):
+    if timeout is None:
+        timeout = sock.gettimeout() or TIMEOUT
+    poller = select.poll()
+    poller.register(sock, events)
+    if not poller.poll(timeout * 1000):
+        raise socket.timeout("Превышено время ожидания сокета")
+
+
+# Чтение из сокета до конца заголовка (\r\n\r\n); остаток данных остается в буфере
+def recv_head(sock, buffer, relay):
+    return _recv_until(sock, buffer, b'\r\n\r\n', MAX_HEAD_SIZE, relay)
+
+
+def _recv_until(sock, buffer, delimiter, limit, relay):
+    start = 0
+    while True:
+        end = buffer.find(delimiter, start)
+        if end >= 0:
+            end += len(delimiter)
+            data = bytes(buffer[:end])
+            del buffer[:end]
+            return data
+
+        if len(buffer) > limit:
+            raise ValueError("Слишком длинный заголовок HTTP-сообщения")
+
+        start = max(0, len(buffer) - len(delimiter) + 1)
+        if not relay.recv_into_buffer(sock, buffer):
+            return None
+
+
+# Пересылка тела сообщения в соответствии с его границами: заголовок разобран один раз,
+# тело идет фиксированными порциями, поэтому память не зависит от размера ответа.
+# sink получает данные тела без chunked-разметки (используется кэшем); возвращает число отправленных байт
+def relay_body(source, buffer, destination, framing, relay, sink=None):
+    kind, length = framing
+    if kind == 'length':
+        _relay_exact(source, buffer, destination, length, relay, sink)
+        return length
+    elif kind == 'chunked':
+        sent = 0
+        while True:
+            size_line = _recv_until(source, buffer, b'\r\n', MAX_HEAD_SIZE, relay)
+            if size_line is None:
+                raise ConnectionError("Соединение закрыто посреди chunked-тела")
+            destination.sendall(size_line)
+            sent += len(size_line)
+
+            chunk_size = int(size_line.split(b';')[0].strip(), 16)
+            if chunk_size == 0:
+                # Завершающие заголовки (trailer) до пустой строки
+                while size_line != b'\r\n':
+                    size_line = _recv_until(source, buffer, b'\r\n', MAX_HEAD_SIZE, relay)
+                    if size_line is None:
+                        raise ConnectionError("Соединение закрыто посреди chunked-тела")
+                    destination.sendall(size_line)
+                    sent += len(size_line)
+                return sent
+            _relay_exact(source, buffer, destination, chunk_size, relay, sink)
+            _relay_exact(source, buffer, destination, 2, relay)
+            sent += chunk_size + 2
+    else:
+        sent = len(buffer)
+        if buffer:
+            destination.sendall(buffer)
+            if sink is not None:
+                sink(buffer)
+            buffer.clear()
+        return sent + relay.copy(source, destination, None, sink)
+
+
+def _relay_exact(source, buffer, destination, length, relay, sink=None):
+    # Сначала отправляются данные, уже прочитанные вместе с заголовком
+    if buffer and length > 0:
+        part = bytes(buffer[:length])
+        del buffer[:length]
+        destination.sendall(part)
+        if sink is not None:
+            sink(part)
+        length -= len(part)
+
+    if length > 0:
+        relay.copy(source, destination, length, sink)
+
+
+# Счетчики туннелей CONNECT (общие для всех режимов)
+class TunnelStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.opened = 0
+        self.rejected = 0
+        self.idle_timeouts = 0
+        self.bytes_up = 0  # Клиент -> сервер
+        self.bytes_down = 0  # Сервер -> клиент
+
+    def try_open(self, max_tunnels):
+        with self.lock:
+            if self.active >= max_tunnels:
+                self.rejected += 1
+                return False
+            self.active += 1
+            self.opened += 1
+            return True
+
+    def close(self, bytes_up, bytes_down, idle_timeout=False):
+        with self.lock:
+            self.active -= 1
+            self.bytes_up += bytes_up
+            self.bytes_down += bytes_down
+            if idle_timeout:
+                self.idle_timeouts += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "active": self.active,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "idle_timeouts": self.idle_timeouts,
+                "bytes_up": self.bytes_up,
+                "bytes_down": self.bytes_down,
+            }
+
+
+# Один конец туннеля. pending - данные, которые не удалось сразу записать в этот сокет
+class TunnelEnd:
+    __slots__ = ('sock', 'tunnel', 'peer', 'pending', 'eof', 'events')
+
+    def __init__(self, sock, tunnel):
+        self.sock = sock
+        self.tunnel = tunnel
+        self.peer = None
+        self.pending = None
+        self.eof = False  # Из сокета прочитан конец потока
+        self.events = 0
+
+
+class Tunnel:
+    __slots__ = ('target', 'client', 'upstream', 'bytes_up', 'bytes_down', 'last_activity', 'record')
+
+    def __init__(self, target, client_sock, upstream_sock, record=None):
+        self.target = target
+        self.record = record  # Запись журнала доступа, дополняется при закрытии туннеля
+        self.client = TunnelEnd(client_sock, self)
+        self.upstream = TunnelEnd(upstream_sock, self)
+        self.client.peer = self.upstream
+        self.upstream.peer = self.client
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.last_activity = time.monotonic()
+
+
+# Пересылка данных всех туннелей CONNECT в одном потоке с селектором (epoll в Linux).
+# Чтение идет в общий буфер; копируется только хвост, который сокет-получатель не принял,
+# и пока он не отправлен, из источника больше не читаем. Поэтому на туннель приходится
+# не больше двух порций TUNNEL_CHUNK_SIZE, а общий объем ограничен числом туннелей
+class TunnelRelay:
+    def __init__(self, stats, max_tunnels=MAX_TUNNELS, idle_timeout=TUNNEL_IDLE_TIMEOUT, on_close=None):
+        self.stats = stats
+        self.on_close = on_close  # Вызывается с записью журнала закрытого туннеля
+        self.max_tunnels = max_tunnels
+        self.idle_timeout = idle_timeout
+        self.selector = selectors.DefaultSelector()
+        self.buffer = bytearray(TUNNEL_CHUNK_SIZE)
+        self.view = memoryview(self.buffer)
+        self.tunnels = set()
+        self.incoming = deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, None)
+
+    def start(self):
+        relay_thread = threading.Thread(target=self.run, daemon=True)
+        relay_thread.start()
+
+    def add(self, record, client_sock, upstream_sock, initial_data=b''):
+        """Передает сокеты потоку пересылки; False, если лимит туннелей исчерпан"""
+        if not self.stats.try_open(self.max_tunnels):
+            return False
+        client_sock.setblocking(False)
+        upstream_sock.setblocking(False)
+        tunnel = Tunnel(record.url, client_sock, upstream_sock, record)
+        if initial_data:
+            # Клиент мог отправить начало TLS-рукопожатия сразу за запросом CONNECT
+            tunnel.upstream.pending = bytes(initial_data)
+            tunnel.bytes_up = len(initial_data)
+        self.incoming.append(tunnel)
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            pass  # Поток уже разбужен
+        return True
+
+    def run(self):
+        next_sweep = time.monotonic() + 1.0
+        while True:
+            for selector_key, events in self.selector.select(timeout=1.0):
+                end = selector_key.data
+                if end is None:
+                    self._accept_incoming()
+                    continue
+                if end.tunnel not in self.tunnels:
+                    continue  # Туннель закрыт при обработке другого события
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        self._flush(end)
+                    if events & selectors.EVENT_READ and end.tunnel in self.tunnels:
+                        self._forward(end)
+                except OSError:
+                    self._close(end.tunnel)
+
+            now = time.monotonic()
+            if now >= next_sweep:
+                next_sweep = now + 1.0
+                for tunnel in [t for t in self.tunnels if now - t.last_activity > self.idle_timeout]:
+                    self._close(tunnel, idle_timeout=True)
+
+    def _accept_incoming(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.incoming:
+            tunnel = self.incoming.popleft()
+            self.tunnels.add(tunnel)
+            self._update(tunnel.client)
+            self._update(tunnel.upstream)
+
+    def _forward(self, end):
+        # Чтение из end.sock и немедленная попытка записи в сокет на другой стороне
+        peer = end.peer
+        try:
+            received = end.sock.recv_into(self.view)
+        except BlockingIOError:
+            return
+
+        tunnel = end.tunnel
+        tunnel.last_activity = time.monotonic()
+        if not received:
+            end.eof = True
+            if peer.pending is None:
+                self._shutdown_write(peer)
+        else:
+            if end is tunnel.client:
+                tunnel.bytes_up += received
+            else:
+                tunnel.bytes_down += received
+            try:
+                sent = peer.sock.send(self.view[:received])
+            except BlockingIOError:
+                sent = 0
+            if sent < received:
+                peer.pending = bytes(self.view[sent:received])
+
+        if end.eof and peer.eof and end.pending is None and peer.pending is None:
+            self._close(tunnel)
+            return
+        self._update(end)
+        self._update(peer)
+
+    def _flush(self, end):
+        try:
+            sent = end.sock.send(end.pending)
+        except BlockingIOError:
+            return
+        end.tunnel.last_activity = time.monotonic()
+        end.pending = end.pending[sent:] if sent < len(end.pending) else None
+        if end.pending is None and end.peer.eof:
+            self._shutdown_write(end)
+            if end.eof:
+                self._close(end.tunnel)
+                return
+        self._update(end)
+        self._update(end.peer)
+
+    @staticmethod
+    def _shutdown_write(end):
+        # Half-close: другая сторона закончила передачу, сообщаем об этом дальше
+        try:
+            end.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def _update(self, end):
+        events = 0
+        if not end.eof and end.peer.pending is None:
+            events |= selectors.EVENT_READ
+        if end.pending is not None:
+            events |= selectors.EVENT_WRITE
+
+        if events == end.events:
+            return
+        if not end.events:
+            self.selector.register(end.sock, events, end)
+        elif not events:
+            self.selector.unregister(end.sock)
+        else:
+            self.selector.modify(end.sock, events, end)
+        end.events = events
+
+    def _close(self, tunnel, idle_timeout=False):
+        self.tunnels.discard(tunnel)
+        for end in (tunnel.client, tunnel.upstream):
+            if end.events:
+                self.selector.unregister(end.sock)
+                end.events = 0
+            end.sock.close()
+        self.stats.close(tunnel.bytes_up, tunnel.bytes_down, idle_timeout)
+        record = tunnel.record
+        if record is not None and self.on_close is not None:
+            record.bytes_in += tunnel.bytes_up
+            record.bytes_out += tunnel.bytes_down
+            record.note = "закрыт по таймауту" if idle_timeout else None
+            self.on_close(record)
+
+
+# Разбор цели CONNECT (host:port) и проверка по черному списку
+def parse_connect_target(target):
+    host, separator, port = target.rpartition(':')
+    if not separator or not port.isdigit():
+        return None
+    return host.strip('[]'), int(port)
+
+
+def forbidden_response(url):
+    return BLOCKED_PAGE_TEMPLATE.format(url=url).encode('utf-8')
+
+
+CONNECT_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+SERVICE_UNAVAILABLE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n"
+                       b"<h1>503 Service Unavailable</h1><p>Too many tunnels</p>")
+OVERLOADED_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n"
+                       b"Connection: close\r\n\r\n")
+TOO_MANY_REQUESTS_RESPONSE = (b"HTTP/1.1 429 Too Many Requests\r\nRetry-After: 1\r\nContent-Length: 0\r\n"
+                              b"Connection: close\r\n\r\n")
+
+
+# Открытие туннеля CONNECT в потоковом режиме: после ответа 200 сокеты передаются
+# общему потоку пересылки, а поток клиента завершается
+def open_tunnel(client_socket, client_buffer, request, context, record):
+    target = parse_connect_target(request.target)
+    if target is None:
+        print(f"Некорректный формат запроса: {request.first_line}")
+        return False
+    host, port = target
+
+    if is_blacklisted(f"https://{host}:{port}/", context.blacklist):
+        response = forbidden_response(request.target)
+        client_socket.sendall(response)
+        record.respond(403, "Forbidden", len(response), "Blacklisted")
+        context.finish_request(record)
+        return False
+
+    try:
+        upstream_socket = connect_upstream(context.resolver, host, port)
+    except OSError as e:
+        response = bad_gateway_response(host, port)
+        client_socket.sendall(response)
+        record.respond(502, "Bad Gateway", len(response))
+        record.error = f"Ошибка при подключении к {host}:{port}: {e}"
+        context.finish_request(record)
+        return False
+    record.ttfb = time.monotonic() - record.started
+
+    try:
+        client_socket.sendall(CONNECT_ESTABLISHED)
+        # Дубликат дескриптора принадлежит потоку пересылки, исходный сокет закроет handle_client
+        tunnel_client = client_socket.dup()
+    except OSError:
+        upstream_socket.close()
+        raise
+
+    record.respond(200, "Connection Established", len(CONNECT_ESTABLISHED))
+    if not context.tunnel_relay.add(record, tunnel_client, upstream_socket, client_buffer):
+        tunnel_client.close()
+        upstream_socket.close()
+        client_socket.sendall(SERVICE_UNAVAILABLE)
+        record.respond(503, "Service Unavailable", len(SERVICE_UNAVAILABLE), "лимит туннелей")
+        context.finish_request(record)
+        return False
+
+    client_buffer.clear()
+    return False
+
+
+# Туннель CONNECT в asyncio-режиме: две сопрограммы пересылки на общем цикле событий
+async def open_tunnel_async(reader, writer, request, context, record):
+    target = parse_connect_target(request.target)
+    if target is None:
+        print(f"Некорректный формат запроса: {request.first_line}")
+        return False
+    host, port = target
+
+    try:
+        return await _open_tunnel_async(reader, writer, request, context, record, host, port)
+    except Exception as e:
+        record.error = str(e)
+        raise
+    finally:
+        context.finish_request(record)
+
+
+async def _open_tunnel_async(reader, writer, request, context, record, host, port):
+    if is_blacklisted(f"https://{host}:{port}/", context.blacklist):
+        response = forbidden_response(request.target)
+        writer.write(response)
+        await writer.drain()
+        record.respond(403, "Forbidden", len(response), "Blacklisted")
+        return False
+
+    if not context.tunnels.try_open(context.max_tunnels):
+        writer.write(SERVICE_UNAVAILABLE)
+        await writer.drain()
+        record.respond(503, "Service Unavailable", len(SERVICE_UNAVAILABLE), "лимит туннелей")
+        return False
+
+    tunnel = Tunnel(request.target, None, None)
+    timed_out = False
+    try:
+        try:
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                connect_upstream_async(context.resolver, host, port, limit=TUNNEL_CHUNK_SIZE), TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            response = bad_gateway_response(host, port)
+            writer.write(response)
+            await writer.drain()
+            record.respond(502, "Bad Gateway", len(response))
+            record.error = f"Ошибка при подключении к {host}:{port}: {e}"
+            return False
+        record.ttfb = time.monotonic() - record.started
+
+        writer.write(CONNECT_ESTABLISHED)
+        record.respond(200, "Connection Established", len(CONNECT_ESTABLISHED))
+
+        # Буферы записи ограничены, чтобы медленная сторона не накапливала данные в памяти
+        writer.transport.set_write_buffer_limits(high=TUNNEL_CHUNK_SIZE)
+        upstream_writer.transport.set_write_buffer_limits(high=TUNNEL_CHUNK_SIZE)
+        try:
+            results = await asyncio.gather(
+                _tunnel_pipe_async(reader, upstream_writer, tunnel, True, context.tunnel_idle_timeout),
+                _tunnel_pipe_async(upstream_reader, writer, tunnel, False, context.tunnel_idle_timeout),
+                return_exceptions=True)
+            timed_out = any(isinstance(result, asyncio.TimeoutError) for result in results)
+        finally:
+            upstream_writer.close()
+    finally:
+        context.tunnels.close(tunnel.bytes_up, tunnel.bytes_down, timed_out)
+        record.bytes_in += tunnel.bytes_up
+        record.bytes_out += tunnel.bytes_down
+        if timed_out:
+            record.note = "закрыт по таймауту"
+    return False
+
+
+async def _tunnel_pipe_async(source, destination, tunnel, upstream_direction, idle_timeout):
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(source.read(TUNNEL_CHUNK_SIZE), idle_timeout)
+            except asyncio.TimeoutError:
+                # Туннель простаивает, только если данных не было ни в одном направлении
+                if time.monotonic() - tunnel.last_activity < idle_timeout:
+                    continue
+                destination.close()
+                raise
+            if not chunk:
+                break
+
+            tunnel.last_activity = time.monotonic()
+            if upstream_direction:
+                tunnel.bytes_up += len(chunk)
+            else:
+                tunnel.bytes_down += len(chunk)
+            destination.write(chunk)
+            await destination.drain()
+
+        if destination.can_write_eof():
+            destination.write_eof()
+    except asyncio.TimeoutError:
+        raise  # В Python 3.11+ это подкласс OSError, поэтому обрабатывается отдельно
+    except (ConnectionError, OSError):
+        destination.close()
+
+
+def bad_gateway_response(host, port):
+    return (f"HTTP/1.1 502 Bad Gateway\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n"
+            f"<h1>502 Bad Gateway</h1><p>Error connecting to {host}:{port}</p>").encode('utf-8')
+
+
+# Обработка клиентского соединения: на одном соединении обслуживается несколько запросов
+def handle_client(client_socket, client_addr, context):
+    client_buffer = bytearray()
+    relay = Relay()
+    context.connection_opened()
+    try:
+        client_socket.settimeout(CLIENT_IDLE_TIMEOUT)
+        # Заголовок и тело отправляются отдельно; без TCP_NODELAY алгоритм Нейгла вместе с
+        # отложенным ACK клиента задерживает каждый ответ на keep-alive соединении на ~40 мс
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while not context.draining:
+            request_head = recv_head(client_socket, client_buffer, relay)
+            if not request_head:
+                break
+            if not serve_request(client_socket, client_buffer, request_head, context, relay, client_addr):
+                break
+    except socket.timeout:
+        pass  # Клиент долго не присылал следующий запрос
+    except Exception as e:
+        print(f"Ошибка при обработке запроса: {e}")
+    finally:
+        relay.close()
+        client_socket.close()
+        context.connection_closed()
+        context.admission.release(client_addr[0])
+
+
+# Обработка одного запроса; возвращает True, если соединение с клиентом можно использовать дальше
+def serve_request(client_socket, client_buffer, request_head, context, relay, client_addr=None):
+    request = parse_request_head(request_head)
+    if request is None:
+        first_line = request_head.split(b'\r\n', 1)[0].decode('latin-1')
+        print(f"Некорректный формат запроса: {first_line}")
+        return False
+    method, url, version, headers = request.method, request.target, request.version, request.headers
+
+    # Запрос метрик к самому прокси-серверу
+    if method == 'GET' and url == METRICS_PATH:
+        client_socket.sendall(metrics_response(context))
+        return False
+
+    record = AccessRecord(client_addr, method, url, len(request_head))
+
+    # Клиент, превысивший частоту запросов или объем трафика, получает отказ без обращения к серверу
+    if client_addr and not context.admission.allow_request(client_addr[0]):
+        client_socket.sendall(TOO_MANY_REQUESTS_RESPONSE)
+        record.respond(429, "Too Many Requests", len(TOO_MANY_REQUESTS_RESPONSE), "rate limit")
+        context.finish_request(record)
+        return False
+
+    # CONNECT-запрос: туннель до сервера (HTTPS); запись журнала делается при закрытии туннеля
+    if method == 'CONNECT':
+        return open_tunnel(client_socket, client_buffer, request, context, record)
+
+    if not url.startswith('http://'):
+        print(f"Некорректный формат запроса: {request.first_line}")
+        return False
+
+    try:
+        return serve_http_request(client_socket, client_buffer, request, context, relay, record)
+    except Exception as e:
+        record.error = str(e)
+        raise
+    finally:
+        context.finish_request(record)
+
+
+def serve_http_request(client_socket, client_buffer, request, context, relay, record):
+    method, url, version, headers = request.method, request.target, request.version, request.headers
+
+    # Проверка на черный список
+    if is_blacklisted(url, context.blacklist):
+        response = forbidden_response(url)
+        client_socket.sendall(response)
+        record.respond(403, "Forbidden", len(response), "Blacklisted")
+        return False
+
+    # Парсим URL: хост, порт и путь для сервера назначения
+    host, port, path = split_target(url)
+    key = (host, port)
+    keep_alive = wants_keep_alive(version, headers)
+    request_framing = body_framing(headers, is_request=True)
+
+    # Поиск в кэше: свежая запись отдается клиенту без обращения к серверу
+    cache = context.cache
+    cached, cached_body = None, None
+    if cache is not None:
+        if method == 'GET':
+            cached = cache.lookup(url, headers)
+            cached_body = cache.open_body(cached) if cached is not None else None
+            if cached_body is None:
+                cached = None
+        elif method not in SAFE_METHODS:
+            cache.invalidate(url)
+
+    try:
+        if cached is not None and cache.is_fresh(cached, headers):
+            sent = send_cached(client_socket, cached, cached_body, keep_alive)
+            cache.record_hit(cached)
+            record.respond(*parse_status_line(cached.status_line)[1:], sent, "Cache HIT")
+            return keep_alive
+
+        # Устаревшая запись проверяется у сервера условным запросом
+        revalidating = cached is not None and cached.has_validators() and not has_conditional_headers(headers)
+        upstream_head = request.rewrite(path, conditional_headers(cached) if revalidating else ())
+        return forward_request(client_socket, client_buffer, relay, context, key, method, url, headers,
+                               upstream_head, request_framing, keep_alive, cached if revalidating else None,
+                               cached_body, record)
+    finally:
+        if cached_body is not None and not isinstance(cached_body, bytes):
+            cached_body.close()
+
+
+def forward_request(client_socket, client_buffer, relay, context, key, method, url, headers,
+                    upstream_head, request_framing, keep_alive, revalidated_entry, cached_body, record):
+    cache = context.cache
+    host, port = key
+    upstream = None
+    try:
+        request_time = time.time()
+        try:
+            upstream, response_head, body_sent = exchange_head(client_socket, client_buffer, relay, context, key,
+                                                               upstream_head, request_framing)
+        except (OSError, ValueError) as e:
+            response = bad_gateway_response(host, port)
+            client_socket.sendall(response)
+            record.respond(502, "Bad Gateway", len(response))
+            record.error = f"Ошибка при подключении к {host}:{port}: {e}"
+            return False
+        record.ttfb = time.monotonic() - record.started
+        record.bytes_in += body_sent
+
+        # Промежуточные ответы 1xx передаются клиенту как есть
+        status_line, response_headers = parse_head(response_head)
+        response_version, status_code, status_message = parse_status_line(status_line)
+        while 100 <= status_code < 200 and status_code != 101:
+            client_socket.sendall(response_head)
+            record.bytes_out += len(response_head)
+            response_head = recv_head(upstream.sock, upstream.buffer, relay)
+            if not response_head:
+                raise ConnectionError("Сервер закрыл соединение после промежуточного ответа")
+            status_line, response_headers = parse_head(response_head)
+            response_version, status_code, status_message = parse_status_line(status_line)
+        response_time = time.time()
+
+        framing = body_framing(response_headers, has_body=response_has_body(method, status_code))
+        reusable = framing[0] != 'close' and wants_keep_alive(response_version, response_headers)
+
+        if revalidated_entry is not None and status_code == 304:
+            # Запись по-прежнему актуальна: тело отдается из кэша
+            relay_body(upstream.sock, upstream.buffer, client_socket, framing, relay)
+            if reusable:
+                context.pool.release(key, upstream)
+                upstream = None
+            entry = cache.refresh(revalidated_entry, response_headers, request_time, response_time)
+            sent = send_cached(client_socket, entry, cached_body, keep_alive)
+            cache.record_hit(entry, revalidated=True)
+            record.respond(*parse_status_line(entry.status_line)[1:], sent, "Cache REVALIDATED")
+            return keep_alive
+
+        # Ответ, длина которого определяется закрытием соединения, не оставляет соединения живыми
+        keep_alive = keep_alive and framing[0] != 'close' and status_code != 101
+
+        sink = None
+        if cache is not None and method == 'GET':
+            cache.record_miss()
+            if cache.is_cacheable(method, status_code, headers, response_headers):
+                sink = CacheSink(cache.max_object_size)
+
+        response_head = build_head(status_line, response_headers, keep_alive)
+        client_socket.sendall(response_head)
+        record.respond(status_code, status_message, len(response_head))
+        record.bytes_out += relay_body(upstream.sock, upstream.buffer, client_socket, framing, relay, sink)
+
+        if sink is not None and not sink.overflow:
+            cache.store(url, headers, status_line, response_headers, sink.body(), request_time, response_time)
+
+        if reusable:
+            context.pool.release(key, upstream)
+            upstream = None
+        return keep_alive
+    finally:
+        if upstream is not None:
+            upstream.close()
+
+
+# Отправка клиенту ответа из кэша; тело с диска передается через sendfile. Возвращает число байт
+def send_cached(client_socket, entry, body, keep_alive):
+    head = build_cached_head(entry, keep_alive)
+    client_socket.sendall(head)
+    if isinstance(body, bytes):
+        client_socket.sendall(body)
+    else:
+        client_socket.sendfile(body, entry.body_offset, entry.body_size)
+    return len(head) + entry.body_size
+
+
+# Отправка запроса серверу и получение заголовка ответа.
+# Соединение из пула могло быть закрыто сервером, поэтому запрос без тела повторяется на новом.
+# Возвращает соединение, заголовок ответа и число отправленных байт тела запроса
+def exchange_head(client_socket, client_buffer, relay, context, key, upstream_head, request_framing):
+    upstream = context.pool.acquire(key)
+    while True:
+        reused = upstream is not None
+        if not reused:
+            upstream = open_upstream(context, key)
+
+        try:
+            upstream.sock.sendall(upstream_head)
+            body_sent = relay_body(client_socket, client_buffer, upstream.sock, request_framing, relay)
+            response_head = recv_head(upstream.sock, upstream.buffer, relay)
+            if response_head:
+                return upstream, response_head, body_sent
+            error = ConnectionError("Сервер закрыл соединение без ответа")
+        except OSError as e:
+            error = e
+
+        upstream.close()
+        upstream = None
+        if not reused or request_framing != ('length', 0):
+            raise error
+
+
+def open_upstream(context, key):
+    started = time.monotonic()
+    sock = connect_upstream(context.resolver, *key)
+    context.pool.record_connect(time.monotonic() - started)
+    return UpstreamConnection(sock)
+
+
+# Обработка клиентского соединения в asyncio-режиме
+async def handle_client_async(reader, writer, context):
+    client_addr = writer.get_extra_info('peername')
+    rejection = context.admission.admit(client_addr[0])
+    if rejection is not None:
+        writer.write(rejection)
+        writer.close()
+        return
+
+    context.connection_opened()
+    try:
+        while not context.draining:
+            try:
+                request_head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), CLIENT_IDLE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                break
+            if not await serve_request_async(reader, writer, request_head, context, client_addr):
+                break
+    except Exception as e:
+        print(f"Ошибка при обработке запроса: {e}")
+    finally:
+        context.connection_closed()
+        context.admission.release(client_addr[0])
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def serve_request_async(reader, writer, request_head, context, client_addr=None):
+    request = parse_request_head(request_head)
+    if request is None:
+        first_line = request_head.split(b'\r\n', 1)[0].decode('latin-1')
+        print(f"Некорректный формат запроса: {first_line}")
+        return False
+    method, url, version, headers = request.method, request.target, request.version, request.headers
+
+    if method == 'GET' and url == METRICS_PATH:
+        writer.write(metrics_response(context))
+        await writer.drain()
+        return False
+
+    record = AccessRecord(client_addr, method, url, len(request_head))
+
+    if client_addr and not context.admission.allow_request(client_addr[0]):
+        writer.write(TOO_MANY_REQUESTS_RESPONSE)
+        await writer.drain()
+        record.respond(429, "Too Many Requests", len(TOO_MANY_REQUESTS_RESPONSE), "rate limit")
+        context.finish_request(record)
+        return False
+
+    if method == 'CONNECT':
+        return await open_tunnel_async(reader, writer, request, context, record)
+
+    if not url.startswith('http://'):
+        print(f"Некорректный формат запроса: {request.first_line}")
+        return False
+
+    try:
+        return await serve_http_request_async(reader, writer, request, context, record)
+    except Exception as e:
+        record.error = str(e)
+        raise
+    finally:
+        context.finish_request(record)
+
+
+async def serve_http_request_async(reader, writer, request, context, record):
+    method, url, version, headers = request.method, request.target, request.version, request.headers
+
+    if is_blacklisted(url, context.blacklist):
+        response = forbidden_response(url)
+        writer.write(response)
+        await writer.drain()
+        record.respond(403, "Forbidden", len(response), "Blacklisted")
+        return False
+
+    host, port, path = split_target(url)
+    key = (host, port)
+    keep_alive = wants_keep_alive(version, headers)
+    request_framing = body_framing(headers, is_request=True)
+
+    cache = context.cache
+    cached, cached_body = None, None
+    if cache is not None:
+        if method == 'GET':
+            cached = cache.lookup(url, headers)
+            cached_body = cache.open_body(cached) if cached is not None else None
+            if cached_body is None:
+                cached = None
+        elif method not in SAFE_METHODS:
+            cache.invalidate(url)
+
+    try:
+        if cached is not None and cache.is_fresh(cached, headers):
+            sent = await send_cached_async(writer, cached, cached_body, keep_alive)
+            cache.record_hit(cached)
+            record.respond(*parse_status_line(cached.status_line)[1:], sent, "Cache HIT")
+            return keep_alive
+
+        revalidating = cached is not None and cached.has_validators() and not has_conditional_headers(headers)
+        upstream_head = request.rewrite(path, conditional_headers(cached) if revalidating else ())
+        return await forward_request_async(reader, writer, context, key, method, url, headers,
+                                           upstream_head, request_framing, keep_alive,
+                                           cached if revalidating else None, cached_body, record)
+    finally:
+        if cached_body is not None and not isinstance(cached_body, bytes):
+            cached_body.close()
+
+
+async def forward_request_async(reader, writer, context, key, method, url, headers,
+                                upstream_head, request_framing, keep_alive, revalidated_entry, cached_body, record):
+    cache = context.cache
+    host, port = key
+    upstream = None
+    try:
+        request_time = time.time()
+        try:
+            upstream, response_head, body_sent = await exchange_head_async(reader, context, key,
+                                                                           upstream_head, request_framing)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            response = bad_gateway_response(host, port)
+            writer.write(response)
+            await writer.drain()
+            record.respond(502, "Bad Gateway", len(response))
+            record.error = f"Ошибка при подключении к {host}:{port}: {e}"
+            return False
+        record.ttfb = time.monotonic() - record.started
+        record.bytes_in += body_sent
+
+        status_line, response_headers = parse_head(response_head)
+        response_version, status_code, status_message = parse_status_line(status_line)
+        while 100 <= status_code < 200 and status_code != 101:
+            writer.write(response_head)
+            record.bytes_out += len(response_head)
+            response_head = await asyncio.wait_for(upstream.reader.readuntil(b'\r\n\r\n'), TIMEOUT)
+            status_line, response_headers = parse_head(response_head)
+            response_version, status_code, status_message = parse_status_line(status_line)
+        response_time = time.time()
+
+        framing = body_framing(response_headers, has_body=response_has_body(method, status_code))
+        reusable = framing[0] != 'close' and wants_keep_alive(response_version, response_headers)
+
+        if revalidated_entry is not None and status_code == 304:
+            await relay_body_async(upstream.reader, writer, framing)
+            if reusable:
+                context.pool.release(key, upstream)
+                upstream = None
+            entry = cache.refresh(revalidated_entry, response_headers, request_time, response_time)
+            sent = await send_cached_async(writer, entry, cached_body, keep_alive)
+            cache.record_hit(entry, revalidated=True)
+            record.respond(*parse_status_line(entry.status_line)[1:], sent, "Cache REVALIDATED")
+            return keep_alive
+
+        keep_alive = keep_alive and framing[0] != 'close' and status_code != 101
+
+        sink = None
+        if cache is not None and method == 'GET':
+            cache.record_miss()
+            if cache.is_cacheable(method, status_code, headers, response_headers):
+                sink = CacheSink(cache.max_object_size)
+
+        response_head = build_head(status_line, response_headers, keep_alive)
+        writer.write(response_head)
+        record.respond(status_code, status_message, len(response_head))
+        record.bytes_out += await relay_body_async(upstream.reader, writer, framing, sink)
+        await writer.drain()
+
+        if sink is not None and not sink.overflow:
+            # Вытеснение на диск может писать файлы, поэтому выполняется вне цикла событий
+            await asyncio.get_running_loop().run_in_executor(
+                None, cache.store, url, headers, status_line, response_headers, sink.body(),
+                request_time, response_time)
+
+        if reusable:
+            context.pool.release(key, upstream)
+            upstream = None
+        return keep_alive
+    finally:
+        if upstream is not None:
+            upstream.close()
+
+
+async def send_cached_async(writer, entry, body, keep_alive):
+    head = build_cached_head(entry, keep_alive)
+    writer.write(head)
+    if isinstance(body, bytes):
+        writer.write(body)
+        await writer.drain()
+    else:
+        await writer.drain()
+        await asyncio.get_running_loop().sendfile(writer.transport, body, entry.body_offset, entry.body_size)
+    return len(head) + entry.body_size
+
+
+async def exchange_head_async(reader, context, key, upstream_head, request_framing):
+    upstream = context.pool.acquire(key)
+    while True:
+        reused = upstream is not None
+        if not reused:
+            upstream = await open_upstream_async(context, key)
+
+        try:
+            upstream.writer.write(upstream_head)
+            body_sent = await relay_body_async(reader, upstream.writer, request_framing)
+            await upstream.writer.drain()
+            response_head = await asyncio.wait_for(upstream.reader.readuntil(b'\r\n\r\n'), TIMEOUT)
+            return upstream, response_head, body_sent
+        except (OSError, asyncio.IncompleteReadError) as e:
+            error = e
+
+        upstream.close()
+        upstream = None
+        if not reused or request_framing != ('length', 0):
+            raise error
+
+
+async def open_upstream_async(context, key):
+    started = time.monotonic()
+    upstream_reader, upstream_writer = await asyncio.wait_for(connect_upstream_async(context.resolver, *key), TIMEOUT)
+    context.pool.record_connect(time.monotonic() - started)
+    return AsyncUpstreamConnection(upstream_reader, upstream_writer)
+
+
+async def relay_body_async(reader, writer, framing, sink=None):
+    kind, length = framing
+    if kind == 'length':
+        await _relay_exact_async(reader, writer, length, sink)
+        return length
+    elif kind == 'chunked':
+        sent = 0
+        while True:
+            size_line = await asyncio.wait_for(reader.readuntil(b'\r\n'), TIMEOUT)
+            writer.write(size_line)
+            sent += len(size_line)
+
+            chunk_size = int(size_line.split(b';')[0].strip(), 16)
+            if chunk_size == 0:
+                while size_line != b'\r\n':
+                    size_line = await asyncio.wait_for(reader.readuntil(b'\r\n'), TIMEOUT)
+                    writer.write(size_line)
+                    sent += len(size_line)
+                return sent
+            await _relay_exact_async(reader, writer, chunk_size, sink)
+            await _relay_exact_async(reader, writer, 2)
+            sent += chunk_size + 2
+    else:
+        sent = 0
+        while True:
+            chunk = await asyncio.wait_for(reader.read(ASYNC_CHUNK_SIZE), TIMEOUT)
+            if not chunk:
+                return sent
+            writer.write(chunk)
+            if sink is not None:
+                sink(chunk)
+            sent += len(chunk)
+            await writer.drain()
+
+
+async def _relay_exact_async(reader, writer, length, sink=None):
+    while length > 0:
+        chunk = await asyncio.wait_for(reader.read(min(ASYNC_CHUNK_SIZE, length)), TIMEOUT)
+        if not chunk:
+            raise ConnectionError("Соединение закрыто до конца тела сообщения")
+        writer.write(chunk)
+        if sink is not None:
+            sink(chunk)
+        await writer.drain()
+        length -= len(chunk)
+
+
+# Разбор абсолютного URL на хост, порт и путь для сервера назначения
+def split_target(url):
+    authority_start = url.find('://') + 3
+    path_start = url.find('/', authority_start)
+    query_start = url.find('?', authority_start)
+    if path_start < 0 or 0 <= query_start < path_start:
+        path_start = query_start
+    if path_start < 0:
+        authority, path = url[authority_start:], "/"
+    else:
+        authority, path = url[authority_start:path_start], url[path_start:]
+    path = path.partition('#')[0]
+    if path.startswith('?'):
+        path = "/" + path
+
+    host = authority.rpartition('@')[2]
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        port = int(port)
+    else:
+        port = 80  # Стандартный HTTP-порт
+
+    return host, port, path
+
+
+# Снимок статистики процесса; в режиме нескольких процессов отправляется супервизору
+def collect_stats(context):
+    with context.lock:
+        connections = {"active": context.active_connections, "accepted": context.accepted_connections}
+    requests = context.metrics.stats()
+    requests["log_dropped"] = context.access_log.dropped
+    return {
+        "connections": connections,
+        "requests": requests,
+        "admission": context.admission.stats(),
+        "pool": context.pool.stats(),
+        "dns": context.resolver.stats(),
+        "cache": context.cache.stats() if context.cache is not None else None,
+        "tunnels": context.tunnels.stats(),
+        "blacklist": {"entries": len(context.blacklist), "reloads": context.blacklist.reloads},
+    }
+
+
+# Сводная статистика нескольких процессов: счетчики складываются, доли пересчитываются
+def aggregate_stats(snapshots):
+    total = {}
+    for snapshot in snapshots:
+        for section, values in snapshot.items():
+            if values is None:
+                total.setdefault(section, None)
+                continue
+            section_total = total.get(section) or {}
+            for name, value in values.items():
+                section_total[name] = section_total.get(name, 0) + value
+            total[section] = section_total
+
+    pool = total.get("pool")
+    if pool:
+        requests = pool["hits"] + pool["misses"]
+        pool["hit_ratio"] = pool["hits"] / requests if requests else 0.0
+        pool["avg_connect_ms"] = pool["saved_connect_ms"] / pool["hits"] if pool["hits"] else 0.0
+    dns = total.get("dns")
+    if dns:
+        lookups = dns["hits"] + dns["negative_hits"] + dns["misses"] + dns["coalesced"]
+        dns["hit_ratio"] = (dns["hits"] + dns["negative_hits"] + dns["coalesced"]) / lookups if lookups else 0.0
+    cache = total.get("cache")
+    if cache:
+        lookups = cache["hits"] + cache["revalidated"] + cache["misses"]
+        cache["hit_ratio"] = (cache["hits"] + cache["revalidated"]) / lookups if lookups else 0.0
+    blacklist = total.get("blacklist")
+    if blacklist and snapshots:
+        blacklist["entries"] = max(snapshot["blacklist"]["entries"] for snapshot in snapshots)
+    return total
+
+
+def print_stats(stats):
+    connections = stats["connections"]
+    print(f"Соединения: принято {connections['accepted']}, активно {connections['active']}")
+
+    requests = stats["requests"]
+    print(f"Запросы: {requests['requests']}, получено {requests['bytes_in']} Б, отправлено {requests['bytes_out']} Б, "
+          f"по черному списку {requests['blacklist_hits']}, ошибок сервера назначения {requests['upstream_errors']}, "
+          f"потеряно записей журнала {requests['log_dropped']}")
+
+    admission = stats["admission"]
+    print(f"Отклонено: соединений сверх общего лимита {admission['rejected_connections']}, "
+          f"сверх лимита на IP {admission['rejected_per_ip']}, запросов по частоте {admission['limited_requests']}, "
+          f"по объему трафика {admission['limited_bytes']}")
+
+    pool = stats["pool"]
+    print(f"Пул соединений: попаданий {pool['hits']}, промахов {pool['misses']} "
+          f"({pool['hit_ratio']:.1%}), сэкономлено ~{pool['saved_connect_ms']:.0f} мс на установку соединений")
+
+    dns = stats["dns"]
+    print(f"Кэш DNS: попаданий {dns['hits']}, по ошибкам {dns['negative_hits']}, "
+          f"объединено {dns['coalesced']}, поисков {dns['misses']} ({dns['hit_ratio']:.1%}), "
+          f"на поиски потрачено {dns['lookup_ms']:.0f} мс")
+
+    cache = stats["cache"]
+    if cache is not None:
+        print(f"Кэш: попаданий {cache['hits']}, проверено у сервера {cache['revalidated']}, промахов {cache['misses']} "
+              f"({cache['hit_ratio']:.1%}), сэкономлено {cache['bytes_saved'] / 1024:.0f} КБ")
+
+    tunnels = stats["tunnels"]
+    print(f"Туннели CONNECT: открыто {tunnels['opened']}, отклонено {tunnels['rejected']}, "
+          f"закрыто по таймауту {tunnels['idle_timeouts']}, отправлено {tunnels['bytes_up']} Б, "
+          f"получено {tunnels['bytes_down']} Б")
+
+
+# Запрос на корректное завершение (SIGTERM) в потоковом режиме
+class ShutdownRequest(Exception):
+    pass
+
+
+def request_shutdown(signum, frame):
+    # Повторный сигнал не должен прерывать уже начатое завершение
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise ShutdownRequest()
+
+
+# Ожидание завершения активных соединений и туннелей, не дольше DRAIN_TIMEOUT
+def wait_for_drain(context):
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while time.monotonic() < deadline:
+        with context.lock:
+            active = context.active_connections
+        if active == 0 and context.tunnels.stats()["active"] == 0:
+            return
+        time.sleep(0.1)
+
+
+def reload_blacklist_in_background(context):
+    threading.Thread(target=context.blacklist.reload, daemon=True).start()
+
+
+# Основная функция прокси-сервера в asyncio-режиме
+async def serve_asyncio(context, host, port, reuse_port=False):
+    server = await asyncio.start_server(
+        lambda r, w: handle_client_async(r, w, context),
+        host, port, backlog=LISTEN_BACKLOG, reuse_address=True, reuse_port=reuse_port or None)
+
+    # Сигналы обрабатываются в цикле событий: SIGTERM/SIGINT - завершение, SIGHUP - перезагрузка списка
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGHUP, reload_blacklist_in_background, context)
+
+    print(f"HTTP прокси-сервер (asyncio) запущен на {host}:{port}{worker_label(context)}")
+
+    try:
+        await stop.wait()
+        # Новые соединения больше не принимаются, начатые запросы дообслуживаются
+        server.close()
+        context.draining = True
+        deadline = loop.time() + DRAIN_TIMEOUT
+        while loop.time() < deadline:
+            with context.lock:
+                active = context.active_connections
+            if active == 0 and context.tunnels.stats()["active"] == 0:
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        # Соединения asyncio нужно закрыть, пока цикл событий еще работает
+        context.pool.close_all()
+
+
+def worker_label(context):
+    return f" (процесс {context.worker_id})" if context.worker_id is not None else ""
+
+
+# Периодическая отправка статистики процесса-обработчика супервизору
+def report_stats(context, stats_queue):
+    while True:
+        time.sleep(STATS_INTERVAL)
+        stats_queue.put((context.worker_id, os.getpid(), collect_stats(context)))
+
+
+# Основная функция прокси-сервера
+def run_proxy_server(mode="threaded", host=PROXY_HOST, port=PROXY_PORT, max_connections=MAX_CONNECTIONS,
+                     cache_dir=CACHE_DIR, use_cache=True, cache_memory_limit=CACHE_MEMORY_LIMIT,
+                     cache_disk_limit=CACHE_DISK_LIMIT, blacklist_path=BLACKLIST_PATH, max_tunnels=MAX_TUNNELS,
+                     tunnel_idle_timeout=TUNNEL_IDLE_TIMEOUT, access_log_path=None,
+                     max_connections_per_ip=MAX_CONNECTIONS_PER_IP, request_rate=0, request_burst=0,
+                     byte_rate=0, byte_burst=0, worker_id=None, stats_queue=None):
+    server_socket = None
+    context = None
+    try:
+        # Загружаем черный список; дальше он перечитывается при изменении файла
+        blacklist = ReloadingBlacklist(blacklist_path)
+        if blacklist and worker_id in (None, 0):
+            print(f"Загружен черный список из {len(blacklist)} элементов")
+        blacklist.start()
+
+        # У каждого процесса-обработчика свой каталог дискового кэша
+        if worker_id is not None:
+            cache_dir = os.path.join(cache_dir, f"worker-{worker_id}")
+        cache = ResponseCache(cache_dir, cache_memory_limit, cache_disk_limit) if use_cache else None
+        access_log = AccessLog(access_log_path)
+        access_log.start()
+        admission = AdmissionControl(max_connections, max_connections_per_ip,
+                                     request_rate, request_burst, byte_rate, byte_burst)
+        context = ProxyContext(blacklist, UpstreamPool(), cache, max_tunnels, tunnel_idle_timeout,
+                               access_log=access_log, admission=admission)
+        context.worker_id = worker_id
+
+        if stats_queue is not None:
+            threading.Thread(target=report_stats, args=(context, stats_queue), daemon=True).start()
+
+        if mode == "asyncio":
+            asyncio.run(serve_asyncio(context, host, port, reuse_port=worker_id is not None))
+            return
+
+        context.tunnel_relay = TunnelRelay(context.tunnels, max_tunnels, tunnel_idle_timeout,
+                                           context.finish_request)
+        context.tunnel_relay.start()
+
+        # Создаем сокет сервера
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if worker_id is not None:
+            # Каждый процесс слушает свой сокет, соединения между ними распределяет ядро
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+        server_socket.listen(LISTEN_BACKLOG)
+
+        signal.signal(signal.SIGTERM, request_shutdown)
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_blacklist_in_background(context))
+
+        print(f"HTTP прокси-сервер запущен на {host}:{port}{worker_label(context)}")
+
+        # Основной цикл прокси-сервера
+        while True:
+            try:
+                client_socket, client_addr = server_socket.accept()
+                # Сверх лимитов соединение отклоняется сразу, поток для него не создается
+                rejection = context.admission.admit(client_addr[0])
+                if rejection is not None:
+                    reject_connection(client_socket, rejection)
+                    continue
+                client_thread = threading.Thread(
+                    target=handle_client,
+                    args=(client_socket, client_addr, context)
+                )
+                client_thread.daemon = True
+                client_thread.start()
+            except (KeyboardInterrupt, ShutdownRequest):
+                break
+            except Exception as e:
+                print(f"Ошибка при обработке соединения: {e}")
+
+        # Прекращаем прием соединений и даем начатым запросам завершиться
+        server_socket.close()
+        server_socket = None
+        context.draining = True
+        wait_for_drain(context)
+
+    except (KeyboardInterrupt, ShutdownRequest):
+        pass
+    except Exception as e:
+        print(f"Ошибка при запуске прокси-сервера: {e}")
+    finally:
+        if context is not None:
+            context.access_log.close()
+        print(f"Завершение работы прокси-сервера{worker_label(context) if context else ''}")
+        if context is not None:
+            if stats_queue is not None:
+                stats_queue.put((context.worker_id, os.getpid(), collect_stats(context)))
+            else:
+                print_stats(collect_stats(context))
+            context.pool.close_all()
+        if server_socket is not None:
+            server_socket.close()
+        sys.exit(0)
+
+
+# Точка входа процесса-обработчика: Ctrl+C в терминале получает вся группа процессов,
+# но завершением обработчиков управляет супервизор
+def run_worker(worker_id, options, stats_queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_proxy_server(**options, worker_id=worker_id, stats_queue=stats_queue)
+
+
+# Супервизор режима нескольких процессов: запускает обработчики с SO_REUSEPORT,
+# перезапускает упавшие, передает им SIGHUP и собирает общую статистику
+def run_supervisor(workers, options):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        print("Ошибка: SO_REUSEPORT не поддерживается в этой системе")
+        sys.exit(1)
+
+    process_context = multiprocessing.get_context('fork')
+    stats_queue = process_context.Queue()
+    processes = {}  # номер обработчика -> (процесс, время запуска)
+    latest = {}  # pid -> последний снимок статистики
+    retired = []  # Итоговые снимки завершившихся процессов
+    state = {"stopping": False, "show_stats": False}
+
+    def spawn(worker_id):
+        process = process_context.Process(target=run_worker, args=(worker_id, options, stats_queue))
+        process.start()
+        processes[worker_id] = (process, time.monotonic())
+
+    def drain_queue(timeout):
+        try:
+            worker_id, pid, snapshot = stats_queue.get(timeout=timeout)
+            latest[pid] = snapshot
+            while True:
+                worker_id, pid, snapshot = stats_queue.get_nowait()
+                latest[pid] = snapshot
+        except queue.Empty:
+            pass
+
+    def current_stats():
+        return aggregate_stats(retired + list(latest.values()))
+
+    def forward_signal(signum, frame):
+        for process, _ in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stop(signum, frame):
+        state["stopping"] = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, forward_signal)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: state.update(show_stats=True))
+
+    print(f"Супервизор запускает {workers} процессов-обработчиков на {options['host']}:{options['port']}")
+    for worker_id in range(workers):
+        spawn(worker_id)
+
+    while not state["stopping"]:
+        drain_queue(timeout=0.5)
+
+        for worker_id, (process, started) in list(processes.items()):
+            if process.is_alive():
+                continue
+            # Итоговая статистика упавшего процесса сохраняется в общей сумме
+            if process.pid in latest:
+                retired.append(latest.pop(process.pid))
+            if state["stopping"]:
+                break
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                continue  # Не перезапускаем слишком часто процесс, который сразу падает
+            print(f"Процесс-обработчик {worker_id} завершился с кодом {process.exitcode}, перезапуск")
+            spawn(worker_id)
+
+        if state["show_stats"]:
+            state["show_stats"] = False
+            print_stats(current_stats())
+
+    # Корректное завершение: обработчики перестают принимать соединения и дообслуживают начатые
+    print("Завершение работы супервизора")
+    for process, _ in processes.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + DRAIN_TIMEOUT + 2
+    for process, _ in processes.values():
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    drain_queue(timeout=0.5)
+    print_stats(current_stats())
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="HTTP прокси-сервер с черным списком")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="threaded",
+                        help="режим обслуживания: поток на соединение или цикл событий asyncio")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="число процессов-обработчиков с SO_REUSEPORT (0 - один процесс без супервизора)")
+    parser.add_argument("--host", default=PROXY_HOST, help="адрес прокси-сервера")
+    parser.add_argument("--port", type=int, default=PROXY_PORT, help="порт прокси-сервера")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="максимум одновременных клиентских соединений; сверх него - 503")
+    parser.add_argument("--max-connections-per-ip", type=int, default=MAX_CONNECTIONS_PER_IP,
+                        help="максимум одновременных соединений с одного IP; сверх него - 429")
+    parser.add_argument("--request-rate", type=float, default=0,
+                        help="запросов в секунду с одного IP (0 - без ограничения)")
+    parser.add_argument("--request-burst", type=int, default=0,
+                        help="допустимый всплеск запросов с одного IP (по умолчанию равен частоте)")
+    parser.add_argument("--byte-rate", type=int, default=0,
+                        help="байт в секунду трафика одного IP (0 - без ограничения)")
+    parser.add_argument("--byte-burst", type=int, default=0,
+                        help="допустимый всплеск трафика одного IP, байт (по умолчанию равен скорости)")
+    parser.add_argument("--max-tunnels", type=int, default=MAX_TUNNELS,
+                        help="максимум одновременных туннелей CONNECT")
+    parser.add_argument("--tunnel-idle-timeout", type=int, default=TUNNEL_IDLE_TIMEOUT,
+                        help="таймаут простоя туннеля CONNECT, с")
+    parser.add_argument("--blacklist", default=BLACKLIST_PATH, help="файл черного списка")
+    parser.add_argument("--access-log", help="файл журнала доступа в формате JSON по строке на запрос "
+                                             "(\"-\" - на консоль); без него журнал выводится текстом")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="каталог дискового уровня кэша")
+    parser.add_argument("--cache-memory-mb", type=int, default=CACHE_MEMORY_LIMIT // (1024 * 1024),
+                        help="объем кэша в памяти, МБ")
+    parser.add_argument("--cache-disk-mb", type=int, default=CACHE_DISK_LIMIT // (1024 * 1024),
+                        help="объем дискового кэша, МБ")
+    parser.add_argument("--no-cache", action="store_true", help="отключить кэширование ответов")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    run_proxy_server()
+    args = parse_arguments()
+    options = dict(
+        mode=args.mode, host=args.host, port=args.port, max_connections=args.max_connections,
+        cache_dir=args.cache_dir, use_cache=not args.no_cache,
+        cache_memory_limit=args.cache_memory_mb * 1024 * 1024, cache_disk_limit=args.cache_disk_mb * 1024 * 1024,
+        blacklist_path=args.blacklist, max_tunnels=args.max_tunnels, tunnel_idle_timeout=args.tunnel_idle_timeout,
+        access_log_path=args.access_log, max_connections_per_ip=args.max_connections_per_ip,
+        request_rate=args.request_rate, request_burst=args.request_burst,
+        byte_rate=args.byte_rate, byte_burst=args.byte_burst,
+    )
+    if args.workers > 0:
+        run_supervisor(args.workers, options)
+    else:
+        run_proxy_server(**options)